@@ -0,0 +1,92 @@
+"""
+Size of the error messages given to the diagnosis, built from build logs with
+the previous `get_err_msg` and with the log reduction of `reduce_log`.
+Runs on the given build logs, or on a generated pip install log.
+
+    python -m eval.bench_log_reduce logs/build_logs/*.log
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+
+from install_test.log_reduce import reduce_log
+
+ERR_MESSAGE_LIMIT = 30
+
+
+def legacy_err_msg(log: str) -> str:
+    lines = log.splitlines(True)
+    sections = [i for i, l in enumerate(lines) if set(l.strip()) == {"-"}]
+    if len(sections) >= 4:
+        return "\n".join(lines[sections[-4] :])
+    return "\n".join(lines[-ERR_MESSAGE_LIMIT:])
+
+
+def pip_log(n_packages: int) -> str:
+    "buildkit output of a pip install that downloads many packages and then fails"
+    lines = ["#7 [3/4] RUN pip install -e ."]
+    for i in range(n_packages):
+        lines += [
+            f"#7 {i}.01 Collecting package{i}>=1.{i}",
+            f"#7 {i}.02   Downloading package{i}-1.{i}.0-py3-none-any.whl (2.{i} MB)",
+            f"#7 {i}.03      {'━' * 40} 2.{i}/2.{i} MB 31.4 MB/s eta 0:00:00",
+        ]
+    error = [
+        "  error: subprocess-exited-with-error",
+        "  × Getting requirements to build wheel did not run successfully.",
+        "  │ exit code: 1",
+        "  ╰─> [4 lines of output]",
+        "      Traceback (most recent call last):",
+        '        File "setup.py", line 3, in <module>',
+        "      ModuleNotFoundError: No module named 'numpy'",
+        "      [end of output]",
+    ]
+    lines += [f"#7 {n_packages}.{i:02d} {line}" for i, line in enumerate(error)]
+    failed = 'process "/bin/sh -c pip install -e ." did not complete successfully'
+    lines += [
+        f"#7 ERROR: {failed}: exit code: 1",
+        "------",
+        " > [3/4] RUN pip install -e .:",
+    ]
+    lines += [f"{n_packages}.{i:02d} {line}" for i, line in enumerate(error)]
+    lines += ["------", f"ERROR: failed to solve: {failed}: exit code: 1"]
+    return "\n".join(lines) + "\n"
+
+
+def main(args):
+    logs = []
+    for path in args.logs:
+        with open(path, "r") as f:
+            logs.append((os.path.basename(path), f.read()))
+    if len(logs) == 0:
+        logs.append(("generated pip log", pip_log(args.packages)))
+    total = {"log": 0, "legacy": 0, "reduced": 0}
+    for name, log in logs:
+        legacy = legacy_err_msg(log)
+        start = time.perf_counter()
+        reduced = reduce_log(log)
+        elapsed = time.perf_counter() - start
+        total["log"] += len(log)
+        total["legacy"] += len(legacy)
+        total["reduced"] += reduced["reduced_chars"]
+        print(
+            f"{name[:32]:<32} log {len(log):8d}  legacy {len(legacy):7d}  "
+            f"reduced {reduced['reduced_chars']:6d} chars  "
+            f"{len(reduced['errors'])} errors  {elapsed * 1000:7.2f} ms"
+        )
+    print(
+        f"reduced messages are {total['reduced'] / max(total['legacy'], 1):.1%} "
+        f"of the legacy ones and {total['reduced'] / max(total['log'], 1):.1%} "
+        "of the logs"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("logs", nargs="*")
+    parser.add_argument("--packages", type=int, default=300)
+    main(parser.parse_args())
@@ -0,0 +1,94 @@
+"""
+Benchmark of matching tool arguments against the paths of a large repository,
+with difflib over the whole list and with the index of PathList.
+Paths are added a directory at a time, as the agents discover them.
+
+    python -m eval.bench_matcher --paths 20000 --queries 200
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from difflib import get_close_matches
+
+sys.path.append(os.getcwd())
+
+from install_test.utils import PathList
+
+PACKAGES = ["core", "api", "web", "cli", "sdk", "infra", "data", "ml", "auth", "ui"]
+DIRS = ["src", "tests", "docs", "scripts", "examples", "config", "lib", "utils"]
+NAMES = ["install", "setup", "readme", "build", "client", "server", "models", "io"]
+EXTENSIONS = [".py", ".md", ".rst", ".txt", ".toml", ".cfg", ".yml", ".json"]
+
+
+def monorepo(n_paths: int, rng: random.Random) -> list:
+    "a listing of n_paths files, grouped by directory"
+    directories = {}
+    while sum(len(files) for files in directories.values()) < n_paths:
+        directory = "/".join(
+            [rng.choice(PACKAGES) + str(rng.randrange(20))]
+            + rng.sample(DIRS, rng.randrange(1, 4))
+        )
+        name = f"{rng.choice(NAMES)}_{rng.randrange(100)}{rng.choice(EXTENSIONS)}"
+        directories.setdefault(directory, []).append(f"{directory}/{name}")
+    return list(directories.values())
+
+
+def typo(path: str, rng: random.Random) -> str:
+    i = rng.randrange(len(path))
+    return path[:i] + rng.choice("abcdefghijklmnopqrstuvwxyz") + path[i + 1 :]
+
+
+def queries(paths: list, n: int, rng: random.Random) -> list:
+    "exact paths, file names, paths with a typo and paths that do not exist"
+    kinds = [
+        lambda: rng.choice(paths),
+        lambda: "/".join(rng.choice(paths).split("/")[-2:]),
+        lambda: "./" + rng.choice(paths),
+        lambda: typo(rng.choice(paths), rng),
+        lambda: f"missing/{rng.choice(NAMES)}.lock",
+    ]
+    return [kinds[i % len(kinds)]() for i in range(n)]
+
+
+def match(options, query: str, cutoff: float):
+    if isinstance(options, PathList):
+        return options.close_match(query, cutoff)
+    matches = get_close_matches(query, options, n=1, cutoff=cutoff)
+    return matches[0] if len(matches) > 0 else None
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    listing = monorepo(args.paths, rng)
+    paths = [path for directory in listing for path in directory]
+    qs = queries(paths, args.queries, rng)
+    results = {}
+    for name, options in [("difflib", []), ("PathList", PathList())]:
+        start = time.perf_counter()
+        matched = []
+        # the listing grows between lookups, as update_files_dirs extends it
+        step = max(len(listing) // len(qs), 1)
+        for i, query in enumerate(qs):
+            for directory in listing[i * step : (i + 1) * step]:
+                options.extend(directory)
+            matched.append(match(options, query, args.cutoff))
+        elapsed = time.perf_counter() - start
+        results[name] = matched
+        print(
+            f"{name:<10} {elapsed:8.3f}s  {elapsed / len(qs) * 1000:8.3f} ms/lookup  "
+            f"{sum(m is not None for m in matched)} matched"
+        )
+    same = sum(a == b for a, b in zip(results["difflib"], results["PathList"]))
+    print(f"same result for {same}/{len(qs)} lookups over {len(paths)} paths")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--paths", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--cutoff", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
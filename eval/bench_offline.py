@@ -0,0 +1,236 @@
+"""
+Benchmark of the pipeline without the openai api or github:
+a scripted stand-in answers the model requests with a fixed latency,
+and repository contents are read from a generated local checkout.
+The time not spent waiting on the model is the overhead of the agents.
+
+    python -m eval.bench_offline --latency 0.05 --runs 5 --sessions 8
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+sys.path.append(os.getcwd())
+
+from install_test.agent import AsyncGatherAgent, GatherAgent, RepairAgent
+from install_test.agent.agent import Agent
+from install_test.agent.functions import set_backend, set_cache
+from install_test.agent.functions_json import FUNC_DOCKERFILE_NAME
+from install_test.agent.mock_llm import (
+    MOCK_MODEL,
+    MockLLMServer,
+    ScriptedBackend,
+    ScriptedChat,
+)
+from vm_control import VMController, WorkerPool, parse_worker
+
+REPO_URL = "https://github.com/mock/repo.git"
+REPO_FILES = {
+    "README.md": "# repo\n\n## Installation\n\n    pip install -e .\n\n## Tests\n\n    pytest\n",
+    "CONTRIBUTING.md": "# Contributing\n\n## Development setup\n\n    pip install -r requirements-dev.txt\n",
+    "requirements-dev.txt": "pytest\n",
+    "setup.py": "from setuptools import setup\n\nsetup(name='repo')\n",
+    "docs/install.md": "# Install\n\nRun `pip install .`\n",
+    "repo/__init__.py": "",
+    "tests/test_repo.py": "def test_ok():\n    assert True\n",
+}
+SCRIPT = [
+    ("get_directory_contents", {"directory": "docs"}),
+    ("get_file_contents", {"file": "README.md"}),
+    ("submit_documentation", {"file": "README.md"}),
+    ("get_file_contents", {"file": "CONTRIBUTING.md"}),
+    ("submit_documentation", {"file": "CONTRIBUTING.md"}),
+    ("check_presence", {"file": "setup.py"}),
+    ("finished_search", {}),
+    ("get_file_contents", {"file": "README.md"}),
+    ("submit_summary", {"summary": "install with pip install -e . and run pytest"}),
+]
+# the same search, with the reads of each step requested in a single turn
+PARALLEL_SCRIPT = [
+    [
+        ("get_directory_contents", {"directory": "docs"}),
+        ("get_file_contents", {"file": "README.md"}),
+        ("get_file_contents", {"file": "CONTRIBUTING.md"}),
+        ("check_presence", {"file": "setup.py"}),
+    ],
+    [
+        ("submit_documentation", {"file": "README.md"}),
+        ("submit_documentation", {"file": "CONTRIBUTING.md"}),
+        ("finished_search", {}),
+    ],
+    ("get_file_contents", {"file": "README.md"}),
+    ("submit_summary", {"summary": "install with pip install -e . and run pytest"}),
+]
+DOCKERFILE = (
+    "FROM python:3.11-slim\n"
+    "RUN apt-get update && apt-get install -y git\n"
+    f"RUN git clone {REPO_URL} /repo\n"
+    "WORKDIR /repo\n"
+    "RUN pip install -e . pytest\n"
+    "RUN pytest\n"
+)
+
+
+def make_checkout(clone_dir: str):
+    checkout = os.path.join(clone_dir, "mock__repo@HEAD")
+    for path, content in REPO_FILES.items():
+        path = os.path.join(checkout, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+
+def run_pipeline(build: bool) -> Dict[str, Any]:
+    "gather, summarise, generate and optionally build, timing every stage"
+    times = {}
+    start = time.time()
+    agent = GatherAgent(
+        model=MOCK_MODEL,
+        system=GatherAgent.init_system_message(REPO_URL),
+        verbose=False,
+    )
+    documents, contents = agent.gather(REPO_URL)
+    times["gather"] = time.time() - start
+    start = time.time()
+    agent.summarise(REPO_URL, documents, contents)
+    times["summarise"] = time.time() - start
+    start = time.time()
+    dockerfile = agent.gen_dockerfile(REPO_URL)
+    times["generate"] = time.time() - start
+    calls = agent.calls
+    if build:
+        start = time.time()
+        repair_agent = RepairAgent(
+            MOCK_MODEL,
+            RepairAgent.init_system_message(REPO_URL, dockerfile),
+            verbose=False,
+        )
+        repair_agent.repair_dockerfile(
+            REPO_URL, dockerfile, "repo", n_tries=1, alternatives=agent.alternatives
+        )
+        times["repair"] = time.time() - start
+        times["rounds"] = repair_agent.rounds
+        calls += repair_agent.calls
+    times["calls"] = calls
+    return times
+
+
+async def run_sessions(n_sessions: int) -> float:
+    "gather and summarise on many async agents sharing one event loop"
+
+    async def session():
+        agent = AsyncGatherAgent(
+            model=MOCK_MODEL,
+            system=GatherAgent.init_system_message(REPO_URL),
+            verbose=False,
+        )
+        documents, contents = await agent.agather(REPO_URL)
+        await agent.asummarise(REPO_URL, documents, contents)
+
+    start = time.time()
+    await asyncio.gather(*[session() for _ in range(n_sessions)])
+    return time.time() - start
+
+
+def report(name: str, wall: float, busy: float, requests: int):
+    print(
+        f"{name:<12} wall {wall:8.3f}s  model {busy:8.3f}s  "
+        f"overhead {wall - busy:8.3f}s  requests {requests}"
+    )
+
+
+def main(args):
+    clone_dir = args.clone_dir or tempfile.mkdtemp(prefix="bench_offline_")
+    make_checkout(clone_dir)
+    set_backend("local", clone_dir)
+    set_cache(None)
+    os.makedirs("logs/dockerfiles", exist_ok=True)
+    os.makedirs("logs/build_logs", exist_ok=True)
+    if args.workers:
+        VMController.pool = WorkerPool([parse_worker(w) for w in args.workers])
+    Agent.n_candidates = args.candidates
+
+    chat = ScriptedChat(
+        PARALLEL_SCRIPT if args.parallel else SCRIPT,
+        latency=args.latency,
+        defaults={FUNC_DOCKERFILE_NAME: {"dockerfile": DOCKERFILE}},
+    )
+    server = None
+    if args.server:
+        server = MockLLMServer(chat).start()
+        Agent.base_url = server.url
+        os.environ.setdefault("OPENAI_API_KEY", "offline")
+    else:
+        Agent.backend = ScriptedBackend(chat)
+
+    try:
+        runs: List[Dict[str, Any]] = []
+        for _ in range(args.runs):
+            requests, busy = chat.requests, chat.busy
+            start = time.time()
+            times = run_pipeline(args.build)
+            report(
+                "pipeline",
+                time.time() - start,
+                chat.busy - busy,
+                chat.requests - requests,
+            )
+            runs.append(times)
+        for stage in ["gather", "summarise", "generate", "repair"]:
+            if stage in runs[0]:
+                mean = sum(times[stage] for times in runs) / len(runs)
+                print(f"  {stage:<10} mean {mean:8.3f}s")
+
+        if args.sessions > 0:
+            requests, busy = chat.requests, chat.busy
+            wall = asyncio.run(run_sessions(args.sessions))
+            # model time overlaps between sessions, so it is reported summed
+            print(
+                f"{args.sessions} sessions  wall {wall:8.3f}s  "
+                f"summed model {chat.busy - busy:8.3f}s  "
+                f"requests {chat.requests - requests}"
+            )
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=0,
+        help="Number of concurrent async gather sessions to run after the pipeline.",
+    )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="Serve the script over http instead of calling it in process.",
+    )
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="Request several tool calls per turn, as models with parallel calls do.",
+    )
+    parser.add_argument(
+        "--build",
+        action="store_true",
+        help="Also build the generated dockerfile on the build workers.",
+    )
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=1,
+        help="Number of dockerfiles to generate and build at the same time.",
+    )
+    parser.add_argument("--workers", nargs="+", default=None)
+    parser.add_argument("--clone_dir", default=None)
+    main(parser.parse_args())
@@ -0,0 +1,147 @@
+"""
+Micro-benchmark of the section parsers against the previous implementations
+of `get_headings` and `get_headings_rst`, on large generated documents.
+
+    python -m eval.bench_sections --sections 2000 --repeat 20
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import Callable, List, Optional, Tuple
+
+sys.path.append(os.getcwd())
+
+from install_test.agent.functions import get_headings, get_headings_rst
+from install_test.agent.sections import parse_markdown, parse_rst
+
+
+def legacy_get_headings(file: str) -> Optional[List[Tuple[str, str]]]:
+    lines = file.split("\n")
+    headings = []
+    code_block = False
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if line.startswith("```"):
+            code_block = not code_block
+        elif line.startswith("#") and not code_block:
+            headings.append((line, i))
+    if len(headings) == 0:
+        return None
+
+    headings = [
+        (
+            heading[0].replace("#", "").strip(),
+            heading[1],
+            (
+                3
+                if heading[0].startswith("###")
+                else 2 if heading[0].startswith("##") else 1
+            ),
+        )
+        for heading in headings
+    ]
+
+    sections = [("", lines[: headings[0][1]])]
+    sections = sections + [
+        (
+            heading[0],
+            "\n".join(
+                lines[
+                    heading[1]
+                    + 1 : (headings[i + 1][1] if i + 1 < len(headings) else None)
+                ]
+            ),
+        )
+        for i, heading in enumerate(headings[:-1])
+    ]
+    return sections
+
+
+def legacy_get_headings_rst(file: str) -> Optional[List[Tuple[str, str]]]:
+    lines = file.split("\n")
+    headings = [
+        i
+        for i, line in enumerate(lines[1:])
+        if not line.startswith(" ")
+        and line.strip() != ""
+        and (all(l == "=" for l in line.strip()) or all(l == "-" for l in line.strip()))
+    ]
+
+    sections = []
+    if headings[0] != 0:
+        sections = [("", "\n".join(lines[: headings[0]]))]
+    sections.extend(
+        (lines[prev], "\n".join(lines[prev + 2 : curr]))
+        for prev, curr in zip(headings, headings[1:])
+    )
+    return sections
+
+
+PARAGRAPH = (
+    "Install the package with pip and run the tests with pytest, "
+    "optional dependencies are listed in the extras of setup.cfg.\n"
+)
+
+
+def markdown_doc(n_sections: int) -> str:
+    parts = ["Introduction to the project.\n\n"]
+    for i in range(n_sections):
+        parts.append(f"{'#' * (i % 3 + 1)} Section {i}\n\n")
+        parts.append(PARAGRAPH * 5)
+        parts.append("\n```bash\n# a comment, not a heading\npip install .\n```\n\n")
+    return "".join(parts)
+
+
+def rst_doc(n_sections: int) -> str:
+    parts = ["Introduction to the project.\n\n"]
+    for i in range(n_sections):
+        title = f"Section {i}"
+        parts.append(f"{title}\n{'=-'[i % 2] * len(title)}\n\n")
+        parts.append(PARAGRAPH * 5)
+        parts.append("\n.. code-block:: bash\n\n    pip install .\n\n")
+    return "".join(parts)
+
+
+def bench(name: str, func: Callable, text: str, repeat: int):
+    # the best of the repeats, as the others mostly measure other processes
+    elapsed = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(text)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    print(f"  {name:<24} {elapsed * 1000:9.3f} ms  {len(result or []):6d} sections")
+
+
+def main(args):
+    for kind, doc, functions in [
+        (
+            "markdown",
+            markdown_doc(args.sections),
+            [
+                ("legacy get_headings", legacy_get_headings),
+                ("get_headings", get_headings),
+                ("parse_markdown", parse_markdown),
+            ],
+        ),
+        (
+            "rst",
+            rst_doc(args.sections),
+            [
+                ("legacy get_headings_rst", legacy_get_headings_rst),
+                ("get_headings_rst", get_headings_rst),
+                ("parse_rst", parse_rst),
+            ],
+        ),
+    ]:
+        print(f"{kind}: {len(doc) / 1024:.0f} KiB, {args.sections} headings")
+        for name, func in functions:
+            bench(name, func, doc, args.repeat)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sections", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=20)
+    main(parser.parse_args())
@@ -5,12 +5,12 @@ import sys
 from datetime import date, datetime
 from pprint import pprint
 import traceback
-from typing import Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 from install_test.agent.agent import Agent
 from install_test.agent.repair_agent import RepairAgent
 from install_test.consts import EVAL_LOGS, REPO_SETS
-from doc_test.utils import notify
+from install_test.utils import notify
 
 sys.path.append(os.getcwd())
 
@@ -86,14 +86,20 @@ def eval_build_project(
     n_tries = 0
     try:
         print("test_repair")
+        alternatives = agent.alternatives
         agent = RepairAgent(
             agent.model, RepairAgent.init_system_message(url, dockerfile), verbose=False
         )
         build_status, n_tries = agent.repair_dockerfile(
-            url, dockerfile, repo_name, repair_attempts, ref=ref
+            url,
+            dockerfile,
+            repo_name,
+            repair_attempts,
+            ref=ref,
+            alternatives=alternatives,
         )
     except Exception as e:
-        agent.messages.append(
+        agent.add_message(
             {
                 "role": "error",
                 "content": f"{str(type(e))[8:-2]}: {str(e)}\n{traceback.format_exc()}",
@@ -106,7 +112,24 @@ def eval_build_project(
     except KeyboardInterrupt:
         build_status = "failure"
 
-    notify(f" - BUILD STATUS: {build_status.upper()} after {n_tries} repair attempt(s)")
     agent.save_messages(messages_fname, messages_dir)
-    record[repo_name]["build_status"] = build_status
-    record[repo_name]["n_tries"] = n_tries
+    record_build(agent, record[repo_name], build_status, n_tries)
+
+
+def record_build(agent: Agent, record: Dict[str, Any], build_status: str, n_tries: int):
+    notify(f" - BUILD STATUS: {build_status.upper()} after {n_tries} repair attempt(s)")
+    record["build_status"] = build_status
+    record["n_tries"] = n_tries
+    record["builds"] = getattr(agent, "builds", [])
+    record["repair_llm_cache"] = agent.cache_stats
+    record["candidate_rounds"] = getattr(agent, "rounds", [])
+    record["err_reductions"] = getattr(agent, "reductions", [])
+    record["fix_cache"] = getattr(agent, "fix_rounds", [])
+    record["fixed_by_cache"] = any(r["passed"] for r in record["fix_cache"])
+    log_chars = sum(r["log_chars"] for r in record["err_reductions"])
+    if log_chars > 0:
+        err_chars = sum(r["err_chars"] for r in record["err_reductions"])
+        notify(
+            f" - BUILD LOGS REDUCED FROM {log_chars} TO {err_chars} CHARACTERS "
+            f"({err_chars / log_chars:.1%})"
+        )
@@ -1,6 +1,7 @@
 import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Any, Dict, List, Optional
 
 from install_test.agent.gather_agent import GatherAgent
@@ -24,6 +25,7 @@ def eval_gather_build(
     run_name: str,
     model: str = DEFAULT_MODEL,
     perfect_recall: bool = False,
+    n_workers: int = 1,
 ):
     test_cases, messages_dir = eval_start(repo_sets, run_name, model)
 
@@ -39,56 +41,30 @@ def eval_gather_build(
     finished = False
     try:
         for i in range(n_eval):
-            records.append({})
+            records.append({test["url"].split("/")[-1][:-4]: {} for test in test_cases})
             record = records[-1]
-            for test in test_cases:
-                url = test["url"]
-                ref = test.get("ref", None)
-                repo_name = test["url"].split("/")[-1][:-4]
-                gather_fname = f"{model}-{repo_name}-gather-{i}.json"
-                record[repo_name] = {}
-                start_time = time.time()
-
-                agent = GatherAgent(
+            # repos are independent of each other within a round,
+            # so their pipelines can be run at the same time.
+            executor = ThreadPoolExecutor(max_workers=n_workers)
+            futures = [
+                executor.submit(
+                    eval_repo,
+                    test,
+                    record,
+                    i=i,
                     model=model,
-                    system=GatherAgent.init_system_message(url),
-                    verbose=False,
-                    count_tokens=False,
-                )
-                try:
-                    eval_gather_repo(
-                        agent,
-                        url,
-                        test["relevant_docs"],
-                        record[repo_name],
-                        repo_name,
-                        collected_docs=(
-                            test["relevant_docs"] if perfect_recall else None
-                        ),
-                    )
-                    dockerfile = agent.gen_dockerfile(url, repo_name)
-                except Exception as e:
-                    print(e)
-                    continue
-                finally:
-                    agent.save_messages(gather_fname, messages_dir)
-
-                eval_build_project(
-                    agent,
-                    dockerfile,
-                    repo_name=repo_name,
-                    record=record,
-                    url=url,
-                    repair_attempts=repair_attempts,
                     run_name=run_name,
-                    model_name=model,
-                    i=i,
-                    ref=ref,
+                    messages_dir=messages_dir,
+                    repair_attempts=repair_attempts,
+                    perfect_recall=perfect_recall,
                 )
-
-                duration = time.time() - start_time
-                notify(f" - finished in {duration} seconds")
-                record[repo_name]["duration"] = duration
+                for test in test_cases
+            ]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
 
             notify(f"EVAL ROUND {i} FIN:\n")
 
@@ -102,6 +78,64 @@ def eval_gather_build(
     return records
 
 
+def eval_repo(
+    test: Dict[str, Any],
+    record: Dict[str, Any],
+    i: int,
+    model: str,
+    run_name: str,
+    messages_dir: str,
+    repair_attempts: int,
+    perfect_recall: bool = False,
+):
+    "gather, generate and build a single test case, storing the results in record"
+    url = test["url"]
+    ref = test.get("ref", None)
+    repo_name = test["url"].split("/")[-1][:-4]
+    gather_fname = f"{model}-{repo_name}-gather-{i}.json"
+    start_time = time.time()
+
+    agent = GatherAgent(
+        model=model,
+        system=GatherAgent.init_system_message(url, ref=ref),
+        verbose=False,
+        count_tokens=False,
+    )
+    try:
+        eval_gather_repo(
+            agent,
+            url,
+            test["relevant_docs"],
+            record[repo_name],
+            repo_name,
+            collected_docs=(test["relevant_docs"] if perfect_recall else None),
+            ref=ref,
+        )
+        dockerfile = agent.gen_dockerfile(url, repo_name)
+    except Exception as e:
+        print(e)
+        return
+    finally:
+        agent.save_messages(gather_fname, messages_dir)
+
+    eval_build_project(
+        agent,
+        dockerfile,
+        repo_name=repo_name,
+        record=record,
+        url=url,
+        repair_attempts=repair_attempts,
+        run_name=run_name,
+        model_name=model,
+        i=i,
+        ref=ref,
+    )
+
+    duration = time.time() - start_time
+    notify(f" - {repo_name} finished in {duration} seconds")
+    record[repo_name]["duration"] = duration
+
+
 def eval_gather_repo(
     agent: GatherAgent,
     url: str,
@@ -119,6 +153,14 @@ def eval_gather_repo(
             agent.system = f.read().replace("<REPO_NAME>", repo_name)
         retrieved_docs = collected_docs
         contents = {}
+    record_gather(record, retrieved_docs, relevant_docs)
+    summary = agent.summarise(url, retrieved_docs, contents, ref=ref)
+    record_summary(agent, record, summary)
+
+
+def record_gather(
+    record: Dict[str, Any], retrieved_docs: List[str], relevant_docs: List[str]
+):
     notify(f" - COLLECTED DOCS: {retrieved_docs}")
     notify(f" - RELEVANT DOCS: {relevant_docs}")
     relevant_retrieved = set(retrieved_docs).intersection(set(relevant_docs))
@@ -128,6 +170,12 @@ def eval_gather_repo(
     record["recall"] = (
         len(relevant_retrieved) / len(relevant_docs) if len(relevant_docs) > 0 else 0
     )
-    summary = agent.summarise(url, retrieved_docs, contents, ref=ref)
+
+
+def record_summary(agent: GatherAgent, record: Dict[str, Any], summary: str):
     record["summary"] = summary
     record["gather_tokens"] = agent.tokens
+    record["compacted_tokens"] = agent.compacted_tokens
+    record["gather_llm_cache"] = agent.cache_stats
+    if agent.prefetcher is not None:
+        record["prefetch"] = agent.prefetcher.stats()
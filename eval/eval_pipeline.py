@@ -0,0 +1,254 @@
+"""
+Evaluation with the model and build stages of every repo overlapping.
+
+Repos wait for generation in one queue, where async agents gather, summarise
+and generate a dockerfile for up to `n_llm` of them at a time on one event loop.
+Generated dockerfiles wait for a build slot in a second, bounded queue.
+Once it is full, generation waits for builds to catch up, so the model stage
+runs at most `build_queue` dockerfiles ahead of the workers.
+Build slots build and repair dockerfiles. Builds run in threads, leasing a
+worker from the pool, while the repair conversation goes on in the event loop.
+"""
+
+import asyncio
+import json
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+from install_test.agent.gather_agent import AsyncGatherAgent, GatherAgent
+from install_test.agent.repair_agent import AsyncRepairAgent
+from install_test.consts import DEFAULT_MODEL, GATHER_SYSTEM_PERFECT_RECALL_PROMPT_PATH
+from install_test.utils import notify
+from eval.eval import eval_start, log_eval_end, record_build
+from eval.eval_gather import record_gather, record_summary
+from vm_control import VMController
+
+# marks the end of the generated dockerfiles for the build slots
+DONE = None
+
+
+async def agenerate(
+    test: Dict[str, Any],
+    record: Dict[str, Any],
+    i: int,
+    model: str,
+    messages_dir: str,
+    perfect_recall: bool = False,
+) -> Optional[List[str]]:
+    """
+    gather, summarise and generate a dockerfile for a test case,
+    returns it followed by its alternatives, or None if it failed.
+    """
+    url = test["url"]
+    ref = test.get("ref", None)
+    repo_name = url.split("/")[-1][:-4]
+    notify(f"REPO: {repo_name}")
+    agent = None
+    try:
+        # lists the repo on github, which would block the other agents
+        system = await asyncio.to_thread(GatherAgent.init_system_message, url, ref=ref)
+        agent = AsyncGatherAgent(
+            model=model,
+            system=system,
+            verbose=False,
+            count_tokens=False,
+        )
+        if perfect_recall:
+            with open(GATHER_SYSTEM_PERFECT_RECALL_PROMPT_PATH, "r") as f:
+                agent.system = f.read().replace("<REPO_NAME>", repo_name)
+            retrieved_docs, contents = test["relevant_docs"], {}
+        else:
+            retrieved_docs, contents = await agent.agather(url, ref=ref)
+        record_gather(record, retrieved_docs, test["relevant_docs"])
+        summary = await agent.asummarise(url, retrieved_docs, contents, ref=ref)
+        record_summary(agent, record, summary)
+        dockerfile = await agent.agen_dockerfile(url, repo_name)
+        return [dockerfile] + agent.alternatives
+    except Exception as e:
+        print(e)
+        return None
+    finally:
+        if agent is not None:
+            agent.save_messages(f"{model}-{repo_name}-gather-{i}.json", messages_dir)
+
+
+async def abuild(
+    test: Dict[str, Any],
+    record: Dict[str, Any],
+    dockerfiles: List[str],
+    i: int,
+    model: str,
+    messages_dir: str,
+    repair_attempts: int,
+):
+    "build and repair the generated dockerfile and alternatives of a test case"
+    dockerfile = dockerfiles[0]
+    url = test["url"]
+    repo_name = url.split("/")[-1][:-4]
+    agent = AsyncRepairAgent(
+        model, AsyncRepairAgent.init_system_message(url, dockerfile), verbose=False
+    )
+    n_tries = 0
+    try:
+        build_status, n_tries = await agent.arepair_dockerfile(
+            url,
+            dockerfile,
+            repo_name,
+            repair_attempts,
+            ref=test.get("ref", None),
+            alternatives=dockerfiles[1:],
+        )
+    except Exception as e:
+        agent.add_message(
+            {
+                "role": "error",
+                "content": f"{str(type(e))[8:-2]}: {str(e)}\n{traceback.format_exc()}",
+            }
+        )
+        print(e)
+        build_status = "failure"
+    agent.save_messages(f"{model}-{repo_name}-build-{i}.json", messages_dir)
+    record_build(agent, record, build_status, n_tries)
+
+
+async def run_round(
+    test_cases: List[Dict[str, Any]],
+    record: Dict[str, Dict[str, Any]],
+    i: int,
+    model: str,
+    messages_dir: str,
+    repair_attempts: int,
+    perfect_recall: bool,
+    n_llm: int,
+    n_build: int,
+    build_queue: int,
+) -> Dict[str, float]:
+    """
+    one round over every test case, returns the time spent generating, building,
+    and waiting for a build slot, summed over the sessions of each stage.
+    """
+    repos: asyncio.Queue = asyncio.Queue()
+    for test in test_cases:
+        repos.put_nowait(test)
+    generated: asyncio.Queue = asyncio.Queue(maxsize=build_queue)
+    busy = {"generate": 0.0, "build": 0.0, "blocked": 0.0}
+
+    async def generator():
+        while not repos.empty():
+            test = repos.get_nowait()
+            repo_name = test["url"].split("/")[-1][:-4]
+            start = time.time()
+            dockerfiles = await agenerate(
+                test, record[repo_name], i, model, messages_dir, perfect_recall
+            )
+            busy["generate"] += time.time() - start
+            record[repo_name]["generate_duration"] = time.time() - start
+            if dockerfiles is None:
+                continue
+            queued = time.time()
+            # waits here while the build slots are behind
+            await generated.put((test, dockerfiles, start, queued))
+            busy["blocked"] += time.time() - queued
+
+    async def builder():
+        while True:
+            item = await generated.get()
+            if item is DONE:
+                return
+            test, dockerfiles, started, queued = item
+            repo_name = test["url"].split("/")[-1][:-4]
+            start = time.time()
+            record[repo_name]["build_queue_wait"] = start - queued
+            try:
+                await abuild(
+                    test,
+                    record[repo_name],
+                    dockerfiles,
+                    i,
+                    model,
+                    messages_dir,
+                    repair_attempts,
+                )
+            except Exception as e:
+                # a build slot that stopped would leave the generators waiting
+                # on the full queue forever
+                print(e)
+                record[repo_name]["build_status"] = "failure"
+            busy["build"] += time.time() - start
+            record[repo_name]["build_duration"] = time.time() - start
+            duration = time.time() - started
+            notify(f" - {repo_name} finished in {duration} seconds")
+            record[repo_name]["duration"] = duration
+
+    builders = [asyncio.create_task(builder()) for _ in range(n_build)]
+    await asyncio.gather(*[generator() for _ in range(n_llm)])
+    for _ in builders:
+        await generated.put(DONE)
+    await asyncio.gather(*builders)
+    return busy
+
+
+def eval_pipeline(
+    repo_sets: List[str],
+    n_eval: int,
+    repair_attempts: int,
+    run_name: str,
+    model: str = DEFAULT_MODEL,
+    perfect_recall: bool = False,
+    n_llm: int = 4,
+    n_build: Optional[int] = None,
+    build_queue: int = 2,
+):
+    """
+    evaluate like `eval_gather_build`, with generation and builds overlapping.
+    By default there are two build slots per worker, so that a worker can build
+    one repo while the model diagnoses the failed build of another.
+    """
+    test_cases, messages_dir = eval_start(repo_sets, run_name, model)
+    if perfect_recall:
+        test_cases = [
+            test
+            for test in test_cases
+            if "relevant_docs" in test and len(test["relevant_docs"]) > 0
+        ]
+        print(f"EVALUATING SUBSET OF TEST CASES WITH LENGTH {len(test_cases)}")
+    if n_build is None:
+        n_build = 2 * len(VMController.pool.workers)
+
+    records = []
+    finished = False
+    try:
+        for i in range(n_eval):
+            records.append({test["url"].split("/")[-1][:-4]: {} for test in test_cases})
+            start = time.time()
+            busy = asyncio.run(
+                run_round(
+                    test_cases,
+                    records[-1],
+                    i,
+                    model,
+                    messages_dir,
+                    repair_attempts,
+                    perfect_recall,
+                    n_llm,
+                    n_build,
+                    build_queue,
+                )
+            )
+            wall = time.time() - start
+            notify(
+                f"EVAL ROUND {i} FIN in {wall:.0f}s, summed over sessions: "
+                f"generating {busy['generate']:.0f}s, "
+                f"building {busy['build']:.0f}s, "
+                f"waiting for a build slot {busy['blocked']:.0f}s\n"
+            )
+
+            with open(f"logs/eval/{run_name}_{model}.json", "w") as f:
+                json.dump(records, f)
+        finished = True
+    finally:
+        with open(f"logs/eval/{run_name}_{model}.json", "w") as f:
+            json.dump(records, f)
+        log_eval_end(finished)
+    return records
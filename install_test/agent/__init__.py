@@ -1,3 +1,4 @@
 from install_test.agent.agent import Agent
-from install_test.agent.gather_agent import GatherAgent
-from install_test.agent.repair_agent import RepairAgent
+from install_test.agent.async_agent import AsyncAgent
+from install_test.agent.gather_agent import AsyncGatherAgent, GatherAgent
+from install_test.agent.repair_agent import AsyncRepairAgent, RepairAgent
@@ -1,11 +1,12 @@
 import json
 import os
-from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from openai import OpenAI
 from tiktoken import encoding_for_model
-from tqdm import tqdm
 
+from install_test.agent.compaction import compact_messages
 from install_test.agent.functions import (
     build_default_response,
     check_presence,
@@ -13,10 +14,19 @@ from install_test.agent.functions import (
     get_file_contents,
     inspect_header,
 )
-from install_test.agent.functions_json import FUNC_DOCKERFILE
+from install_test.agent.functions_json import (
+    FUNC_DIR_NAME,
+    FUNC_DOCKERFILE,
+    FUNC_FILE_NAME,
+    FUNC_PRESENCE_NAME,
+)
+from install_test.agent.llm_cache import CacheMissError, LLMCache, completion_message
+from install_test.agent.tokens import TokenLedger
 from install_test.consts import (
+    DOCKERFILE_CANDIDATES,
     DOCKERFILE_PROMPT_PATH,
     PER_MESSAGE_TOKEN_LIMIT,
+    TOOL_WORKERS,
 )
 from install_test.utils import (
     ClassificationError,
@@ -27,8 +37,23 @@ from install_test.utils import (
     wrap_message,
 )
 
+# tools that only read the repository, so can run at the same time
+PARALLEL_TOOLS = [FUNC_FILE_NAME, FUNC_DIR_NAME, FUNC_PRESENCE_NAME]
+NOT_RUN_RESPONSE = "this tool call was not run, call the tool again if you need it."
+
 
 class Agent:
+    # if set, old tool outputs are left out of requests larger than this many tokens
+    context_budget: Optional[int] = None
+    # if set, responses are recorded to and replayed from this cache
+    response_cache: Optional[LLMCache] = None
+    # openai compatible endpoint to send requests to instead of the openai api
+    base_url: Optional[str] = None
+    # if set, called with `asynchronous` to create the clients used for requests
+    backend: Optional[Callable[..., Any]] = None
+    # dockerfiles requested from the model for each generation or repair
+    n_candidates: int = DOCKERFILE_CANDIDATES
+
     def __init__(
         self,
         model: str,
@@ -39,23 +64,31 @@ class Agent:
         prev_messages: Optional[List[Dict[str, Any]]] = None,
     ) -> None:
         self.calls = 0
-        if count_tokens:
-            self._counted_messages = 0
-            self._in_tokens = 0
-            self._out_tokens = 0
-            self._running_tokens = 0
-            self.encoder = encoding_for_model(model)
-        else:
-            self._counted_messages = -1
-            self.encoder = None
+        self.ledger = TokenLedger(encoding_for_model(model)) if count_tokens else None
+        # the step of the task the agent is working on, token usage is grouped by it
+        self.phase = "default"
+        # tokens left out of requests by compaction over all calls
+        self.compacted_tokens = 0
+        # tool calls of the last turn after the first, answered by the tool loop
+        self.pending_calls: List[Dict[str, Any]] = []
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # dockerfiles generated along with the last one, when several were requested
+        self.alternatives: List[str] = []
         self.messages = []
         self.verbose = verbose
         key = os.getenv("OPENAI_API_KEY")
         self.system = system
-        self.client = OpenAI(api_key=key)
+        if self.backend is not None:
+            self.client = self.backend(asynchronous=False)
+        else:
+            self.client = OpenAI(api_key=key, base_url=self.base_url)
         self.model = model
         self.targets = {}
         self.messages = messages or [{"role": "system", "content": self.system}]
+        if self.ledger is not None:
+            for message in self.messages:
+                self.ledger.add(message)
         self.prev_messages = (
             [msg for msg in prev_messages if msg["role"] == "assistant"]
             if prev_messages is not None
@@ -66,15 +99,56 @@ class Agent:
         if self.verbose:
             print(message)
 
+    def add_message(self, message: Dict[str, Any]):
+        if message["role"] != "tool" and len(self.pending_calls) > 0:
+            self.dismiss_pending()
+        self.messages.append(message)
+        if self.ledger is not None:
+            self.ledger.add(message)
+
     def write_conversation(self, log_file: str = "logs/agent_log.txt"):
         conversation = "\n\n".join([wrap_message(message) for message in self.messages])
         with open(log_file, "w") as f:
             f.write(conversation)
 
     def query(self, message, tools: Optional[List[Dict[str, Any]]] = None, **kwargs):
+        response = self.start_query(message, tools)
+        usage, saved = None, 0
+        if response is None:
+            request, saved = self.request(tools, **kwargs)
+            response, usage = self.cached(request)
+            if response is None:
+                completion = self.client.chat.completions.create(**request)
+                response, usage = self.record(request, completion)
+        return self.finish_query(response, tools, usage, saved)
+
+    def cached(self, request: Dict[str, Any]) -> Tuple[Optional[Any], Optional[Any]]:
+        "the (message, usage) recorded for the request, or Nones if it must be sent"
+        if self.response_cache is None:
+            return None, None
+        try:
+            cached = self.response_cache.lookup(request)
+        except CacheMissError as e:
+            self.cache_misses += 1
+            raise e
+        if cached is None:
+            self.cache_misses += 1
+            return None, None
+        self.cache_hits += 1
+        return cached
+
+    def record(self, request: Dict[str, Any], completion: Any) -> Tuple[Any, Any]:
+        if self.response_cache is None:
+            return completion_message(request, completion), completion.usage
+        return self.response_cache.store(request, completion)
+
+    def start_query(
+        self, message, tools: Optional[List[Dict[str, Any]]] = None
+    ) -> Optional[Any]:
+        "add the message to the conversation, returns the replayed response if any"
         print_output(message, ">", self.verbose)
 
-        self.messages.append(
+        self.add_message(
             {
                 "role": "user",
                 "content": message,
@@ -87,49 +161,56 @@ class Agent:
         if len(self.prev_messages) > 0:
             resp = {"tool_calls": []}
             resp.update(self.prev_messages.pop(0))
-            response = objectify(resp)
-        else:
-            response = (
-                self.client.chat.completions.create(
-                    model=self.model,
-                    messages=self.messages,
-                    tools=tools,
-                    tool_choice="auto" if tools is not None else None,
-                    **kwargs,
-                )
-                .choices[0]
-                .message
-            )
+            return objectify(resp)
+        return None
+
+    def request(
+        self, tools: Optional[List[Dict[str, Any]]] = None, **kwargs
+    ) -> Tuple[Dict[str, Any], int]:
+        "arguments of the completion request, and the tokens left out by compaction"
+        messages, saved = self.compacted_messages()
+        request = {
+            "model": self.model,
+            "messages": messages,
+            "tools": tools,
+            "tool_choice": "auto" if tools is not None else None,
+            **kwargs,
+        }
+        return request, saved
+
+    def finish_query(
+        self,
+        response: Any,
+        tools: Optional[List[Dict[str, Any]]] = None,
+        usage: Optional[Any] = None,
+        saved: int = 0,
+    ):
+        "add the response of the model to the conversation"
+        if self.ledger is not None:
+            self.ledger.record_call(self.phase, usage, saved)
 
         if tools is None:
             response = response.content
-            self.messages.append({"role": "assistant", "content": response})
+            self.add_message({"role": "assistant", "content": response})
 
         elif response.tool_calls is None or len(response.tool_calls) == 0:
             try:
                 response = response.content
                 if response is not None:
-                    self.messages.append({"role": "assistant", "content": response})
+                    self.add_message({"role": "assistant", "content": response})
             except:
                 pass
             raise NoToolUsedError("No tools were used")
         else:
-            function_name = response.tool_calls[0].function.name
-            function_args = response.tool_calls[0].function.arguments
-            response = {
-                "id": response.tool_calls[0].id,
-                "type": "function",
-                "function": {
-                    "name": function_name,
-                    "arguments": function_args,
-                },
-            }
-            self.messages.append(
+            calls = self.tool_calls(response)
+            self.add_message(
                 {
                     "role": "assistant",
-                    "tool_calls": [response],
+                    "tool_calls": calls,
                 }
             )
+            response = calls[0]
+            self.pending_calls = calls[1:]
 
         print_output(str(response), "<", self.verbose)
 
@@ -137,58 +218,104 @@ class Agent:
 
         return response
 
+    @staticmethod
+    def tool_calls(response: Any) -> List[Dict[str, Any]]:
+        return [
+            {
+                "id": call.id,
+                "type": "function",
+                "function": {
+                    "name": call.function.name,
+                    "arguments": call.function.arguments,
+                },
+            }
+            for call in response.tool_calls
+        ]
+
+    def query_candidates(
+        self, message, tools: List[Dict[str, Any]], n: int
+    ) -> List[Dict[str, Any]]:
+        """
+        n alternative tool calls answering the message, sampled in one request.
+        None of them is added to the conversation until it is accepted.
+        """
+        response = self.start_query(message, tools)
+        if response is not None:
+            return self.finish_candidates([response])
+        request, saved = self.request(tools, n=n)
+        responses, usage = self.cached(request)
+        if responses is None:
+            completion = self.client.chat.completions.create(**request)
+            responses, usage = self.record(request, completion)
+        return self.finish_candidates(responses, usage, saved)
+
+    def finish_candidates(
+        self, responses: List[Any], usage: Optional[Any] = None, saved: int = 0
+    ) -> List[Dict[str, Any]]:
+        if self.ledger is not None:
+            self.ledger.record_call(self.phase, usage, saved)
+        self.calls += 1
+        # the first call of every response that used a tool
+        candidates = [
+            self.tool_calls(response)[0]
+            for response in responses
+            if response.tool_calls
+        ]
+        if len(candidates) == 0:
+            raise NoToolUsedError("No tools were used")
+        print_output(f"{len(candidates)} candidates", "<", self.verbose)
+        return candidates
+
+    def accept_candidate(self, candidate: Dict[str, Any]):
+        "add a tool call returned by query_candidates to the conversation"
+        self.add_message({"role": "assistant", "tool_calls": [candidate]})
+        print_output(str(candidate), "<", self.verbose)
+
+    @staticmethod
+    def candidate_dockerfiles(candidates: List[Dict[str, Any]]) -> List[str]:
+        return [
+            str(json.loads(candidate["function"]["arguments"])["dockerfile"])
+            for candidate in candidates
+        ]
+
+    def compacted_messages(self) -> Tuple[List[Dict[str, Any]], int]:
+        "the messages to send to the model, with old tool outputs removed if needed"
+        if self.context_budget is None:
+            return self.messages, 0
+        messages, saved = compact_messages(
+            self.messages,
+            self.context_budget,
+            sizes=self.ledger.sizes if self.ledger is not None else None,
+        )
+        self.compacted_tokens += saved
+        return messages, saved
+
+    @property
+    def cache_stats(self) -> Dict[str, int]:
+        "responses of this agent taken from, or missing from, the response cache"
+        return {"hits": self.cache_hits, "misses": self.cache_misses}
+
     @property
     def in_tokens(self) -> Optional[int]:
-        if self._counted_messages == -1:
-            return None
-        if self._counted_messages != len(self.messages):
-            self.update_tokens()
-        return self._in_tokens
+        "tokens sent to the model over all calls"
+        return self.ledger.in_tokens if self.ledger is not None else None
 
     @property
     def out_tokens(self) -> Optional[int]:
-        if self._counted_messages == -1:
-            return None
-        if self._counted_messages != len(self.messages):
-            self.update_tokens()
-        return self._out_tokens
+        "tokens generated by the model over all calls"
+        return self.ledger.out_tokens if self.ledger is not None else None
 
     @property
     def tokens(self) -> Optional[int]:
-        if self._counted_messages == -1:
+        "tokens in the conversation so far"
+        return self.ledger.running if self.ledger is not None else None
+
+    @property
+    def phase_tokens(self) -> Optional[Dict[str, Dict[str, int]]]:
+        "input/output tokens and number of calls for each phase of the task"
+        if self.ledger is None:
             return None
-        if self._counted_messages != len(self.messages):
-            self.update_tokens()
-        return self._running_tokens
-
-    def update_tokens(self):
-        if self._counted_messages == -1:
-            return
-        print("calculating token usage...")
-        for message in tqdm(self.messages[self._counted_messages :]):
-            # INPUTS : CUMULATIVE
-            # BUT NOT ALL INPUTS (confirm function, etc.)
-            # ADD 'sent' key to sent messages, see if it breaks anything
-            # OUTPUTS (assistant): INDEPENDANT
-            message_tokens = len(self.encoder.encode(message["role"]))
-            if "content" in message:
-                message_tokens += len(self.encoder.encode((message["content"])))
-            if message["role"] == ["assistant"] and "tool_calls" in message:
-                # I DONT KNOW HOW EXACTLY THE TOOLS ARE COUNTED. GOOD ENOUGH??!?!
-                message_tokens += len(
-                    self.encoder.encode(json.dumps(message["tool_calls"]["function"]))
-                )
-            if "tools" in message:
-                # SAME AS ABOVE
-                message_tokens += len(self.encoder.encode(json.dumps(message["tools"])))
-            self._running_tokens += message_tokens
-
-            if message["role"] == "user" and "sent" in message:
-                self._in_tokens += self._running_tokens
-            if message["role"] == "assistant":
-                self._out_tokens += message_tokens
-            self._counted_messages += 1
-        assert self._counted_messages == len(self.messages)
+        return {phase: dict(counts) for phase, counts in self.ledger.phases.items()}
 
     def query_and_classify(
         self, message, tools, **kwargs
@@ -203,23 +330,24 @@ class Agent:
                     command,
                     tool_names,
                 )
-            except Exception as e:
-                if isinstance(e, ClassificationError):
-                    err_msg = (
-                        f"tool {command} is not available. "
-                        f"You must choose from the following tools: {', '.join(tool_names)}"
-                    )
-                else:
-                    raise e
-                function_response = {
-                    "tool_call_id": response["id"],
-                    "role": "tool",
-                    "name": response["function"]["name"],
-                    "content": err_msg,
-                }
-                self.messages.append(function_response)
+            except ClassificationError:
+                self.reject_tool(response, tool_names)
         return response, response_class
 
+    def dismiss_pending(self):
+        "answer the tool calls that were not run, as every call needs a response"
+        calls, self.pending_calls = self.pending_calls, []
+        for call in calls:
+            self.add_tool_response(call, NOT_RUN_RESPONSE)
+
+    def reject_tool(self, response: Dict[str, Any], tool_names: List[str]):
+        "tell the model the tool it called does not exist"
+        err_msg = (
+            f"tool {response['function']['name']} is not available. "
+            f"You must choose from the following tools: {', '.join(tool_names)}"
+        )
+        self.add_tool_response(response, err_msg)
+
     def query_then_tool(self, prompt, tools):
         if prompt is not None:
             response = self.query(prompt, None)
@@ -230,14 +358,21 @@ class Agent:
         except NoToolUsedError:
             tool_response, response_class = None, None
         if response_class is None:
-            last_line = list(response.split("\n"))[-1]
-            for tool in tools:
-                if tool["function"]["name"] in last_line:
-                    response_class = tool["function"]["name"]
-                    tool_response = build_default_response(response_class)
-                    break
+            tool_response, response_class = self.planned_tool(response, tools)
         return tool_response, response_class
 
+    @staticmethod
+    def planned_tool(
+        response: str, tools: List[Dict[str, Any]]
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        "the tool named at the end of a plain response, called with default arguments"
+        last_line = list(response.split("\n"))[-1]
+        for tool in tools:
+            if tool["function"]["name"] in last_line:
+                response_class = tool["function"]["name"]
+                return build_default_response(response_class), response_class
+        return None, None
+
     def tool_loop(
         self,
         response: Dict[str, Any],
@@ -254,9 +389,11 @@ class Agent:
     ):
         while response_class != exit_func:
             if response_class is not None:
-                function_response = self.use_tool(
-                    response=response,
-                    response_class=response_class,
+                calls, exit_call = self.turn_calls(
+                    response, response_class, exit_func, tools
+                )
+                function_responses = self.run_tools(
+                    calls,
                     directories=directories,
                     files=files,
                     file_contents=file_contents,
@@ -265,22 +402,80 @@ class Agent:
                     ref=ref,
                     **kwargs,
                 )
-
-                print_output(function_response, "^", self.verbose)
-
-                function_response = {
-                    "tool_call_id": response["id"],
-                    "role": "tool",
-                    "name": response["function"]["name"],
-                    "content": function_response,
-                }
-                self.messages.append(function_response)
+                for (call, _), function_response in zip(calls, function_responses):
+                    print_output(function_response, "^", self.verbose)
+                    self.add_tool_response(call, function_response)
+                if exit_call is not None:
+                    response, response_class = exit_call
+                    continue
                 message = followup
             else:
                 message = None
             response, response_class = self.query_then_tool(message, tools)
         return response
 
+    def turn_calls(
+        self,
+        response: Dict[str, Any],
+        response_class: str,
+        exit_func: str,
+        tools: List[Dict[str, Any]],
+    ) -> Tuple[List[Tuple[Dict[str, Any], str]], Optional[Tuple[Dict[str, Any], str]]]:
+        """
+        the (call, tool) pairs to run for the last turn of the model,
+        and the call of the exit function if it was one of them.
+        """
+        tool_names = [tool["function"]["name"] for tool in tools]
+        calls = [(response, response_class)]
+        pending, self.pending_calls = self.pending_calls, []
+        for call in pending:
+            try:
+                calls.append(
+                    (call, classify_output(call["function"]["name"], tool_names))
+                )
+            except ClassificationError:
+                self.reject_tool(call, tool_names)
+        exit_call = next((call for call in calls if call[1] == exit_func), None)
+        return [call for call in calls if call[1] != exit_func], exit_call
+
+    def run_tools(self, calls: List[Tuple[Dict[str, Any], str]], **kwargs) -> List[str]:
+        """
+        responses to the tool calls of a turn, in order.
+        Calls that only read the repository run first and at the same time,
+        the others run after them one by one as they may depend on their results.
+        """
+        parallel = [i for i, call in enumerate(calls) if call[1] in PARALLEL_TOOLS]
+        function_responses = [None] * len(calls)
+        if len(parallel) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(parallel), TOOL_WORKERS)) as ex:
+                futures = {
+                    i: ex.submit(
+                        self.use_tool,
+                        response=calls[i][0],
+                        response_class=calls[i][1],
+                        **kwargs,
+                    )
+                    for i in parallel
+                }
+            for i, future in futures.items():
+                function_responses[i] = future.result()
+        for i, (call, call_class) in enumerate(calls):
+            if function_responses[i] is None:
+                function_responses[i] = self.use_tool(
+                    response=call, response_class=call_class, **kwargs
+                )
+        return function_responses
+
+    def add_tool_response(self, response: Dict[str, Any], content: str):
+        self.add_message(
+            {
+                "tool_call_id": response["id"],
+                "role": "tool",
+                "name": response["function"]["name"],
+                "content": content,
+            }
+        )
+
     def use_tool(
         self,
         response: str,
@@ -315,7 +510,12 @@ class Agent:
                     )
                 case "inspect_header":
                     function_response = inspect_header(
-                        response, files, file_contents, self.targets
+                        response,
+                        files,
+                        file_contents,
+                        self.targets,
+                        api_url=api_url,
+                        ref=ref,
                     )
         except KeyError as e:
             function_response = (
@@ -337,11 +537,32 @@ class Agent:
         )
 
     def gen_dockerfile(self, url: str, repo_name: Optional[str] = None) -> str:
+        if self.n_candidates > 1:
+            candidates = self.query_candidates(
+                self.dockerfile_prompt(url), [FUNC_DOCKERFILE], self.n_candidates
+            )
+            return self.submit_candidates(candidates, repo_name)
+        response = self.query(
+            message=self.dockerfile_prompt(url), tools=[FUNC_DOCKERFILE]
+        )
+        return self.submit_dockerfile(response, repo_name)
 
+    def submit_candidates(
+        self, candidates: List[Dict[str, Any]], repo_name: Optional[str] = None
+    ) -> str:
+        "continue with the first candidate dockerfile, keeping the others as alternatives"
+        self.accept_candidate(candidates[0])
+        self.alternatives = self.candidate_dockerfiles(candidates[1:])
+        return self.submit_dockerfile(candidates[0], repo_name)
+
+    def dockerfile_prompt(self, url: str) -> str:
+        self.phase = "generate"
         with open(DOCKERFILE_PROMPT_PATH, "r") as f:
-            prompt = f.read().replace("<REPO_URL>", url)
+            return f.read().replace("<REPO_URL>", url)
 
-        response = self.query(message=prompt, tools=[FUNC_DOCKERFILE])
+    def submit_dockerfile(
+        self, response: Dict[str, Any], repo_name: Optional[str] = None
+    ) -> str:
         dockerfile = str(json.loads(response["function"]["arguments"])["dockerfile"])
 
         if repo_name is not None:
@@ -353,13 +574,7 @@ class Agent:
         return dockerfile
 
     def confirm_tool(self, response):
-        function_response = {
-            "tool_call_id": response["id"],
-            "role": "tool",
-            "name": response["function"]["name"],
-            "content": "ok.",
-        }
-        self.messages.append(function_response)
+        self.add_tool_response(response, "ok.")
 
     def save_messages(self, fname: str, dir: Optional[str] = None):
         if dir is not None:
@@ -0,0 +1,230 @@
+import asyncio
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
+
+from install_test.agent.agent import PARALLEL_TOOLS, Agent
+from install_test.agent.functions_json import FUNC_DOCKERFILE
+from install_test.consts import (
+    LLM_BACKOFF,
+    LLM_CONCURRENCY,
+    LLM_MAX_BACKOFF,
+    LLM_MAX_RETRIES,
+)
+from install_test.utils import (
+    ClassificationError,
+    NoToolUsedError,
+    classify_output,
+    print_output,
+)
+
+# errors after which the same request can be sent again
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    "seconds to wait before retrying, as requested by the server"
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    for header in ("retry-after-ms", "retry-after"):
+        value = response.headers.get(header)
+        if value is None:
+            continue
+        try:
+            seconds = float(value)
+        except ValueError:
+            continue
+        return seconds / 1000 if header == "retry-after-ms" else seconds
+    return None
+
+
+class AsyncAgent(Agent):
+    """
+    Agent whose requests to the model are made with an asyncio client,
+    so that many conversations can wait on the model from a single event loop.
+    All agents share a limit on the number of requests in flight, and back off
+    together when the api reports that the rate limit was hit.
+    """
+
+    concurrency: int = LLM_CONCURRENCY
+    max_retries: int = LLM_MAX_RETRIES
+    _semaphore: Optional[asyncio.Semaphore] = None
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    # no request is sent before this time, set when the rate limit is hit
+    _paused_until: float = 0.0
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # retries are handled here so that they can be coordinated between agents
+        if self.backend is not None:
+            self.aclient = self.backend(asynchronous=True)
+        else:
+            self.aclient = AsyncOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                base_url=self.base_url,
+                max_retries=0,
+            )
+        self.retries = 0
+
+    @staticmethod
+    def semaphore() -> asyncio.Semaphore:
+        "limit on requests in flight, shared by all agents on the running loop"
+        loop = asyncio.get_running_loop()
+        if AsyncAgent._semaphore is None or AsyncAgent._loop is not loop:
+            AsyncAgent._semaphore = asyncio.Semaphore(AsyncAgent.concurrency)
+            AsyncAgent._loop = loop
+        return AsyncAgent._semaphore
+
+    @staticmethod
+    def set_concurrency(concurrency: int):
+        AsyncAgent.concurrency = concurrency
+        AsyncAgent._semaphore = None
+
+    async def create(self, request: Dict[str, Any]):
+        "send a completion request, retrying with backoff on transient errors"
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore():
+                    # checked after acquiring, as the pause may start while waiting
+                    delay = AsyncAgent._paused_until - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    return await self.aclient.chat.completions.create(**request)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise e
+                delay = retry_after(e)
+                if delay is None:
+                    delay = min(LLM_BACKOFF * 2**attempt, LLM_MAX_BACKOFF)
+                    delay *= random.uniform(0.5, 1.5)
+                self.retries += 1
+                self.log(f"{type(e).__name__}, retrying in {delay:.1f}s")
+                if isinstance(e, RateLimitError):
+                    AsyncAgent._paused_until = max(
+                        AsyncAgent._paused_until, time.monotonic() + delay
+                    )
+                else:
+                    await asyncio.sleep(delay)
+
+    async def aquery(
+        self, message, tools: Optional[List[Dict[str, Any]]] = None, **kwargs
+    ):
+        response = self.start_query(message, tools)
+        usage, saved = None, 0
+        if response is None:
+            request, saved = self.request(tools, **kwargs)
+            response, usage = self.cached(request)
+            if response is None:
+                completion = await self.create(request)
+                response, usage = self.record(request, completion)
+        return self.finish_query(response, tools, usage, saved)
+
+    async def aquery_candidates(
+        self, message, tools: List[Dict[str, Any]], n: int
+    ) -> List[Dict[str, Any]]:
+        response = self.start_query(message, tools)
+        if response is not None:
+            return self.finish_candidates([response])
+        request, saved = self.request(tools, n=n)
+        responses, usage = self.cached(request)
+        if responses is None:
+            completion = await self.create(request)
+            responses, usage = self.record(request, completion)
+        return self.finish_candidates(responses, usage, saved)
+
+    async def aquery_and_classify(
+        self, message, tools, **kwargs
+    ) -> Tuple[Optional[Dict[str, Any]], str]:
+        tool_names = [tool["function"]["name"] for tool in tools]
+        response_class = None
+        while response_class is None:
+            try:
+                response = await self.aquery(message, tools, **kwargs)
+                response_class = classify_output(
+                    response["function"]["name"],
+                    tool_names,
+                )
+            except ClassificationError:
+                self.reject_tool(response, tool_names)
+        return response, response_class
+
+    async def aquery_then_tool(self, prompt, tools):
+        if prompt is not None:
+            response = await self.aquery(prompt, None)
+        try:
+            tool_response, response_class = await self.aquery_and_classify(
+                "Now, use the tool that you planned to use.", tools
+            )
+        except NoToolUsedError:
+            tool_response, response_class = None, None
+        if response_class is None:
+            tool_response, response_class = self.planned_tool(response, tools)
+        return tool_response, response_class
+
+    async def atool_loop(
+        self,
+        response: Dict[str, Any],
+        response_class: str,
+        exit_func: str,
+        followup: str,
+        tools: List[Dict[str, Any]],
+        **kwargs,
+    ):
+        while response_class != exit_func:
+            if response_class is not None:
+                calls, exit_call = self.turn_calls(
+                    response, response_class, exit_func, tools
+                )
+                function_responses = await self.arun_tools(calls, tools=tools, **kwargs)
+                for (call, _), function_response in zip(calls, function_responses):
+                    print_output(function_response, "^", self.verbose)
+                    self.add_tool_response(call, function_response)
+                if exit_call is not None:
+                    response, response_class = exit_call
+                    continue
+                message = followup
+            else:
+                message = None
+            response, response_class = await self.aquery_then_tool(message, tools)
+        return response
+
+    async def arun_tools(
+        self, calls: List[Tuple[Dict[str, Any], str]], **kwargs
+    ) -> List[str]:
+        "like `run_tools`, with the tools run in threads off the event loop"
+        parallel = [i for i, call in enumerate(calls) if call[1] in PARALLEL_TOOLS]
+        function_responses = [None] * len(calls)
+        results = await asyncio.gather(
+            *[
+                asyncio.to_thread(
+                    self.use_tool,
+                    response=calls[i][0],
+                    response_class=calls[i][1],
+                    **kwargs,
+                )
+                for i in parallel
+            ]
+        )
+        for i, function_response in zip(parallel, results):
+            function_responses[i] = function_response
+        for i, (call, call_class) in enumerate(calls):
+            if function_responses[i] is None:
+                function_responses[i] = await asyncio.to_thread(
+                    self.use_tool, response=call, response_class=call_class, **kwargs
+                )
+        return function_responses
+
+    async def agen_dockerfile(self, url: str, repo_name: Optional[str] = None) -> str:
+        if self.n_candidates > 1:
+            candidates = await self.aquery_candidates(
+                self.dockerfile_prompt(url), [FUNC_DOCKERFILE], self.n_candidates
+            )
+            return self.submit_candidates(candidates, repo_name)
+        response = await self.aquery(
+            message=self.dockerfile_prompt(url), tools=[FUNC_DOCKERFILE]
+        )
+        return self.submit_dockerfile(response, repo_name)
@@ -0,0 +1,63 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+from install_test.consts import KEEP_LAST_TOOL_OUTPUTS
+
+STUB = (
+    "[the output of {name}({arguments}) was removed to save space, "
+    "call the tool again if you need it]"
+)
+
+
+def estimate_tokens(message: Dict[str, Any]) -> int:
+    "rough token count for when no encoder is available"
+    content = message.get("content")
+    return len(content) // 4 if isinstance(content, str) else 0
+
+
+def compact_messages(
+    messages: List[Dict[str, Any]],
+    budget: int,
+    sizes: Optional[List[int]] = None,
+    keep_last: int = KEEP_LAST_TOOL_OUTPUTS,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    returns a copy of messages in which the oldest tool outputs are replaced by
+    short stubs until the conversation fits within budget tokens,
+    along with the number of tokens that were removed.
+    Only the content of tool messages is changed, so every tool call keeps its
+    response, and the last `keep_last` tool outputs are never removed.
+    """
+    if sizes is None or len(sizes) != len(messages):
+        sizes = [estimate_tokens(message) for message in messages]
+    total = sum(sizes)
+    if total <= budget:
+        return messages, 0
+
+    calls = {
+        call["id"]: call["function"]
+        for message in messages
+        if message["role"] == "assistant"
+        for call in message.get("tool_calls") or []
+    }
+    tool_indices = [
+        i for i, message in enumerate(messages) if message["role"] == "tool"
+    ]
+    candidates = tool_indices[:-keep_last] if keep_last > 0 else tool_indices
+
+    compacted = list(messages)
+    saved = 0
+    for i in candidates:
+        if total - saved <= budget:
+            break
+        message = messages[i]
+        function = calls.get(message.get("tool_call_id"), {})
+        stub = STUB.format(
+            name=message.get("name", function.get("name", "tool")),
+            arguments=function.get("arguments", ""),
+        )
+        stub_size = estimate_tokens({"content": stub})
+        if sizes[i] <= stub_size:
+            continue
+        compacted[i] = {**message, "content": stub}
+        saved += sizes[i] - stub_size
+    return compacted, saved
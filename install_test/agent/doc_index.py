@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from install_test.agent.github_cache import is_pinned
+from install_test.agent.sections import parse_sections
+from install_test.consts import DOC_INDEX_DIR, GITHUB_CACHE_TTL
+
+
+def index_sections(path: str, text: str) -> List[Dict[str, Any]]:
+    """
+    sections of a markdown or rst document, in order, with the level,
+    character offset and size of their content, and the index of their parent.
+    """
+    return [
+        section.to_json() for section in parse_sections(text, rst=path.endswith(".rst"))
+    ]
+
+
+class Document(Mapping):
+    """
+    A parsed file of a repository, mapping its section titles to their contents.
+    Contents are sliced from the text when they are looked up.
+    """
+
+    def __init__(self, path: str, text: str, sections: List[Dict[str, Any]]):
+        self.path = path
+        self.text = text
+        self.sections = sections
+        # later sections with the same title take precedence
+        self._titles = {section["title"]: section for section in sections}
+
+    def __getitem__(self, title: str) -> str:
+        section = self._titles[title]
+        return self.text[section["offset"] : section["offset"] + section["size"]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._titles)
+
+    def __len__(self) -> int:
+        return len(self._titles)
+
+    @property
+    def headings(self) -> List[str]:
+        return [section["title"] for section in self.sections]
+
+    def tree(self) -> List[Dict[str, Any]]:
+        "sections nested under their parent heading"
+        nodes = [
+            {"title": s["title"], "level": s["level"], "children": []}
+            for s in self.sections
+        ]
+        roots = []
+        for node, section in zip(nodes, self.sections):
+            if section["parent"] is None:
+                roots.append(node)
+            else:
+                nodes[section["parent"]]["children"].append(node)
+        return roots
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"text": self.text, "sections": self.sections}
+
+
+class DocIndex:
+    """
+    The parsed documents of a repository at a given ref, shared by every agent
+    working on it and kept on disk, so that each file is parsed only once.
+    Documents are appended to the file on disk as they are parsed, one per line.
+    Indexes of refs that are not commit hashes expire like github responses.
+    """
+
+    root = DOC_INDEX_DIR
+
+    def __init__(self, api_url: str, ref: Optional[str] = None):
+        owner, repo = api_url.split("/")[-3:-1]
+        self.ref = ref
+        self.path = os.path.join(self.root, f"{owner}__{repo}@{ref or 'HEAD'}.jsonl")
+        self.lock = threading.Lock()
+        self.documents: Dict[str, Document] = {}
+        self.created = time.time()
+        # set while the file on disk is missing or expired, and must be rewritten
+        self.stale = True
+        # set if the last line on disk was cut short, and must be ended first
+        self.torn = False
+        self.load()
+
+    def expired(self) -> bool:
+        return not is_pinned(self.ref) and time.time() - self.created > GITHUB_CACHE_TTL
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                text = f.read()
+            lines = text.splitlines()
+            created = json.loads(lines[0])["created"]
+        except (OSError, ValueError, IndexError, KeyError):
+            return
+        if not is_pinned(self.ref) and time.time() - created > GITHUB_CACHE_TTL:
+            return
+        self.created = created
+        self.stale = False
+        self.torn = not text.endswith("\n")
+        for line in lines[1:]:
+            try:
+                doc = json.loads(line)
+            except ValueError:
+                # cut short by a process that stopped while writing it
+                continue
+            self.documents[doc["path"]] = Document(
+                doc["path"], doc["text"], doc["sections"]
+            )
+
+    def save(self, document: Document):
+        "append a document to the file on disk, starting a new file if it is stale"
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lines = [json.dumps({"path": document.path, **document.to_json()})]
+        if self.stale:
+            lines.insert(0, json.dumps({"created": self.created}))
+        # written at once, so that lines appended by other processes do not mix
+        with open(self.path, "w" if self.stale else "a") as f:
+            f.write(("\n" if self.torn else "") + "\n".join(lines) + "\n")
+        self.stale = False
+        self.torn = False
+
+    def get(self, path: str) -> Optional[Document]:
+        return self.documents.get(path)
+
+    def document(
+        self, path: str, fetch: Callable[[], Optional[str]], parse: bool = True
+    ) -> Optional[Document]:
+        """
+        the indexed document at path, fetched with `fetch()` and parsed
+        the first time it is requested, or None if it does not exist.
+        """
+        if path in self.documents:
+            return self.documents[path]
+        text = fetch()
+        if text is None:
+            return None
+        document = Document(path, text, index_sections(path, text) if parse else [])
+        with self.lock:
+            if path not in self.documents:
+                self.documents[path] = document
+                self.save(document)
+        return self.documents[path]
+
+
+_INDEXES: Dict[Tuple[str, Optional[str]], DocIndex] = {}
+_LOCK = threading.Lock()
+
+
+def get_doc_index(api_url: str, ref: Optional[str] = None) -> DocIndex:
+    "returns the document index of the given repo and ref, a new one once expired"
+    with _LOCK:
+        index = _INDEXES.get((api_url, ref))
+        if index is None or index.expired():
+            index = _INDEXES[(api_url, ref)] = DocIndex(api_url, ref)
+        return index
@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from difflib import SequenceMatcher
+from typing import Any, Dict, List, Optional, Tuple
+
+from install_test.consts import (
+    FIX_CACHE_MAX_LINES,
+    FIX_CACHE_PATH,
+    FIX_CACHE_TRIES,
+    PATCH_MATCH_CUTOFF,
+)
+
+# kinds of errors that point to a cause, docker and pytest errors only tell
+# which step failed
+KEY_KINDS = ("traceback", "pip", "apt", "compiler")
+# errors that pip prints for any failing build, whatever the cause
+GENERIC_SIGNATURES = {
+    "pip: error: subprocess-exited-with-error",
+    "pip: error: metadata-generation-failed",
+}
+
+Patch = List[Dict[str, Any]]
+
+
+def key_signatures(signatures: List[str]) -> List[str]:
+    "the error signatures of a failure that a fix can be looked up by"
+    return sorted(
+        {
+            signature
+            for signature in signatures
+            if signature.split(":", 1)[0] in KEY_KINDS
+            and signature not in GENERIC_SIGNATURES
+        }
+    )
+
+
+def keyword(line: Optional[str]) -> Optional[str]:
+    "the instruction of a dockerfile line"
+    words = line.split() if line is not None else []
+    return words[0].upper() if len(words) > 0 else None
+
+
+def make_patch(before: str, after: str) -> Optional[Patch]:
+    """
+    the changes from one dockerfile to another as hunks of removed and added
+    lines, each with the line before it, or None if too many lines changed
+    for the patch to apply to other dockerfiles.
+    """
+    a = [line.strip() for line in before.strip().split("\n")]
+    b = [line.strip() for line in after.strip().split("\n")]
+    hunks = []
+    for op, i1, i2, j1, j2 in SequenceMatcher(None, a, b).get_opcodes():
+        if op == "equal":
+            continue
+        hunks.append(
+            {
+                "before": a[i1 - 1] if i1 > 0 else None,
+                "remove": a[i1:i2],
+                "add": b[j1:j2],
+            }
+        )
+    changed = sum(len(h["remove"]) + len(h["add"]) for h in hunks)
+    if len(hunks) == 0 or changed > FIX_CACHE_MAX_LINES:
+        return None
+    return hunks
+
+
+def find_line(lines: List[str], line: str) -> Optional[int]:
+    "index of the line, or of the most similar line with the same instruction"
+    stripped = [l.strip() for l in lines]
+    if line in stripped:
+        return stripped.index(line)
+    best, best_ratio = None, PATCH_MATCH_CUTOFF
+    for i, other in enumerate(stripped):
+        if keyword(other) != keyword(line):
+            continue
+        ratio = SequenceMatcher(None, other, line).ratio()
+        if ratio >= best_ratio:
+            best, best_ratio = i, ratio
+    return best
+
+
+def apply_patch(dockerfile: str, patch: Patch) -> Optional[str]:
+    """
+    the dockerfile with the patch applied, matching lines that differ from the
+    ones the patch was made from by their instruction and similarity,
+    or None if the patch does not apply or changes nothing.
+    """
+    lines = dockerfile.strip().split("\n")
+    for hunk in patch:
+        if len(hunk["remove"]) > 0:
+            stripped = [line.strip() for line in lines]
+            n = len(hunk["remove"])
+            starts = [
+                i
+                for i in range(len(lines) - n + 1)
+                if stripped[i : i + n] == hunk["remove"]
+            ]
+            if len(starts) > 0:
+                start = starts[0]
+            elif n == 1:
+                start = find_line(lines, hunk["remove"][0])
+            else:
+                start = None
+            if start is None:
+                return None
+            lines[start : start + n] = hunk["add"]
+            continue
+        if all(line in [l.strip() for l in lines] for line in hunk["add"]):
+            # already there
+            continue
+        if hunk["before"] is None:
+            at = 0
+        else:
+            anchor = find_line(lines, hunk["before"])
+            if anchor is None and keyword(hunk["before"]) == "FROM":
+                froms = [i for i, l in enumerate(lines) if keyword(l) == "FROM"]
+                anchor = froms[-1] if len(froms) > 0 else None
+            if anchor is None:
+                return None
+            at = anchor + 1
+        lines[at:at] = hunk["add"]
+    patched = "\n".join(lines)
+    return patched if patched != dockerfile.strip() else None
+
+
+class FixCache:
+    """
+    On-disk cache of dockerfile changes that fixed a failed build, keyed by
+    the normalized signatures of the errors of the failure, shared by every
+    repo and kept across runs.
+    Every use of a fix is recorded with whether it passed and the time it saved
+    compared to the model repair that first found it.
+    """
+
+    def __init__(self, path: str = FIX_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS fixes (id TEXT PRIMARY KEY, patch TEXT, "
+            "repair_seconds REAL, successes INTEGER, failures INTEGER, created REAL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS signatures "
+            "(signature TEXT, fix TEXT, PRIMARY KEY (signature, fix))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS uses (fix TEXT, repo TEXT, passed INTEGER, "
+            "seconds REAL, saved REAL, created REAL)"
+        )
+        self.conn.commit()
+        self.lookups = 0
+        self.hits = 0
+        self.fixed = 0
+        self.saved = 0.0
+
+    def lookup(
+        self, signatures: List[str], dockerfile: str, limit: int = FIX_CACHE_TRIES
+    ) -> List[Tuple[str, str]]:
+        """
+        (fix id, patched dockerfile) of the fixes stored for the errors that
+        apply to the dockerfile, best first: the fixes found for more of the
+        errors, then the fixes that passed more often.
+        """
+        keys = key_signatures(signatures)
+        if len(keys) == 0:
+            return []
+        self.lookups += 1
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT fixes.id, fixes.patch, fixes.successes, fixes.failures, "
+                "COUNT(*) FROM signatures JOIN fixes ON signatures.fix = fixes.id "
+                f"WHERE signature IN ({', '.join('?' for _ in keys)}) "
+                "GROUP BY fixes.id",
+                keys,
+            ).fetchall()
+        rows.sort(key=lambda row: (-row[4], -(row[2] + 1) / (row[2] + row[3] + 2)))
+        fixes = []
+        for fix, patch, *_ in rows:
+            patched = apply_patch(dockerfile, json.loads(patch))
+            if patched is not None and patched not in [p for _, p in fixes]:
+                fixes.append((fix, patched))
+            if len(fixes) == limit:
+                break
+        if len(fixes) > 0:
+            self.hits += 1
+        return fixes
+
+    def store(
+        self, signatures: List[str], before: str, after: str, repair_seconds: float
+    ) -> Optional[str]:
+        "record the change that fixed a failure, returns its id if it was stored"
+        keys = key_signatures(signatures)
+        patch = make_patch(before, after)
+        if len(keys) == 0 or patch is None:
+            return None
+        encoded = json.dumps(patch, sort_keys=True)
+        fix = hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT repair_seconds, successes FROM fixes WHERE id = ?", (fix,)
+            ).fetchone()
+            if row is None:
+                self.conn.execute(
+                    "INSERT INTO fixes VALUES (?, ?, ?, 1, 0, ?)",
+                    (fix, encoded, repair_seconds, time.time()),
+                )
+            else:
+                # running mean of the time the model took to find it
+                seconds = (row[0] * row[1] + repair_seconds) / (row[1] + 1)
+                self.conn.execute(
+                    "UPDATE fixes SET repair_seconds = ?, successes = successes + 1 "
+                    "WHERE id = ?",
+                    (seconds, fix),
+                )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO signatures VALUES (?, ?)",
+                [(key, fix) for key in keys],
+            )
+            self.conn.commit()
+        return fix
+
+    def record_use(self, fix: str, repo: str, passed: bool, seconds: float) -> float:
+        "record a build with a cached fix, returns the time it saved"
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT repair_seconds FROM fixes WHERE id = ?", (fix,)
+            ).fetchone()
+            saved = max(row[0] - seconds, 0.0) if passed and row is not None else 0.0
+            self.conn.execute(
+                f"UPDATE fixes SET {'successes' if passed else 'failures'} = "
+                f"{'successes' if passed else 'failures'} + 1 WHERE id = ?",
+                (fix,),
+            )
+            self.conn.execute(
+                "INSERT INTO uses VALUES (?, ?, ?, ?, ?, ?)",
+                (fix, repo, int(passed), seconds, saved, time.time()),
+            )
+            self.conn.commit()
+        if passed:
+            self.fixed += 1
+            self.saved += saved
+        return saved
+
+    def stats(self) -> Dict[str, Any]:
+        "hit rate and time saved in this run, and over every run"
+        with self.lock:
+            n_fixes = self.conn.execute("SELECT COUNT(*) FROM fixes").fetchone()[0]
+            uses, passed, saved = self.conn.execute(
+                "SELECT COUNT(*), SUM(passed), SUM(saved) FROM uses"
+            ).fetchone()
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "fixed": self.fixed,
+            "hit_rate": self.fixed / self.lookups if self.lookups > 0 else None,
+            "saved_seconds": self.saved,
+            "stored_fixes": n_fixes,
+            "total_uses": uses,
+            "total_passed": passed or 0,
+            "total_saved_seconds": saved or 0.0,
+        }
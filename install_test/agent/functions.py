@@ -1,12 +1,18 @@
 import base64
 import json
 import os
+import threading
 from typing import Any, Dict, List, Optional, Tuple
 from uuid import uuid4
 
 import requests
 
+from install_test.agent.doc_index import get_doc_index
 from install_test.agent.functions_json import FUNC_DICT, FUNC_HEADER
+from install_test.agent.github_cache import GithubCache
+from install_test.agent.local_repo import LocalRepo, get_local_repo
+from install_test.agent.sections import parse_markdown, parse_rst
+from install_test.consts import REPO_BACKENDS
 from install_test.utils import ClassificationError, classify_output, update_files_dirs
 
 # '.rst' IS TYPICALLY FOR READMES - IT IS NL
@@ -14,6 +20,30 @@ from install_test.utils import ClassificationError, classify_output, update_file
 # so here it is :)
 NON_NL = [".py", "requirements", ".toml", ".yaml", "Dockerfile", ".lock"]
 
+# where repository contents are read from, either "api" or "local"
+BACKEND = "api"
+# on-disk cache of github api responses, requests are always sent if None
+CACHE: Optional[GithubCache] = None
+# guards the state shared between tool calls that run at the same time
+_LOCK = threading.Lock()
+# background fetches of repository contents, keyed by (api_url, ref)
+PREFETCHERS: Dict[Tuple[str, Optional[str]], Any] = {}
+
+
+def set_backend(backend: str, clone_dir: Optional[str] = None):
+    "select whether repository contents are read from the github api or local clones"
+    global BACKEND
+    if backend not in REPO_BACKENDS:
+        raise ValueError(f"unknown backend {backend}, choose one of {REPO_BACKENDS}")
+    BACKEND = backend
+    if clone_dir is not None:
+        LocalRepo.root = clone_dir
+
+
+def count_target(targets: Dict[str, int], key: str):
+    with _LOCK:
+        targets[key] = targets[key] + 1 if key in targets else 1
+
 
 def get_api_url(git_url: str):
     "takes a git url, and returns the corresponding git api url"
@@ -22,11 +52,45 @@ def get_api_url(git_url: str):
     return f"https://api.github.com/repos/{owner}/{repo}/contents"
 
 
+def set_cache(cache: Optional[GithubCache]):
+    "set the cache placed in front of github api requests, or None to disable it"
+    global CACHE
+    CACHE = cache
+
+
+def set_prefetcher(api_url: str, ref: Optional[str], prefetcher: Optional[Any]):
+    "serve contents of the repo at ref from the prefetcher, or stop if None"
+    if prefetcher is None:
+        PREFETCHERS.pop((api_url, ref), None)
+    else:
+        PREFETCHERS[(api_url, ref)] = prefetcher
+
+
+def prefetched(api_url: str, ref: Optional[str], kind: str, path: str) -> Optional[Any]:
+    "the prefetched contents of a file or directory, or None if it was not prefetched"
+    prefetcher = PREFETCHERS.get((api_url, ref))
+    if prefetcher is None:
+        return None
+    return prefetcher.result(kind, path)
+
+
 def send_request(url: str, ref: Optional[str] = None):
+    if CACHE is not None:
+        return CACHE.get(url, ref, _send_request)
+    return _send_request(url, ref)
+
+
+def _send_request(
+    url: str, ref: Optional[str] = None, headers: Optional[Dict[str, str]] = None
+):
     if ref is not None:
         url = url + f"?ref={ref}"
     contents_response = requests.get(
-        url, headers={"Authorization": f"Bearer {os.environ.get('GIT_TOKEN')}"}
+        url,
+        headers={
+            "Authorization": f"Bearer {os.environ.get('GIT_TOKEN')}",
+            **(headers or {}),
+        },
     )
     return contents_response
 
@@ -53,10 +117,11 @@ def get_directory_contents(
 
     if targets is not None:
         key = f"DIR-{target_directory}"
-        targets[key] = targets[key] + 1 if key in targets else 1
+        count_target(targets, key)
 
     dir_contents = _get_directory_contents(api_url, target_directory, ref=ref)
-    update_files_dirs(files, directories, target_directory, dir_contents)
+    with _LOCK:
+        update_files_dirs(files, directories, target_directory, dir_contents)
     function_response = (
         directory_contents_str(dir_contents)
         + "\n"
@@ -73,16 +138,33 @@ def _get_directory_contents(
 ) -> List[Tuple[str, str]]:
     "return the contents of a directory in a given git repo"
     directory = "" if directory == "." or directory == "/" else directory
+    contents = prefetched(api_url, ref, "dir", directory)
+    if contents is None:
+        contents = _fetch_directory_contents(api_url, directory, ref=ref)
+    return [
+        content
+        for content in contents
+        if not (content[0] == "pyproject.toml" and exclude_pyproject)
+    ]
+
+
+def _fetch_directory_contents(
+    api_url: str, directory: str = "", ref: Optional[str] = None
+) -> List[Tuple[str, str]]:
+    if BACKEND == "local":
+        contents = get_local_repo(api_url, ref).directory_contents(directory)
+        if contents is None:
+            raise ValueError(
+                f"Failed to retrieve contents of directory {directory} "
+                f"in repository {api_url} (not found in local checkout)"
+            )
+        return contents
     contents_url = api_url + f"/{directory}"
     contents_response = send_request(contents_url, ref)
 
     if contents_response.status_code == 200:
         contents_data = contents_response.json()
-        contents = [
-            (content["name"], content["type"])
-            for content in contents_data
-            if not (content["name"] == "pyproject.toml" and exclude_pyproject)
-        ]
+        contents = [(content["name"], content["type"]) for content in contents_data]
     else:
         raise ValueError(
             f"Failed to retrieve contents of directory {directory} "
@@ -117,33 +199,34 @@ def get_file_contents(
 
     if targets is not None:
         key = f"FILE-{target_file}"
-        targets[key] = targets[key] + 1 if key in targets else 1
+        count_target(targets, key)
 
-    new_file_contents = _get_file_contents(api_url, target_file, ref=ref)
     non_nl = [x in target_file for x in NON_NL]
-
-    headings = (
-        get_headings_rst(new_file_contents)
-        if target_file.endswith(".rst")
-        else get_headings(new_file_contents)
+    document = get_doc_index(api_url, ref).document(
+        target_file,
+        lambda: _get_file_contents(api_url, target_file, ref=ref),
+        parse=not any(non_nl),
     )
+    if document is None:
+        return f"{target_file} does NOT exist."
 
-    if (not any(non_nl)) and headings is not None:
-        contents_dict = {h[0]: h[1] for h in headings}
-        headings_str = "\n - ".join([h[0] for h in headings])
+    if len(document) > 0:
+        contents_dict = document
+        headings_str = "\n - ".join(document.headings)
         function_response = (
             f"\nhere are the section headers of the file: \n - {headings_str}"
         )
-        if len(file_contents.keys()) == 0:
-            function_response += (
-                "\n You can use the `inspect_header` "
-                "function to see the content any file heading."
-            )
-            tools.append(FUNC_HEADER)
-        file_contents[target_file] = contents_dict
+        with _LOCK:
+            if len(file_contents.keys()) == 0:
+                function_response += (
+                    "\n You can use the `inspect_header` "
+                    "function to see the content any file heading."
+                )
+                tools.append(FUNC_HEADER)
+            file_contents[target_file] = contents_dict
     else:
         function_response = (
-            new_file_contents + "\n" + f"here are the contents of file {target_file}"
+            document.text + "\n" + f"here are the contents of file {target_file}"
         )
 
     return function_response
@@ -151,6 +234,15 @@ def get_file_contents(
 
 def _get_file_contents(api_url, file_path, ref: Optional[str] = None) -> str:
     "return the contents of a file in a given git repo"
+    contents = prefetched(api_url, ref, "file", file_path)
+    if contents is not None:
+        return contents
+    return _fetch_file_contents(api_url, file_path, ref=ref)
+
+
+def _fetch_file_contents(api_url, file_path, ref: Optional[str] = None) -> str:
+    if BACKEND == "local":
+        return get_local_repo(api_url, ref).file_contents(file_path)
     contents_url = api_url + f"/{file_path}"
     contents_response = send_request(contents_url, ref)
 
@@ -165,66 +257,18 @@ def _get_file_contents(api_url, file_path, ref: Optional[str] = None) -> str:
 
 def get_headings(file: str) -> Optional[List[Tuple[str, str]]]:
     "get a list of all section heading, section content pairs from the given file"
-    lines = file.split("\n")
-    headings = []
-    code_block = False
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if line.startswith("```"):
-            code_block = not code_block
-        elif line.startswith("#") and not code_block:
-            headings.append((line, i))
-    if len(headings) == 0:
+    sections = parse_markdown(file)
+    if len(sections) == 0:
         return None
-
-    headings = [
-        (
-            heading[0].replace("#", "").strip(),
-            heading[1],
-            (
-                3
-                if heading[0].startswith("###")
-                else 2 if heading[0].startswith("##") else 1
-            ),
-        )
-        for heading in headings
-    ]
-
-    sections = [("", lines[: headings[0][1]])]
-    sections = sections + [
-        (
-            heading[0],
-            "\n".join(
-                lines[
-                    heading[1]
-                    + 1 : (headings[i + 1][1] if i + 1 < len(headings) else None)
-                ]
-            ),
-        )
-        for i, heading in enumerate(headings[:-1])
-    ]
-    return sections
+    return [(section.title, section.content(file)) for section in sections]
 
 
 def get_headings_rst(file: str) -> Optional[List[Tuple[str, str]]]:
     "get a list of all section heading, section content pairs from the given file"
-    lines = file.split("\n")
-    headings = [
-        i
-        for i, line in enumerate(lines[1:])
-        if not line.startswith(" ")
-        and line.strip() != ""
-        and (all(l == "=" for l in line.strip()) or all(l == "-" for l in line.strip()))
-    ]
-
-    sections = []
-    if headings[0] != 0:
-        sections = [("", "\n".join(lines[: headings[0]]))]
-    sections.extend(
-        (lines[prev], "\n".join(lines[prev + 2 : curr]))
-        for prev, curr in zip(headings, headings[1:])
-    )
-    return sections
+    sections = parse_rst(file)
+    if len(sections) == 0:
+        return None
+    return [(section.title, section.content(file)) for section in sections]
 
 
 def inspect_header(
@@ -232,6 +276,8 @@ def inspect_header(
     files: List[str],
     file_contents: Dict[str, Dict[str, str]],
     targets: Optional[Dict[str, int]] = None,
+    api_url: Optional[str] = None,
+    ref: Optional[str] = None,
 ):
     args = json.loads(response["function"]["arguments"])
     try:
@@ -239,7 +285,11 @@ def inspect_header(
     except ClassificationError:
         return f"{args['file']} does NOT exist."
 
-    # WHAT IF NOT???
+    if target_file not in file_contents and api_url is not None:
+        # the file may have been parsed by another agent working on the repo
+        document = get_doc_index(api_url, ref).get(target_file)
+        if document is not None and len(document) > 0:
+            file_contents[target_file] = document
     if target_file not in file_contents:
         return f"file {target_file} not found!"
 
@@ -252,9 +302,9 @@ def inspect_header(
 
     if targets is not None:
         key = f"FILE-{target_file}"
-        targets[key] = targets[key] + 1 if key in targets else 1
+        count_target(targets, key)
         key = f"{key}-HEAD-{target_heading}"
-        targets[key] = targets[key] + 1 if key in targets else 1
+        count_target(targets, key)
 
     section_contents = file_contents[target_file][target_heading]
     function_response = (
@@ -275,7 +325,7 @@ def check_presence(
 
     if targets is not None:
         key = f"FILE-{target_file}"
-        targets[key] = targets[key] + 1 if key in targets else 1
+        count_target(targets, key)
 
     exists = _check_presence(api_url, target_file, ref=ref)
     function_response = f"{target_file} does{' NOT' if not exists else ''} exist."
@@ -284,6 +334,8 @@ def check_presence(
 
 def _check_presence(api_url: str, file_path: str, ref: Optional[str] = None) -> bool:
     "check whether the provided file exists"
+    if BACKEND == "local":
+        return get_local_repo(api_url, ref).exists(file_path)
     contents_url = api_url + f"/{file_path}"
     contents_response = send_request(contents_url, ref)
 
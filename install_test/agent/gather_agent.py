@@ -1,8 +1,10 @@
+import asyncio
 import json
 import os
 from typing import Any, Dict, List, Optional, Tuple
 
 from install_test.agent.agent import Agent
+from install_test.agent.async_agent import AsyncAgent
 from install_test.agent.functions import (
     _get_directory_contents,
     directory_contents_str,
@@ -17,26 +19,37 @@ from install_test.agent.functions_json import (
     FUNC_SUBMIT_FILE,
     FUNC_SUMMARISE,
 )
+from install_test.agent.prefetch import Prefetcher, start_prefetch
 from install_test.consts import (
     GATHER_FOLLOWUP_PROMPT_PATH,
     GATHER_SUMMARISE_FOLLOWUP_PROMPT_PATH,
     GATHER_SUMMARISE_PROMPT_PATH,
     GATHER_SYSTEM_PROMPT_PATH,
 )
-from install_test.utils import ClassificationError, classify_output, print_output
+from install_test.utils import (
+    ClassificationError,
+    PathList,
+    classify_output,
+    print_output,
+)
 
 
 class GatherAgent(Agent):
+    # if set, likely installation documents are fetched while the model searches
+    prefetch: bool = False
+    prefetcher: Optional[Prefetcher] = None
 
     @staticmethod
     def init_system_message(
-        repo_url: str, system_path: str = GATHER_SYSTEM_PROMPT_PATH
+        repo_url: str,
+        system_path: str = GATHER_SYSTEM_PROMPT_PATH,
+        ref: Optional[str] = None,
     ) -> str:
         repo_name = repo_url.split("/")[-1][:-4]
         with open(os.path.abspath(system_path), "r") as f:
             system = f.read()
         api_url = get_api_url(repo_url)
-        contents = _get_directory_contents(api_url)
+        contents = _get_directory_contents(api_url, ref=ref)
         system = system.replace("<CONTENTS>", directory_contents_str(contents)).replace(
             "<REPO_NAME>", repo_name
         )
@@ -45,6 +58,24 @@ class GatherAgent(Agent):
     def gather(
         self, repo_url: str, ref: Optional[str] = None
     ) -> Tuple[List[str], List[str]]:
+        try:
+            loop_args = self.gather_setup(repo_url, ref)
+            response, response_class = self.query_then_tool(
+                self.followup, loop_args["tools"]
+            )
+            response = self.tool_loop(
+                response=response, response_class=response_class, **loop_args
+            )
+        except BaseException:
+            # no summary follows to stop the prefetcher
+            self.stop_prefetch()
+            raise
+        self.confirm_tool(response)
+        return loop_args["submitted_files"], loop_args["file_contents"]
+
+    def gather_setup(self, repo_url: str, ref: Optional[str] = None) -> Dict[str, Any]:
+        "prepare the search for documentation, returns the arguments of the tool loop"
+        self.phase = "gather"
         with open(GATHER_FOLLOWUP_PROMPT_PATH, "r") as f:
             followup = f.read()
         self.followup = followup.replace(
@@ -54,30 +85,23 @@ class GatherAgent(Agent):
         print_output(self.system + "\n", "", self.verbose)
 
         api_url = get_api_url(repo_url)
+        if self.prefetch and self.prefetcher is None:
+            self.prefetcher = start_prefetch(api_url, ref)
         root_dir = _get_directory_contents(api_url, ref=ref)
         tools = [FUNC_DIR, FUNC_FILE, FUNC_PRESENCE, FUNC_SUBMIT_FILE, FUNC_FINISHED]
-        directories = [i[0] for i in root_dir if i[1] == "dir"] + [".", "/"]
-        files = [i[0] for i in root_dir if i[1] == "file"]
-        file_contents = {}
-        submitted_files = []
-
-        response, response_class = self.query_then_tool(self.followup, tools)
-
-        response = self.tool_loop(
-            response=response,
-            response_class=response_class,
-            exit_func=FUNC_FINISHED["function"]["name"],
-            directories=directories,
-            files=files,
-            file_contents=file_contents,
-            tools=tools,
-            api_url=api_url,
-            followup=self.followup,
-            submitted_files=submitted_files,
-            ref=ref,
-        )
-        self.confirm_tool(response)
-        return submitted_files, file_contents
+        return {
+            "exit_func": FUNC_FINISHED["function"]["name"],
+            "directories": PathList(
+                [i[0] for i in root_dir if i[1] == "dir"] + [".", "/"]
+            ),
+            "files": PathList([i[0] for i in root_dir if i[1] == "file"]),
+            "file_contents": {},
+            "tools": tools,
+            "api_url": api_url,
+            "followup": self.followup,
+            "submitted_files": [],
+            "ref": ref,
+        }
 
     def summarise(
         self,
@@ -86,6 +110,28 @@ class GatherAgent(Agent):
         file_contents: Dict[str, Dict[str, str]],
         ref: Optional[str] = None,
     ):
+        try:
+            loop_args = self.summarise_setup(url, submitted_files, file_contents, ref)
+            response, response_class = self.query_then_tool(
+                self.followup, loop_args["tools"]
+            )
+            response = self.tool_loop(
+                response=response, response_class=response_class, **loop_args
+            )
+            return self.submit_summary(response)
+        finally:
+            # the documents are not read again after the summary
+            self.stop_prefetch()
+
+    def summarise_setup(
+        self,
+        url: str,
+        submitted_files: List[str],
+        file_contents: Dict[str, Dict[str, str]],
+        ref: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        "prepare the summary of the documentation, returns the arguments of the tool loop"
+        self.phase = "summarise"
         repo_name = url.split("/")[-1][:-4]
         with open(GATHER_SUMMARISE_PROMPT_PATH, "r") as f:
             summarise_prompt = (
@@ -111,28 +157,29 @@ class GatherAgent(Agent):
                 )
                 .replace("<SUMMARISE_TOOL>", FUNC_SUMMARISE["function"]["name"])
             )
-        self.messages.append({"role": "user", "content": summarise_prompt})
-        tools = [FUNC_FILE, FUNC_HEADER, FUNC_SUMMARISE]
-        response, response_class = self.query_then_tool(self.followup, tools)
+        self.add_message({"role": "user", "content": summarise_prompt})
+        return {
+            "exit_func": FUNC_SUMMARISE["function"]["name"],
+            "directories": [],
+            "files": submitted_files,
+            "file_contents": file_contents,
+            "tools": [FUNC_FILE, FUNC_HEADER, FUNC_SUMMARISE],
+            "api_url": get_api_url(url),
+            "followup": self.followup,
+            "submitted_files": [],
+            "ref": ref,
+        }
 
-        response = self.tool_loop(
-            response=response,
-            response_class=response_class,
-            exit_func=FUNC_SUMMARISE["function"]["name"],
-            directories=[],
-            files=submitted_files,
-            file_contents=file_contents,
-            tools=tools,
-            api_url=get_api_url(url),
-            followup=self.followup,
-            submitted_files=[],
-            ref=ref,
-        )
+    def submit_summary(self, response: Dict[str, Any]) -> str:
         summary = json.loads(response["function"]["arguments"])["summary"]
         print_output(summary, "<", self.verbose)
         self.confirm_tool(response)
         return summary
 
+    def stop_prefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+
     def use_tool(
         self,
         response: str,
@@ -157,6 +204,7 @@ class GatherAgent(Agent):
             tools=tools,
             api_url=api_url,
             function_response=function_response,
+            ref=ref,
         )
 
     def submit_file(self, response: str, files: List[str], submitted_files: List[str]):
@@ -171,3 +219,42 @@ class GatherAgent(Agent):
         except ClassificationError:
             msg = f"{args['file']} does NOT exist."
         return msg
+
+
+class AsyncGatherAgent(AsyncAgent, GatherAgent):
+
+    async def agather(
+        self, repo_url: str, ref: Optional[str] = None
+    ) -> Tuple[List[str], List[str]]:
+        try:
+            loop_args = await asyncio.to_thread(self.gather_setup, repo_url, ref)
+            response, response_class = await self.aquery_then_tool(
+                self.followup, loop_args["tools"]
+            )
+            response = await self.atool_loop(
+                response=response, response_class=response_class, **loop_args
+            )
+        except BaseException:
+            self.stop_prefetch()
+            raise
+        self.confirm_tool(response)
+        return loop_args["submitted_files"], loop_args["file_contents"]
+
+    async def asummarise(
+        self,
+        url: str,
+        submitted_files: List[str],
+        file_contents: Dict[str, Dict[str, str]],
+        ref: Optional[str] = None,
+    ):
+        try:
+            loop_args = self.summarise_setup(url, submitted_files, file_contents, ref)
+            response, response_class = await self.aquery_then_tool(
+                self.followup, loop_args["tools"]
+            )
+            response = await self.atool_loop(
+                response=response, response_class=response_class, **loop_args
+            )
+            return self.submit_summary(response)
+        finally:
+            self.stop_prefetch()
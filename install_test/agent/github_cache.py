@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from install_test.consts import GITHUB_CACHE_PATH, GITHUB_CACHE_TTL
+
+# status codes that describe the repository rather than the state of the api
+CACHEABLE_STATUS = (200, 404)
+
+
+class CachedResponse:
+    "the parts of a `requests.Response` used by the repository functions"
+
+    def __init__(self, status_code: int, content: bytes, headers: Dict[str, str]):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def is_pinned(ref: Optional[str]) -> bool:
+    "refs that are commit hashes always point to the same tree, so never go stale"
+    return ref is not None and re.fullmatch(r"[0-9a-f]{7,40}", ref) is not None
+
+
+class GithubCache:
+    """
+    On-disk cache of github api responses keyed by (url, ref).
+    Responses for pinned refs never expire, other responses are revalidated
+    with their ETag once they are older than `ttl` seconds.
+    """
+
+    def __init__(self, path: str = GITHUB_CACHE_PATH, ttl: float = GITHUB_CACHE_TTL):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, url TEXT, ref TEXT, status INTEGER, "
+            "etag TEXT, body BLOB, fetched REAL)"
+        )
+        self.conn.commit()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url: str, ref: Optional[str]) -> str:
+        return hashlib.sha256(f"{url}@{ref or ''}".encode("utf-8")).hexdigest()
+
+    def get(
+        self,
+        url: str,
+        ref: Optional[str],
+        fetch: Callable[[str, Optional[str], Dict[str, str]], object],
+    ):
+        """
+        return the cached response for url at ref,
+        calling `fetch(url, ref, headers)` if it is missing or stale.
+        """
+        key = self.key(url, ref)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, etag, body, fetched FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+        if row is not None:
+            status, etag, body, fetched = row
+            cached = CachedResponse(status, body, {"ETag": etag or ""})
+            if is_pinned(ref) or time.time() - fetched < self.ttl:
+                self.hits += 1
+                return cached
+
+        headers = {"If-None-Match": row[1]} if row is not None and row[1] else {}
+        response = fetch(url, ref, headers)
+        if response.status_code == 304 and row is not None:
+            self.revalidated += 1
+            self.store(key, url, ref, status, etag, body)
+            return cached
+
+        self.misses += 1
+        if response.status_code in CACHEABLE_STATUS:
+            self.store(
+                key,
+                url,
+                ref,
+                response.status_code,
+                response.headers.get("ETag"),
+                response.content,
+            )
+        return response
+
+    def store(
+        self,
+        key: str,
+        url: str,
+        ref: Optional[str],
+        status: int,
+        etag: Optional[str],
+        body: bytes,
+    ):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, url, ref, status, etag, body, time.time()),
+            )
+            self.conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+        }
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from install_test.consts import LLM_CACHE_PATH
+from install_test.utils import objectify
+
+
+class CacheMissError(Exception):
+    "raised in replay mode when a request has no recorded response"
+
+
+def normalise_messages(messages: Any) -> Any:
+    """
+    copy of the messages with tool call ids replaced by their order of appearance,
+    as ids made up for default tool calls differ between runs.
+    """
+    ids: Dict[str, str] = {}
+
+    def normalise(value):
+        if isinstance(value, dict):
+            value = {key: normalise(val) for key, val in value.items()}
+            for key in ("id", "tool_call_id"):
+                if isinstance(value.get(key), str):
+                    value[key] = ids.setdefault(value[key], f"call_{len(ids)}")
+            return value
+        if isinstance(value, list):
+            return [normalise(x) for x in value]
+        return value
+
+    return normalise(messages)
+
+
+def serialise_message(message: Any) -> Dict[str, Any]:
+    "the parts of a chat completion message used by the agents"
+    tool_calls = getattr(message, "tool_calls", None)
+    return {
+        "content": message.content,
+        "tool_calls": (
+            [
+                {
+                    "id": call.id,
+                    "type": "function",
+                    "function": {
+                        "name": call.function.name,
+                        "arguments": call.function.arguments,
+                    },
+                }
+                for call in tool_calls
+            ]
+            if tool_calls
+            else None
+        ),
+    }
+
+
+def completion_message(request: Dict[str, Any], completion: Any) -> Any:
+    "the message of a completion, or the list of its messages if several were requested"
+    if request.get("n", 1) > 1:
+        return [choice.message for choice in completion.choices]
+    return completion.choices[0].message
+
+
+class LLMCache:
+    """
+    On-disk cache of chat completions keyed by the hash of the full request
+    (model, messages, tools and sampling parameters).
+    In "record" mode every request goes to the api and its response is stored,
+    in "replay" mode only stored responses are used, and in "auto" mode
+    the api is only called for requests that were never recorded.
+    """
+
+    def __init__(self, path: str = LLM_CACHE_PATH, mode: str = "auto"):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, model TEXT, message TEXT, usage TEXT, created REAL)"
+        )
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(request: Dict[str, Any]) -> str:
+        request = dict(request, messages=normalise_messages(request["messages"]))
+        return hashlib.sha256(
+            json.dumps(request, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def lookup(self, request: Dict[str, Any]) -> Optional[Tuple[Any, Any]]:
+        "the recorded (message, usage) for the request, or None if it must be sent"
+        if self.mode == "record":
+            self.misses += 1
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT message, usage FROM completions WHERE key = ?",
+                (self.key(request),),
+            ).fetchone()
+        if row is None:
+            self.misses += 1
+            if self.mode == "replay":
+                raise CacheMissError(
+                    f"no recorded response for request to {request['model']} "
+                    f"with {len(request['messages'])} messages"
+                )
+            return None
+        self.hits += 1
+        return objectify(json.loads(row[0])), objectify(json.loads(row[1]))
+
+    def store(self, request: Dict[str, Any], completion: Any) -> Tuple[Any, Any]:
+        "record the completion of a request, returns its (message, usage)"
+        message = completion_message(request, completion)
+        usage = completion.usage
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                (
+                    self.key(request),
+                    request["model"],
+                    json.dumps(
+                        [serialise_message(m) for m in message]
+                        if isinstance(message, list)
+                        else serialise_message(message)
+                    ),
+                    json.dumps(
+                        {
+                            "prompt_tokens": usage.prompt_tokens,
+                            "completion_tokens": usage.completion_tokens,
+                        }
+                        if usage is not None
+                        else None
+                    ),
+                    time.time(),
+                ),
+            )
+            self.conn.commit()
+        return message, usage
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
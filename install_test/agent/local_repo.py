@@ -0,0 +1,93 @@
+import os
+import subprocess
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from install_test.consts import CLONE_DIR
+
+
+class LocalRepo:
+    """
+    A local checkout of a github repository at a given ref,
+    used to answer directory listings, file reads and presence checks
+    without going through the github contents api.
+    """
+
+    root = CLONE_DIR
+
+    def __init__(self, api_url: str, ref: Optional[str] = None):
+        owner, repo = api_url.split("/")[-3:-1]
+        self.git_url = f"https://github.com/{owner}/{repo}.git"
+        self.ref = ref
+        self.path = os.path.abspath(
+            os.path.join(self.root, f"{owner}__{repo}@{ref or 'HEAD'}")
+        )
+        if not os.path.isdir(self.path):
+            self.clone()
+
+    def clone(self):
+        "shallow clone the repo, or a blobless clone if a specific ref is needed"
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        subprocess.run(["rm", "-rf", tmp_path])
+        if self.ref is None:
+            cmd = ["git", "clone", "--depth", "1", self.git_url, tmp_path]
+        else:
+            # refs in the dataset are abbreviated commit hashes,
+            # which can not be fetched shallowly.
+            cmd = ["git", "clone", "--filter=blob:none", self.git_url, tmp_path]
+        subprocess.run(cmd, capture_output=True, check=True)
+        if self.ref is not None:
+            subprocess.run(
+                ["git", "-C", tmp_path, "checkout", "-q", self.ref],
+                capture_output=True,
+                check=True,
+            )
+        os.rename(tmp_path, self.path)
+
+    def resolve(self, path: str) -> Optional[str]:
+        "absolute path of a repo-relative path, or None if it leaves the checkout"
+        path = os.path.normpath(os.path.join(self.path, path.strip("/")))
+        if os.path.commonpath([path, self.path]) != self.path:
+            return None
+        return path
+
+    def directory_contents(
+        self, directory: str = ""
+    ) -> Optional[List[Tuple[str, str]]]:
+        path = self.resolve(directory)
+        if path is None or not os.path.isdir(path):
+            return None
+        return [
+            (entry.name, "dir" if entry.is_dir(follow_symlinks=False) else "file")
+            for entry in sorted(os.scandir(path), key=lambda e: e.name)
+            if entry.name != ".git"
+        ]
+
+    def file_contents(self, file_path: str) -> Optional[str]:
+        path = self.resolve(file_path)
+        if path is None or not os.path.isfile(path):
+            return None
+        with open(path, "r", errors="replace") as f:
+            return f.read()
+
+    def exists(self, file_path: str) -> bool:
+        path = self.resolve(file_path)
+        return path is not None and os.path.lexists(path)
+
+
+_REPOS: Dict[Tuple[str, Optional[str]], LocalRepo] = {}
+_LOCKS: Dict[Tuple[str, Optional[str]], threading.Lock] = {}
+_LOCK = threading.Lock()
+
+
+def get_local_repo(api_url: str, ref: Optional[str] = None) -> LocalRepo:
+    "returns the local checkout for the given repo and ref, cloning it if needed"
+    key = (api_url, ref)
+    with _LOCK:
+        lock = _LOCKS.setdefault(key, threading.Lock())
+    # clones of different repos can run at the same time
+    with lock:
+        if key not in _REPOS:
+            _REPOS[key] = LocalRepo(api_url, ref)
+        return _REPOS[key]
@@ -0,0 +1,213 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from install_test.agent.functions import build_default_arg
+from install_test.agent.functions_json import (
+    FUNC_DOCKERFILE_NAME,
+    FUNC_FINISHED_NAME,
+    FUNC_READY_TO_FIX_NAME,
+    FUNC_SUMMARISE_NAME,
+)
+from install_test.utils import objectify
+
+MOCK_MODEL = "mock"
+TEXT_RESPONSE = "I will now use the tool that I planned to use."
+# tools that end a phase of the agents, called once the script runs out
+EXIT_TOOLS = [
+    FUNC_FINISHED_NAME,
+    FUNC_READY_TO_FIX_NAME,
+    FUNC_SUMMARISE_NAME,
+    FUNC_DOCKERFILE_NAME,
+]
+
+
+class ScriptedChat:
+    """
+    Stand-in for a chat model that answers from a script of tool calls.
+    The script lists (tool name, arguments) in the order they should be called
+    over a conversation, or lists of them to call several tools in one turn.
+    The n-th tool request of a conversation is answered with the n-th entry
+    if its tools are offered, and otherwise with the offered tool that ends
+    the phase of the agent called with default arguments,
+    or the arguments given in `defaults`.
+    Requests for several choices get the arguments of `variants` in turn
+    for the tools that have them.
+    Answers only depend on the request, so one script can serve many
+    conversations at once, and every request waits `latency` seconds.
+    """
+
+    def __init__(
+        self,
+        script: Optional[List[Tuple[str, Dict[str, Any]]]] = None,
+        latency: float = 0.0,
+        defaults: Optional[Dict[str, Dict[str, Any]]] = None,
+        variants: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+    ):
+        self.script = script or []
+        self.latency = latency
+        self.defaults = defaults or {}
+        self.variants = variants or {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        # time spent answering requests, including latency
+        self.busy = 0.0
+
+    def respond(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        "the chat completion for a request, as returned by the api"
+        start = time.time()
+        messages = request["messages"]
+        tools = request.get("tools")
+        if tools:
+            n_turns = sum(
+                1
+                for message in messages
+                if message["role"] == "assistant" and message.get("tool_calls")
+            )
+            choices = [
+                self.tool_call(n_turns, tools, i) for i in range(request.get("n") or 1)
+            ]
+        else:
+            choices = [{"role": "assistant", "content": TEXT_RESPONSE}]
+        prompt = sum(len(str(message.get("content") or "")) for message in messages)
+        completion = sum(len(json.dumps(message)) for message in choices) // 4
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            self.busy += time.time() - start
+        return {
+            "id": f"chatcmpl-{self.requests}",
+            "object": "chat.completion",
+            "created": int(start),
+            "model": request.get("model", MOCK_MODEL),
+            "choices": [
+                {"index": i, "message": message, "finish_reason": "stop"}
+                for i, message in enumerate(choices)
+            ],
+            "usage": {
+                "prompt_tokens": prompt // 4,
+                "completion_tokens": completion,
+                "total_tokens": prompt // 4 + completion,
+            },
+        }
+
+    def tool_call(
+        self, n: int, tools: List[Dict[str, Any]], choice: int = 0
+    ) -> Dict[str, Any]:
+        offered = {tool["function"]["name"]: tool for tool in tools}
+        calls = self.script[n] if n < len(self.script) else []
+        if not isinstance(calls, list):
+            calls = [calls]
+        if len(calls) == 0 or any(name not in offered for name, _ in calls):
+            exits = [name for name in offered if name in EXIT_TOOLS]
+            name = exits[-1] if len(exits) > 0 else tools[-1]["function"]["name"]
+            params = offered[name]["function"]["parameters"]
+            arguments = {
+                param: build_default_arg(params["properties"][param])
+                for param in params.get("required", [])
+            }
+            arguments.update(self.defaults.get(name, {}))
+            if len(self.variants.get(name, [])) > 0:
+                variants = self.variants[name]
+                arguments.update(variants[choice % len(variants)])
+            calls = [(name, arguments)]
+        return {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": f"call_{n}_{choice}_{i}",
+                    "type": "function",
+                    "function": {"name": name, "arguments": json.dumps(arguments)},
+                }
+                for i, (name, arguments) in enumerate(calls)
+            ],
+        }
+
+
+class ScriptedClient:
+    "in-process client with the `chat.completions.create` interface of openai"
+
+    def __init__(self, chat: ScriptedChat, asynchronous: bool = False):
+        self.chat = self
+        self.completions = self
+        self.scripted = chat
+        self.asynchronous = asynchronous
+
+    def create(self, **request):
+        if self.asynchronous:
+            return asyncio.to_thread(self._create, request)
+        return self._create(request)
+
+    def _create(self, request: Dict[str, Any]):
+        request = {
+            **request,
+            "messages": json.loads(json.dumps(request["messages"], default=str)),
+        }
+        return objectify(self.scripted.respond(request))
+
+
+class ScriptedBackend:
+    "chat backend for `Agent.backend` that creates clients answering from a script"
+
+    def __init__(self, chat: ScriptedChat):
+        self.chat = chat
+
+    def __call__(self, asynchronous: bool = False) -> ScriptedClient:
+        return ScriptedClient(self.chat, asynchronous)
+
+
+class MockLLMServer:
+    """
+    OpenAI compatible http endpoint answering from a script,
+    agents use it by setting `Agent.base_url` to `server.url`.
+    """
+
+    def __init__(self, chat: ScriptedChat, host: str = "127.0.0.1", port: int = 0):
+        self.chat = chat
+        scripted = chat
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                body = json.dumps(scripted.respond(request)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockLLMServer":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "MockLLMServer":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,130 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from fnmatch import fnmatch
+from typing import Any, Dict, Optional, Tuple
+
+from install_test.agent import functions
+from install_test.agent.functions import (
+    _fetch_directory_contents,
+    _fetch_file_contents,
+    set_prefetcher,
+)
+from install_test.consts import (
+    PREFETCH_DIR_PATTERNS,
+    PREFETCH_DOCS_DEPTH,
+    PREFETCH_DOCS_DIRS,
+    PREFETCH_FILE_PATTERNS,
+    PREFETCH_MAX_FILES,
+    PREFETCH_WORKERS,
+)
+
+
+class Prefetcher:
+    """
+    Fetches the files of a repository that usually describe how to install it
+    in the background, starting from the root listing, so that they are ready
+    by the time the model asks for them.
+    Requests for a file or directory that is still being fetched wait for
+    the fetch in progress instead of sending their own.
+    """
+
+    def __init__(self, api_url: str, ref: Optional[str] = None):
+        self.api_url = api_url
+        self.ref = ref
+        self.lock = threading.Lock()
+        self.futures: Dict[Tuple[str, str], Future] = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch"
+        )
+        self.n_files = 0
+        self.hits = 0
+
+    def start(self) -> "Prefetcher":
+        self.schedule_directory("", 0)
+        return self
+
+    def schedule(self, kind: str, path: str) -> Optional[Future]:
+        with self.lock:
+            if (kind, path) in self.futures:
+                return None
+            if kind == "file":
+                if self.n_files >= PREFETCH_MAX_FILES:
+                    return None
+                self.n_files += 1
+            fetch = (
+                _fetch_file_contents if kind == "file" else _fetch_directory_contents
+            )
+            try:
+                future = self.executor.submit(fetch, self.api_url, path, ref=self.ref)
+            except RuntimeError:
+                # stopped
+                return None
+            self.futures[(kind, path)] = future
+            return future
+
+    def schedule_directory(self, directory: str, depth: int):
+        future = self.schedule("dir", directory)
+        if future is not None:
+            # chained rather than waited on, so that workers are never blocked
+            future.add_done_callback(lambda f: self.discover(directory, depth, f))
+
+    def discover(self, directory: str, depth: int, future: Future):
+        "schedule the documents of a listed directory, and the directories to search"
+        if future.cancelled() or future.exception() is not None:
+            return
+        for name, kind in future.result():
+            path = f"{directory}/{name}" if directory else name
+            if kind == "file" and self.wanted(path, depth):
+                self.schedule("file", path)
+            elif kind == "dir" and self.search(path, depth):
+                self.schedule_directory(path, depth + 1)
+
+    @staticmethod
+    def wanted(path: str, depth: int) -> bool:
+        name = os.path.basename(path).lower()
+        if depth == 0:
+            return any(fnmatch(name, pattern) for pattern in PREFETCH_FILE_PATTERNS)
+        if any(fnmatch(path.lower(), pattern) for pattern in PREFETCH_DIR_PATTERNS):
+            return True
+        return "install" in name
+
+    @staticmethod
+    def search(path: str, depth: int) -> bool:
+        top = path.split("/")[0].lower()
+        if top == ".github":
+            return path.lower() in (".github", ".github/workflows")
+        return top in PREFETCH_DOCS_DIRS and depth < PREFETCH_DOCS_DEPTH
+
+    def result(self, kind: str, path: str) -> Optional[Any]:
+        "the prefetched contents of a path, waiting for them if needed"
+        with self.lock:
+            future = self.futures.get((kind, path))
+        if future is None:
+            return None
+        try:
+            contents = future.result()
+        except Exception:
+            return None
+        with self.lock:
+            self.hits += 1
+        return contents
+
+    def stop(self):
+        set_prefetcher(self.api_url, self.ref, None)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {"prefetched_files": self.n_files, "hits": self.hits}
+
+
+def start_prefetch(api_url: str, ref: Optional[str] = None) -> Optional[Prefetcher]:
+    """
+    start prefetching the documents of the repo at ref,
+    or return None if contents are read from a local clone anyway.
+    """
+    if functions.BACKEND == "local":
+        return None
+    prefetcher = Prefetcher(api_url, ref)
+    set_prefetcher(api_url, ref, prefetcher)
+    return prefetcher.start()
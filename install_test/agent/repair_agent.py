@@ -1,8 +1,13 @@
-import json
+import asyncio
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Any, Dict, List, Literal, Optional, Tuple
 
 from install_test.agent.agent import Agent
+from install_test.agent.async_agent import AsyncAgent
+from install_test.agent.fix_cache import FixCache, key_signatures
 from install_test.agent.functions import _get_directory_contents, get_api_url
 from install_test.agent.functions_json import (
     FUNC_DIR,
@@ -19,13 +24,14 @@ from install_test.consts import (
     DOCKERFILE_REPAIR_PROMPT_PATH,
     DOCKERFILE_REPAIR_SYSTEM_PROMPT_PATH,
 )
-from install_test.utils import notify, print_output
+from install_test.log_reduce import reduce_log
+from install_test.utils import PathList, notify, print_output
 from vm_control import VMController, test_dockerfile
 
-ERR_MESSAGE_LIMIT = 30
-
 
 class RepairAgent(Agent):
+    # shared by all repair agents, set to try fixes that worked for other repos
+    fix_cache: Optional[FixCache] = None
 
     @staticmethod
     def init_system_message(
@@ -53,6 +59,18 @@ class RepairAgent(Agent):
         super().__init__(model, system, messages, count_tokens, verbose, prev_messages)
         with open(DOCKERFILE_REPAIR_HINTS_PATH, "r") as f:
             self.hints = f.read()
+        # timing and cache usage of every build attempt
+        self.builds = []
+        # attempts where several candidate dockerfiles were built at once
+        self.rounds = []
+        # failing instruction of staged builds, by build log file
+        self.failures: Dict[str, Dict[str, Any]] = {}
+        # size of every build log and of the error message made from it
+        self.reductions = []
+        # builds of cached fixes tried before asking the model for a repair
+        self.fix_rounds = []
+        # the dockerfile of the most recent attempt
+        self.dockerfile: Optional[str] = None
 
     def repair_dockerfile(
         self,
@@ -61,32 +79,27 @@ class RepairAgent(Agent):
         repo_name: str,
         n_tries: int = 2,
         ref: Optional[str] = None,
+        alternatives: Optional[List[str]] = None,
     ) -> Tuple[Literal["success", "failure", "insufficient"], int]:
-
-        build_logs_dir = "logs/build_logs"
-        for file in os.listdir(build_logs_dir):
-            if repo_name in file:
-                os.remove(os.path.join(build_logs_dir, file))
+        self.start_repair(repo_name)
         n = 0
-        build_logs = os.path.join(build_logs_dir, f"{repo_name}-N{n}.log")
-        vmc = VMController(build_logs)
-        build_success = test_dockerfile(url, dockerfile, repo_name, vmc=vmc, ref=ref)
+        dockerfiles = [dockerfile] + (alternatives or [])
+        chosen, build_success, build_logs = self.build_candidates(
+            url, dockerfiles, repo_name, n, ref
+        )
+        self.dockerfile = dockerfiles[chosen]
 
         if not build_success:
-            root_dir = "\n".join(
-                [
-                    str(tup)
-                    for tup in _get_directory_contents(
-                        get_api_url(url), exclude_pyproject=False
-                    )
-                ]
-            )
-            self.hints = self.hints.replace("<ROOT_DIRECTORY>", root_dir)
-            with open(DOCKERFILE_REPAIR_PROMPT_PATH, "r") as f:
-                repair_prompt = f.read().replace("<REPAIR_HINTS>", self.hints)
+            repair_prompt = self.repair_prompt(url)
         while not build_success and n < n_tries:
             notify(f"BUILD {n} FAILED, ATTEMPTING REPAIR")
             err_msg = self.get_err_msg(build_logs)
+            if self.cached_fix(url, repo_name, n, ref):
+                # a patched dockerfile passed, which counts as a repair
+                n += 1
+                build_success = True
+                break
+            failed, start = self.dockerfile, time.time()
 
             # Check if fixable
             self.diagnosis(err_msg, url, ref=ref)
@@ -95,52 +108,312 @@ class RepairAgent(Agent):
             response = self.query(repair_prompt, tools=None)
 
             # Submit repaired dockerfile
-            response = self.query("", tools=[FUNC_DOCKERFILE])
-            self.confirm_tool(response)
-            dockerfile = str(
-                json.loads(response["function"]["arguments"])["dockerfile"]
-            )
+            if self.n_candidates > 1:
+                candidates = self.query_candidates(
+                    "", [FUNC_DOCKERFILE], self.n_candidates
+                )
+            else:
+                candidates = [self.query("", tools=[FUNC_DOCKERFILE])]
             n += 1
-            build_logs = f"logs/build_logs/{repo_name}-N{n}.log"
-            vmc = VMController(build_logs)
-            build_success = test_dockerfile(
-                url, dockerfile, repo_name, vmc=vmc, ref=ref
+            build_success, build_logs = self.repair_candidates(
+                url, candidates, repo_name, n, ref
             )
+            if build_success:
+                self.remember_fix(failed, time.time() - start)
 
         if not build_success:
             err_msg = self.get_err_msg(build_logs)
             return "failure", n
         return "success", n
 
-    def get_err_msg(self, build_logs: str):
+    def start_repair(self, repo_name: str):
+        "remove the build logs of previous repair sessions of the repo"
+        self.phase = "repair"
+
+        build_logs_dir = "logs/build_logs"
+        for file in os.listdir(build_logs_dir):
+            if file.startswith(f"{repo_name}-N"):
+                os.remove(os.path.join(build_logs_dir, file))
+
+    def build(
+        self,
+        url: str,
+        dockerfile: str,
+        repo_name: str,
+        n: int,
+        ref: Optional[str] = None,
+        candidate: Optional[int] = None,
+        cancel: Optional[threading.Event] = None,
+        label: str = "C",
+    ) -> Tuple[bool, str]:
+        """
+        build attempt n of the dockerfile, returns whether it passed and its log file.
+        Candidates are labelled C, and cached fixes F.
+        """
+        suffix = f"-{label}{candidate}" if candidate is not None else ""
+        build_logs = os.path.join("logs/build_logs", f"{repo_name}-N{n}{suffix}.log")
+        vmc = VMController(build_logs, cancel=cancel)
+        build_success = test_dockerfile(
+            url, dockerfile, f"{repo_name}{suffix}", vmc=vmc, ref=ref
+        )
+        self.record_build(vmc, n, candidate, label)
+        failure = (vmc.last_build or {}).get("failure")
+        if failure is not None:
+            self.failures[build_logs] = failure
+        return build_success, build_logs
+
+    def build_candidates(
+        self,
+        url: str,
+        dockerfiles: List[str],
+        repo_name: str,
+        n: int,
+        ref: Optional[str] = None,
+        label: str = "C",
+    ) -> Tuple[int, bool, str]:
+        """
+        build attempt n of every candidate dockerfile at the same time,
+        stopping the other builds as soon as one passes.
+        Returns the index of the passing candidate, or of the first one if none
+        passed, whether it passed, and its log file.
+        """
+        if len(dockerfiles) == 1 and label == "C":
+            return (0,) + self.build(url, dockerfiles[0], repo_name, n, ref)
+        start = time.time()
+        cancel = threading.Event()
+        results: Dict[int, Tuple[bool, str]] = {}
+        winner = None
+        with ThreadPoolExecutor(max_workers=len(dockerfiles)) as executor:
+            futures = {
+                executor.submit(
+                    self.build, url, dockerfile, repo_name, n, ref, i, cancel, label
+                ): i
+                for i, dockerfile in enumerate(dockerfiles)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i] = future.result()
+                if results[i][0] and winner is None:
+                    winner = i
+                    notify(f"CANDIDATE {i} PASSED, CANCELLING THE OTHER BUILDS")
+                    cancel.set()
+        self.record_round(n, len(dockerfiles), winner, time.time() - start, label)
+        chosen = winner if winner is not None else 0
+        return (chosen,) + results[chosen]
+
+    def repair_candidates(
+        self,
+        url: str,
+        candidates: List[Dict[str, Any]],
+        repo_name: str,
+        n: int,
+        ref: Optional[str] = None,
+    ) -> Tuple[bool, str]:
+        "build the repaired dockerfiles, continuing the conversation with the best one"
+        dockerfiles = self.candidate_dockerfiles(candidates)
+        chosen, build_success, build_logs = self.build_candidates(
+            url, dockerfiles, repo_name, n, ref
+        )
+        self.dockerfile = dockerfiles[chosen]
+        if self.n_candidates > 1:
+            self.accept_candidate(candidates[chosen])
+        self.confirm_tool(candidates[chosen])
+        return build_success, build_logs
+
+    def cached_fix(
+        self, url: str, repo_name: str, n: int, ref: Optional[str] = None
+    ) -> bool:
+        """
+        build the cached fixes for the errors of the last failed build at once,
+        returns whether one passed, in which case it becomes the dockerfile.
+        """
+        if self.fix_cache is None or self.dockerfile is None:
+            return False
+        signatures = self.reductions[-1]["signature"]
+        fixes = self.fix_cache.lookup(signatures, self.dockerfile)
+        if len(fixes) == 0:
+            return False
+        notify(f"TRYING {len(fixes)} CACHED FIX(ES) BEFORE REPAIR")
+        start = time.time()
+        chosen, passed, _ = self.build_candidates(
+            url, [patched for _, patched in fixes], repo_name, n, ref, label="F"
+        )
+        seconds = time.time() - start
+        builds = {
+            build["candidate"]: build
+            for build in self.builds
+            if build["attempt"] == n and build["label"] == "F"
+        }
+        saved = 0.0
+        for i, (fix, _) in enumerate(fixes):
+            # builds stopped because another fix passed say nothing about this one
+            if not builds.get(i, {}).get("cancelled"):
+                saved += self.fix_cache.record_use(
+                    fix, repo_name, passed and i == chosen, seconds
+                )
+        self.fix_rounds.append(
+            {
+                "attempt": n,
+                "signatures": key_signatures(signatures),
+                "fixes": [fix for fix, _ in fixes],
+                "passed": passed,
+                "fix": fixes[chosen][0] if passed else None,
+                "seconds": seconds,
+                "saved": saved,
+            }
+        )
+        if passed:
+            self.dockerfile = fixes[chosen][1]
+        return passed
+
+    def remember_fix(self, failed: str, seconds: float):
+        "cache the change from the failed dockerfile that made the build pass"
+        if self.fix_cache is not None:
+            self.fix_cache.store(
+                self.reductions[-1]["signature"], failed, self.dockerfile, seconds
+            )
+
+    def repair_prompt(self, url: str) -> str:
+        root_dir = "\n".join(
+            [
+                str(tup)
+                for tup in _get_directory_contents(
+                    get_api_url(url), exclude_pyproject=False
+                )
+            ]
+        )
+        self.hints = self.hints.replace("<ROOT_DIRECTORY>", root_dir)
+        with open(DOCKERFILE_REPAIR_PROMPT_PATH, "r") as f:
+            return f.read().replace("<REPAIR_HINTS>", self.hints)
+
+    def record_build(
+        self,
+        vmc: VMController,
+        n: int,
+        candidate: Optional[int] = None,
+        label: str = "C",
+    ):
+        build = vmc.last_build or {}
+        duration = build.get("duration")
+        first = self.builds[0]["duration"] if len(self.builds) > 0 else None
+        self.builds.append(
+            {
+                "attempt": n,
+                "candidate": candidate,
+                "label": label,
+                "cancelled": vmc.cancelled,
+                "passed": build.get("passed", False),
+                "cached": build.get("cached"),
+                "n_cached_steps": build.get("n_cached_steps"),
+                "duration": duration,
+                "cached_duration": build.get("cached_duration"),
+                "disk_used": build.get("disk_used"),
+                "failed_line": (build.get("failure") or {}).get("line"),
+                "exit_code": (build.get("failure") or {}).get("exit_code"),
+                # relative to the first build of this repair session
+                "speedup": first / duration if first and duration else None,
+            }
+        )
+
+    def record_round(
+        self,
+        n: int,
+        n_candidates: int,
+        winner: Optional[int],
+        wall: float,
+        label: str = "C",
+    ):
+        builds = {
+            build["candidate"]: build
+            for build in self.builds
+            if build["attempt"] == n and build["label"] == label
+        }
+        # time to the same result building the candidates one after another,
+        # unknown if a build that would have been needed was cancelled
+        serial = 0.0
+        for i in range(n_candidates if winner is None else winner + 1):
+            build = builds.get(i, {})
+            if build.get("cancelled") or build.get("duration") is None:
+                serial = None
+                break
+            serial += build["duration"]
+        self.rounds.append(
+            {
+                "attempt": n,
+                "label": label,
+                "candidates": n_candidates,
+                "winner": winner,
+                "wall": wall,
+                "serial_wall": serial,
+            }
+        )
+
+    def get_err_msg(self, build_logs: str) -> str:
+        "the errors of a failed build, extracted from its log without the noise"
         with open(build_logs, "r") as f:
-            log = f.readlines()
-        sections = [i for i, l in enumerate(log) if set(l.strip()) == {"-"}]
-        if len(sections) >= 4:
-            err_msg = "\n".join(log[sections[-4] :])
+            log = f.read()
+        failure = self.failures.get(build_logs)
+        if failure is not None:
+            reduced = reduce_log(failure["excerpt"])
+            err_msg = self.failure_msg(failure, reduced["text"])
         else:
-            err_msg = "\n".join(log[-ERR_MESSAGE_LIMIT:])
+            reduced = reduce_log(log)
+            err_msg = reduced["text"]
+        self.reductions.append(
+            {
+                "log_chars": len(log),
+                "err_chars": len(err_msg),
+                "ratio": len(err_msg) / len(log) if len(log) > 0 else 1.0,
+                "signature": reduced["signature"],
+            }
+        )
         return err_msg
 
+    @staticmethod
+    def failure_msg(failure: Dict[str, Any], output: str) -> str:
+        "error message of a staged build, from the instruction that failed"
+        return (
+            f"Step {failure['step']} failed, "
+            f"on line {failure['line']} of the dockerfile:\n"
+            f"{failure['instruction']}\n"
+            f"exit code: {failure['exit_code']}\n"
+            f"error: {failure['error']}\n"
+            f"errors in the output of the step:\n{output}"
+        )
+
     def diagnosis(self, err_msg: str, url: str, ref: Optional[str] = None):
-        root_dir = [
-            tup
-            for tup in _get_directory_contents(
-                get_api_url(url), exclude_pyproject=False, ref=ref
-            )
-        ]
+        self.query(
+            self.diagnosis_prompt(err_msg),
+            tools=None,
+        )
+        search_prompt, loop_args = self.search_setup(url, ref)
+        response, response_class = self.query_then_tool(
+            search_prompt, loop_args["tools"]
+        )
+        response = self.tool_loop(
+            response=response, response_class=response_class, **loop_args
+        )
 
+        self.confirm_tool(response)
+
+    def diagnosis_prompt(self, err_msg: str) -> str:
         with open(DOCKERFILE_DIAGNOSIS_PROMPT_PATH, "r") as f:
-            diagnosis_prompt = (
+            return (
                 f.read()
                 .replace("<ERROR_LOG>", err_msg)
                 .replace("<REPAIR_HINTS>", self.hints)
             )
-        self.query(
-            diagnosis_prompt,
-            tools=None,
-        )
 
+    def search_setup(
+        self, url: str, ref: Optional[str] = None
+    ) -> Tuple[str, Dict[str, Any]]:
+        "prompt to start the search for the cause of a failure, and the tool loop arguments"
+        root_dir = [
+            tup
+            for tup in _get_directory_contents(
+                get_api_url(url), exclude_pyproject=False, ref=ref
+            )
+        ]
         tools = [FUNC_DIR, FUNC_FILE, FUNC_PRESENCE, FUNC_READY_TO_FIX]
         tool_names = [tool["function"]["name"] for tool in tools]
         with open(DOCKERFILE_FAILURE_PROMPT_PATH, "r") as f:
@@ -152,12 +425,6 @@ class RepairAgent(Agent):
                     ", ".join(tool_names),
                 )
             )
-        followup = search_prompt
-        response, response_class = self.query_then_tool(followup, tools)
-        directories = [i[0] for i in root_dir if i[1] == "dir"] + [".", "/"]
-        files = [i[0] for i in root_dir if i[1] == "file"]
-        file_contents = {}
-
         with open(DOCKERFILE_FAILURE_FOLLOWUP_PROMPT_PATH, "r") as f:
             followup = (
                 f.read()
@@ -167,18 +434,84 @@ class RepairAgent(Agent):
                     ", ".join(tool_names),
                 )
             )
+        return search_prompt, {
+            "exit_func": FUNC_READY_TO_FIX["function"]["name"],
+            "directories": PathList(
+                [i[0] for i in root_dir if i[1] == "dir"] + [".", "/"]
+            ),
+            "files": PathList([i[0] for i in root_dir if i[1] == "file"]),
+            "file_contents": {},
+            "tools": tools,
+            "api_url": get_api_url(url),
+            "followup": followup,
+            "ref": ref,
+        }
 
-        response = self.tool_loop(
-            response=response,
-            response_class=response_class,
-            exit_func=FUNC_READY_TO_FIX["function"]["name"],
-            directories=directories,
-            files=files,
-            file_contents=file_contents,
-            tools=tools,
-            api_url=get_api_url(url),
-            followup=followup,
-            ref=ref,
+
+class AsyncRepairAgent(AsyncAgent, RepairAgent):
+
+    async def arepair_dockerfile(
+        self,
+        url: str,
+        dockerfile: str,
+        repo_name: str,
+        n_tries: int = 2,
+        ref: Optional[str] = None,
+        alternatives: Optional[List[str]] = None,
+    ) -> Tuple[Literal["success", "failure", "insufficient"], int]:
+        self.start_repair(repo_name)
+        n = 0
+        dockerfiles = [dockerfile] + (alternatives or [])
+        # builds block on the build worker, so they run off the loop
+        chosen, build_success, build_logs = await asyncio.to_thread(
+            self.build_candidates, url, dockerfiles, repo_name, n, ref
+        )
+        self.dockerfile = dockerfiles[chosen]
+
+        if not build_success:
+            repair_prompt = await asyncio.to_thread(self.repair_prompt, url)
+        while not build_success and n < n_tries:
+            notify(f"BUILD {n} FAILED, ATTEMPTING REPAIR")
+            err_msg = self.get_err_msg(build_logs)
+            if await asyncio.to_thread(self.cached_fix, url, repo_name, n, ref):
+                # a patched dockerfile passed, which counts as a repair
+                n += 1
+                build_success = True
+                break
+            failed, start = self.dockerfile, time.time()
+
+            await self.adiagnosis(err_msg, url, ref=ref)
+
+            await self.aquery(repair_prompt, tools=None)
+
+            if self.n_candidates > 1:
+                candidates = await self.aquery_candidates(
+                    "", [FUNC_DOCKERFILE], self.n_candidates
+                )
+            else:
+                candidates = [await self.aquery("", tools=[FUNC_DOCKERFILE])]
+            n += 1
+            build_success, build_logs = await asyncio.to_thread(
+                self.repair_candidates, url, candidates, repo_name, n, ref
+            )
+            if build_success:
+                self.remember_fix(failed, time.time() - start)
+
+        if not build_success:
+            return "failure", n
+        return "success", n
+
+    async def adiagnosis(self, err_msg: str, url: str, ref: Optional[str] = None):
+        await self.aquery(
+            self.diagnosis_prompt(err_msg),
+            tools=None,
+        )
+        search_prompt, loop_args = await asyncio.to_thread(self.search_setup, url, ref)
+        response, response_class = await self.aquery_then_tool(
+            search_prompt, loop_args["tools"]
+        )
+        response = await self.atool_loop(
+            response=response, response_class=response_class, **loop_args
         )
 
         self.confirm_tool(response)
@@ -0,0 +1,203 @@
+import re
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# from the newline before a line: an atx heading, a setext underline,
+# or a whole fenced code block, unclosed ones running to the end of the text
+MARKDOWN_TOKEN = re.compile(
+    r"\n[ ]{0,3}(?:"
+    r"(#{1,6})(?=[ \t\r\n]|\Z)"
+    r"|(=+|-+)[ \t]*(?=\r?\n|\Z)"
+    r"|(`{3,}|~{3,})(?:[^\n]*\n(?:[^\n]*\n)*?[ ]{0,3}\3[`~]*[ \t]*(?=\r?\n|\Z)|[\s\S]*)"
+    r")"
+)
+# a line made of a single repeated punctuation character
+RST_ADORNMENT = re.compile(r"([!-/:-@\[-`{-~])\1+[ \t]*$")
+RST_UNDERLINE = re.compile(r"\n([!-/:-@\[-`{-~])\1+[ \t]*(?=\r?\n|\Z)")
+FRONT_MATTER = {"---": "---", "+++": "+++"}
+
+
+class Section:
+    """
+    A section of a document. The content of the section is text[offset:end],
+    the heading line(s) start at `start`, and sections are nested under
+    the closest previous section with a lower level.
+    """
+
+    __slots__ = ("title", "level", "start", "offset", "end", "parent", "children")
+
+    def __init__(self, title: str, level: int, start: int, offset: int):
+        self.title = title
+        self.level = level
+        self.start = start
+        self.offset = offset
+        self.end = offset
+        self.parent: Optional[int] = None
+        self.children: List[int] = []
+
+    @property
+    def size(self) -> int:
+        return self.end - self.offset
+
+    def content(self, text: str) -> str:
+        return text[self.offset : self.end]
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "title": self.title,
+            "level": self.level,
+            "offset": self.offset,
+            "size": self.size,
+            "parent": self.parent,
+        }
+
+
+def lines(text: str, start: int = 0) -> Iterator[Tuple[int, int, str]]:
+    "(start, end, line) of every line, where end includes the newline"
+    length = len(text)
+    while start < length:
+        end = text.find("\n", start)
+        end = length if end < 0 else end + 1
+        yield start, end, text[start:end].rstrip("\r\n")
+        start = end
+
+
+def front_matter_end(text: str) -> int:
+    "offset of the end of the yaml or toml front matter, 0 if there is none"
+    first = text[: text.find("\n")].strip() if "\n" in text else ""
+    if first not in FRONT_MATTER:
+        return 0
+    for start, end, line in lines(text, len(first) + 1):
+        if line.strip() == FRONT_MATTER[first]:
+            return end
+    return 0
+
+
+class SectionParser:
+    "builds the section tree of a document while reading it line by line"
+
+    def __init__(self, text: str):
+        self.text = text
+        offset = front_matter_end(text)
+        self.sections = [Section("", 0, offset, offset)]
+        self.parents: List[int] = []
+
+    def open(self, title: str, level: int, start: int, offset: int):
+        "start a new section whose heading begins at start and content at offset"
+        self.sections[-1].end = start
+        section = Section(title.strip(), level, start, offset)
+        while len(self.parents) > 0 and self.sections[self.parents[-1]].level >= level:
+            self.parents.pop()
+        if len(self.parents) > 0:
+            section.parent = self.parents[-1]
+            self.sections[section.parent].children.append(len(self.sections))
+        self.parents.append(len(self.sections))
+        self.sections.append(section)
+
+    def close(self) -> List[Section]:
+        self.sections[-1].end = len(self.text)
+        if len(self.sections) == 1:
+            return []
+        preamble = self.sections[0]
+        if self.text[preamble.offset : preamble.end].strip() == "":
+            # no content before the first heading
+            sections = self.sections[1:]
+            for section in sections:
+                section.parent = None if section.parent is None else section.parent - 1
+                section.children = [child - 1 for child in section.children]
+            return sections
+        return self.sections
+
+
+def line_tokens(
+    pattern: re.Pattern, text: str, offset: int
+) -> Iterator[Tuple[int, re.Match]]:
+    """
+    matches of a pattern starting with a newline, with the start of their line,
+    for lines from offset. Searching from the newline before lines is much faster
+    than anchoring with ^, and the first line is given one.
+    """
+    padded, shift = (text, 0) if offset > 0 else ("\n" + text, 1)
+    for match in pattern.finditer(padded, max(offset - 1, 0)):
+        yield match.start() + 1 - shift, match
+
+
+def atx_title(line: str, level: int) -> str:
+    "the title of an atx heading line, without its optional closing #s"
+    title = line.strip()[level:].strip()
+    closed = title.rstrip("#")
+    if closed == "" or closed[-1] in " \t":
+        return closed.strip()
+    return title
+
+
+def parse_markdown(text: str) -> List[Section]:
+    """
+    sections of a markdown document in one pass over it,
+    with atx (#) and setext (underlined) headings, skipping fenced code blocks.
+    Fenced blocks are matched whole, so only heading lines reach python.
+    """
+    parser = SectionParser(text)
+    # end of the previous heading, underline or fenced block
+    last = -1
+    for start, match in line_tokens(MARKDOWN_TOKEN, text, parser.sections[0].offset):
+        if match.lastindex == 3:
+            last = start + len(match.group(0)) - 1
+            continue
+        end = text.find("\n", start)
+        end = len(text) if end < 0 else end + 1
+        if match.lastindex == 1:
+            level = len(match.group(1))
+            parser.open(atx_title(text[start:end], level), level, start, end)
+            last = end - 1
+        elif start > 0 and last != start - 1:
+            # the text of a setext heading is the paragraph line above it
+            above = text.rfind("\n", 0, start - 1) + 1
+            title = text[above:start].rstrip("\r\n")
+            if title.strip() != "" and not title.startswith(("    ", "\t")):
+                level = 1 if match.group(2)[0] == "=" else 2
+                parser.open(title, level, above, end)
+                last = end - 1
+    return parser.close()
+
+
+def parse_rst(text: str) -> List[Section]:
+    """
+    sections of a restructuredtext document in one pass over it,
+    with titles underlined, or over and underlined, by punctuation characters.
+    Levels follow the order in which the adornment styles first appear.
+    """
+    parser = SectionParser(text)
+    styles: List[Tuple[str, bool]] = []
+    # end of the previous heading
+    last = -1
+    for start, match in line_tokens(RST_UNDERLINE, text, parser.sections[0].offset):
+        if start == 0 or last == start - 1:
+            continue
+        end = text.find("\n", start)
+        end = len(text) if end < 0 else end + 1
+        above = text.rfind("\n", 0, start - 1) + 1
+        title = text[above:start].rstrip("\r\n")
+        if (
+            title.strip() == ""
+            or title[0].isspace()
+            or RST_ADORNMENT.match(title) is not None
+        ):
+            continue
+        heading_start = text.rfind("\n", 0, above - 1) + 1 if above > 0 else above
+        overline = (
+            heading_start < above
+            and text[heading_start:above].strip() == text[start:end].strip()
+        )
+        style = (match.group(1), overline)
+        if style not in styles:
+            styles.append(style)
+        parser.open(
+            title, styles.index(style) + 1, heading_start if overline else above, end
+        )
+        last = end - 1
+    return parser.close()
+
+
+def parse_sections(text: str, rst: bool = False) -> List[Section]:
+    "sections of a document, or an empty list if it has no headings"
+    return parse_rst(text) if rst else parse_markdown(text)
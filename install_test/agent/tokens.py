@@ -0,0 +1,80 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class TokenLedger:
+    """
+    Counts the tokens of each message once, when it is added to a conversation,
+    and the input/output tokens of every call to the model, grouped by phase.
+    Token counts reported by the api are used instead of estimates when available.
+    """
+
+    def __init__(self, encoder) -> None:
+        self.encoder = encoder
+        # tokens in the conversation so far, i.e. the size of the next request
+        self.running = 0
+        # tokens of each message in the conversation, in order
+        self.sizes: List[int] = []
+        self.phases: Dict[str, Dict[str, int]] = {}
+        self._tool_tokens: Dict[Tuple[str, ...], int] = {}
+        # set while the output of the last call still needs to be estimated
+        self._estimate_out: Optional[str] = None
+
+    def count(self, text: str) -> int:
+        return len(self.encoder.encode(text))
+
+    def tool_tokens(self, tools: List[Dict[str, Any]]) -> int:
+        "tokens of a set of tool schemas, only encoded the first time it is seen"
+        key = tuple(tool["function"]["name"] for tool in tools)
+        if key not in self._tool_tokens:
+            self._tool_tokens[key] = self.count(json.dumps(tools))
+        return self._tool_tokens[key]
+
+    def message_tokens(self, message: Dict[str, Any]) -> int:
+        tokens = self.count(message["role"])
+        if isinstance(message.get("content"), str):
+            tokens += self.count(message["content"])
+        if message.get("tool_calls"):
+            tokens += self.count(
+                json.dumps([call["function"] for call in message["tool_calls"]])
+            )
+        if message.get("tools"):
+            tokens += self.tool_tokens(message["tools"])
+        return tokens
+
+    def phase(self, phase: str) -> Dict[str, int]:
+        if phase not in self.phases:
+            self.phases[phase] = {"in": 0, "out": 0, "calls": 0}
+        return self.phases[phase]
+
+    def add(self, message: Dict[str, Any]):
+        "count a message that has just been added to the conversation"
+        tokens = self.message_tokens(message)
+        self.sizes.append(tokens)
+        self.running += tokens
+        if message["role"] == "assistant" and self._estimate_out is not None:
+            self.phase(self._estimate_out)["out"] += tokens
+            self._estimate_out = None
+
+    def record_call(self, phase: str, usage: Optional[Any] = None, saved: int = 0):
+        """
+        count a call to the model, using the usage reported by the api if given.
+        `saved` is the number of tokens left out of the request by compaction.
+        """
+        counts = self.phase(phase)
+        counts["calls"] += 1
+        if usage is not None:
+            counts["in"] += usage.prompt_tokens
+            counts["out"] += usage.completion_tokens
+            self._estimate_out = None
+        else:
+            counts["in"] += self.running - saved
+            self._estimate_out = phase
+
+    @property
+    def in_tokens(self) -> int:
+        return sum(counts["in"] for counts in self.phases.values())
+
+    @property
+    def out_tokens(self) -> int:
+        return sum(counts["out"] for counts in self.phases.values())
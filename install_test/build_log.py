@@ -0,0 +1,265 @@
+import re
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+# number of lines kept from the end of the build output
+TAIL_SIZE = 30
+# number of lines of output of the failing step kept for the diagnosis
+EXCERPT_SIZE = 40
+
+# `Step 3/7 : RUN ...` (legacy builder) or `#7 [3/7] RUN ...` (buildkit)
+STEP_PATTERN = re.compile(r"^(?:Step \d+/\d+ : |#\d+ \[[^\]]*\d+/\d+\] )(.*)$")
+FATAL_PATTERNS = [
+    re.compile(r"ERROR: failed to solve"),
+    re.compile(r"did not complete successfully: exit code: \d+"),
+    re.compile(r"returned a non-zero code: \d+"),
+    re.compile(r"pull access denied|manifest unknown|not found: manifest"),
+    re.compile(r"failed to compute cache key"),
+    re.compile(r"Cannot connect to the Docker daemon"),
+]
+BASE_IMAGE_PATTERN = re.compile(
+    r"pull access denied|manifest unknown|not found: manifest"
+)
+TEST_STEP_PATTERN = re.compile(r"pytest|unittest|\btox\b|\bnox\b|\btest")
+PYTEST_COUNT_PATTERN = re.compile(r"(\d+) (passed|failed|errors?)\b")
+UNITTEST_RAN_PATTERN = re.compile(r"Ran (\d+) tests? in")
+UNITTEST_FAILED_PATTERN = re.compile(r"FAILED \((.*)\)")
+# `#6 CACHED` (buildkit) or ` ---> Using cache` (legacy builder)
+CACHED_STEP_PATTERN = re.compile(r"^#\d+ CACHED|---> Using cache")
+# buildkit --progress=plain: `#7 [builder 3/6] RUN ...` starts the step of vertex 7,
+# `#7 1.234 ...` is its output and `#7 ERROR: ...` its failure
+VERTEX_STEP_PATTERN = re.compile(r"^#(\d+) \[(?:(\S+) )?(\d+)/(\d+)\] (.*)$")
+VERTEX_OUTPUT_PATTERN = re.compile(r"^#(\d+) \d+\.\d+ (.*)$")
+VERTEX_ERROR_PATTERN = re.compile(r"^#(\d+) ERROR: (.*)$")
+EXIT_CODE_PATTERN = re.compile(r"exit code: (\d+)")
+ESCAPE_DIRECTIVE_PATTERN = re.compile(r"^#\s*escape\s*=\s*(\S)\s*$", re.IGNORECASE)
+
+
+def parse_dockerfile(dockerfile: str) -> List[Dict[str, Any]]:
+    """
+    instructions of a dockerfile, with continued lines joined, the line they
+    start on, and their stage and position in it as counted by buildkit.
+    """
+    instructions = []
+    escape = "\\"
+    stages: List[Optional[str]] = []
+    parts: Optional[List[str]] = None
+    start = 0
+    for i, line in enumerate(dockerfile.split("\n"), 1):
+        stripped = line.strip()
+        directive = ESCAPE_DIRECTIVE_PATTERN.match(stripped)
+        if directive is not None and len(instructions) == 0 and parts is None:
+            escape = directive.group(1)
+            continue
+        if stripped.startswith("#") or (parts is None and stripped == ""):
+            continue
+        if parts is None:
+            parts, start = [], i
+        if stripped.endswith(escape):
+            parts.append(stripped[: -len(escape)].strip())
+            continue
+        parts.append(stripped)
+        text = " ".join(part for part in parts if part != "")
+        parts = None
+        keyword = text.split(None, 1)[0].upper()
+        if keyword == "FROM":
+            words = text.split()
+            alias = words[-1] if len(words) >= 4 and words[-2].upper() == "AS" else None
+            stages.append(alias)
+        instructions.append(
+            {
+                "line": start,
+                "keyword": keyword,
+                "instruction": text,
+                "stage": len(stages) - 1,
+                "stage_name": stages[-1] if len(stages) > 0 else None,
+                "step": sum(1 for x in instructions if x["stage"] == len(stages) - 1)
+                + 1,
+            }
+        )
+    return instructions
+
+
+class BuildLogAnalyzer:
+    """
+    Inspects the output of a docker build one line at a time as it arrives,
+    keeping track of passed tests, out of storage errors and the failing step.
+    """
+
+    def __init__(self, tail_size: int = TAIL_SIZE) -> None:
+        self.tail = deque(maxlen=tail_size)
+        self.passed = False
+        self.ran = False
+        self.out_of_storage = False
+        self.fatal: Optional[str] = None
+        self.current_step: Optional[str] = None
+        self.failing_step: Optional[str] = None
+        self.n_passed = 0
+        self.n_failed = 0
+        self.n_cached_steps = 0
+        self.n_lines = 0
+
+    def feed(self, line: str) -> bool:
+        "process a line of build output, returns True if the build is doomed"
+        self.n_lines += 1
+        self.tail.append(line)
+
+        if "no space left on device" in line.lower():
+            self.out_of_storage = True
+            return True
+
+        if CACHED_STEP_PATTERN.search(line.strip()):
+            self.n_cached_steps += 1
+        step = STEP_PATTERN.match(line.strip())
+        if step is not None:
+            self.current_step = step.group(1)
+        if self.fatal is None and any(p.search(line) for p in FATAL_PATTERNS):
+            self.fatal = line.strip()
+            self.failing_step = self.current_step
+
+        self.count_tests(line)
+        # at least one test passing is taken as a successful installation
+        words = line.split()
+        if (
+            ("==" in line and " in " in line)
+            or "snapshots" in line
+            or ("tests" in line)
+        ) and "passed" in line:
+            self.passed = True
+        elif self.ran and (
+            (len(words) > 0 and words[-1] == "OK")
+            or ("(" in line and line.split("(")[0].split()[-1:] == ["OK"])
+        ):
+            self.passed = True
+        elif "Ran" in line and "tests in" in line:
+            self.ran = True
+        return False
+
+    def count_tests(self, line: str):
+        if "==" in line and " in " in line:
+            for count, outcome in PYTEST_COUNT_PATTERN.findall(line):
+                if outcome == "passed":
+                    self.n_passed += int(count)
+                else:
+                    self.n_failed += int(count)
+        ran = UNITTEST_RAN_PATTERN.search(line)
+        if ran is not None:
+            self.n_passed += int(ran.group(1))
+        failed = UNITTEST_FAILED_PATTERN.search(line)
+        if self.ran and failed is not None:
+            n_failed = sum(int(n) for n in re.findall(r"=(\d+)", failed.group(1)))
+            self.n_failed += n_failed
+            self.n_passed = max(self.n_passed - n_failed, 0)
+
+    @property
+    def failure_stage(self) -> Optional[str]:
+        if self.out_of_storage:
+            return "storage"
+        if self.fatal is None:
+            return None
+        if BASE_IMAGE_PATTERN.search(self.fatal) or (
+            self.failing_step is not None and self.failing_step.startswith("FROM")
+        ):
+            return "base_image"
+        if self.failing_step is not None and TEST_STEP_PATTERN.search(
+            self.failing_step
+        ):
+            return "test"
+        return "build"
+
+    def result(self) -> Dict[str, Any]:
+        "structured summary of the build output seen so far"
+        # lines near the end that mention passing tests also count
+        passed = self.passed or any("passed" in line for line in self.tail)
+        return {
+            "passed": passed,
+            "n_passed": self.n_passed,
+            "n_failed": self.n_failed,
+            "out_of_storage": self.out_of_storage,
+            "failure_stage": None if passed else self.failure_stage,
+            "failing_step": self.failing_step,
+            "fatal": self.fatal,
+            "n_cached_steps": self.n_cached_steps,
+            "n_lines": self.n_lines,
+            "tail": "".join(self.tail),
+        }
+
+
+class StagedBuildAnalyzer(BuildLogAnalyzer):
+    """
+    Analyzer for buildkit builds run with --progress=plain, following which
+    instruction of the dockerfile every step of the build is running.
+    The build is stopped as soon as a step fails, and the failing instruction,
+    its exit code and the end of its output are kept for the diagnosis.
+    """
+
+    def __init__(self, dockerfile: str, tail_size: int = TAIL_SIZE) -> None:
+        super().__init__(tail_size)
+        self.instructions = parse_dockerfile(dockerfile)
+        # vertex id to the instruction it runs and its recent output
+        self.vertices: Dict[str, Dict[str, Any]] = {}
+        self.failure: Optional[Dict[str, Any]] = None
+
+    def instruction(
+        self, stage_name: Optional[str], step: int, text: str
+    ) -> Optional[Dict[str, Any]]:
+        "the parsed instruction run by a step, found by its text and position"
+        text = " ".join(text.split())
+        matches = [
+            x for x in self.instructions if " ".join(x["instruction"].split()) == text
+        ]
+        for x in matches:
+            if x["step"] == step:
+                return x
+        if len(matches) > 0:
+            return matches[0]
+        # buildkit names stages by their alias, or by their index if they have none
+        for x in self.instructions:
+            if x["step"] == step and stage_name in (x["stage_name"], str(x["stage"])):
+                return x
+        steps = [x for x in self.instructions if x["step"] == step]
+        return steps[-1] if len(steps) > 0 else None
+
+    def feed(self, line: str) -> bool:
+        doomed = super().feed(line)
+        stripped = line.rstrip("\r\n")
+        output = VERTEX_OUTPUT_PATTERN.match(stripped)
+        if output is not None:
+            if output.group(1) in self.vertices:
+                self.vertices[output.group(1)]["output"].append(output.group(2))
+            return doomed
+        step = VERTEX_STEP_PATTERN.match(stripped)
+        if step is not None:
+            vertex, stage_name, n, total, text = step.groups()
+            self.vertices[vertex] = {
+                "step": f"{n}/{total}",
+                "text": text,
+                "instruction": self.instruction(stage_name, int(n), text),
+                "output": deque(maxlen=EXCERPT_SIZE),
+            }
+            return doomed
+        error = VERTEX_ERROR_PATTERN.match(stripped)
+        if error is not None and error.group(1) in self.vertices:
+            if self.failure is None:
+                vertex = self.vertices[error.group(1)]
+                exit_code = EXIT_CODE_PATTERN.search(error.group(2))
+                instruction = vertex["instruction"] or {}
+                self.failure = {
+                    "instruction": instruction.get("instruction", vertex["text"]),
+                    "line": instruction.get("line"),
+                    "step": vertex["step"],
+                    "exit_code": (
+                        int(exit_code.group(1)) if exit_code is not None else None
+                    ),
+                    "error": error.group(2),
+                    "excerpt": "\n".join(vertex["output"]),
+                }
+                self.failing_step = vertex["text"]
+                self.fatal = self.fatal or error.group(2)
+            return True
+        return doomed
+
+    def result(self) -> Dict[str, Any]:
+        result = super().result()
+        result["failure"] = None if result["passed"] else self.failure
+        return result
@@ -5,6 +5,19 @@ DOCKERFILE_STEP = True
 
 # model hparams
 PER_MESSAGE_TOKEN_LIMIT = 10_000
+## number of most recent tool outputs that are never compacted
+KEEP_LAST_TOOL_OUTPUTS = 2
+## tool calls of a single turn run at the same time
+TOOL_WORKERS = 4
+## requests to the model in flight at once over all async agents
+LLM_CONCURRENCY = 8
+## retries of a request after rate limit or connection errors
+LLM_MAX_RETRIES = 6
+## seconds before the first retry, doubled for every retry after it
+LLM_BACKOFF = 2.0
+LLM_MAX_BACKOFF = 60.0
+## alternative dockerfiles requested at once and built at the same time
+DOCKERFILE_CANDIDATES = 1
 
 CATEGORIES_PATH = "resources/python_categories_limited.json"
 REPOS_20K_GTE_PATH = "resources/dataset/tags/20k+.json"
@@ -65,6 +78,48 @@ DOCKERFILE_REPAIR_HINTS_PATH = os.path.join(
     PROMPTS_DIR, "repair", "dockerfile_repair_hints.md"
 )
 
+# repository access
+CACHE_DIR = ".cache"
+CLONE_DIR = os.path.join(CACHE_DIR, "repos")
+REPO_BACKENDS = ["api", "local"]
+GITHUB_CACHE_PATH = os.path.join(CACHE_DIR, "github_api.sqlite")
+## seconds before responses for branch refs are revalidated
+GITHUB_CACHE_TTL = 60 * 60
+## model responses, keyed by the full request
+LLM_CACHE_PATH = os.path.join(CACHE_DIR, "llm_responses.sqlite")
+LLM_CACHE_MODES = ["record", "replay", "auto"]
+## parsed documents of every (repo, ref)
+DOC_INDEX_DIR = os.path.join(CACHE_DIR, "doc_index")
+## dockerfile changes that fixed a build, keyed by the errors they fixed
+FIX_CACHE_PATH = os.path.join(CACHE_DIR, "repair_fixes.sqlite")
+## cached fixes built at once before asking the model for a repair
+FIX_CACHE_TRIES = 2
+## fixes that change more lines are too specific to their repo to be cached
+FIX_CACHE_MAX_LINES = 10
+## similarity of a dockerfile line to the line a fix was made from to apply it
+PATCH_MATCH_CUTOFF = 0.6
+## documents fetched in the background while the model searches the repo
+PREFETCH_FILE_PATTERNS = [
+    "readme*",
+    "contributing*",
+    "install*",
+    "requirements*",
+    "pyproject.toml",
+    "setup.cfg",
+    "tox.ini",
+    "makefile",
+]
+PREFETCH_DIR_PATTERNS = [".github/workflows/*.yml", ".github/workflows/*.yaml"]
+## directories searched for files with install in their name
+PREFETCH_DOCS_DIRS = ["docs", "doc", "documentation"]
+PREFETCH_DOCS_DEPTH = 3
+PREFETCH_MAX_FILES = 40
+PREFETCH_WORKERS = 4
+## lists of paths matched against every path, longer ones are indexed
+PATH_INDEX_MIN_SIZE = 256
+## indexed paths sharing the most trigrams with a response that are compared to it
+PATH_INDEX_CANDIDATES = 32
+
 # misc
 DEFAULT_REPAIR_TARGET = "resources/fastapi.dockerfile"
 FASTAPI = "https://github.com/tiangolo/fastapi.git"
@@ -0,0 +1,260 @@
+import re
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+# number of lines kept from the end of the reduced output, for context
+REDUCED_TAIL_SIZE = 15
+# errors kept in the reduced output, the last ones are usually the cause
+MAX_ERRORS = 8
+# lines kept from a single error, e.g. the last frames of a traceback
+MAX_ERROR_LINES = 12
+
+ANSI_PATTERN = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+# `#7 1.234 ` before the output of a step in buildkit's plain progress output,
+# and `1.234 ` in the summary of the failing step that buildkit prints at the end
+BUILDKIT_PREFIX_PATTERN = re.compile(r"^#\d+ (?:\d+\.\d+ )?|^\d+\.\d+ ")
+NOISE_PATTERNS = [
+    # progress bars and download speeds of pip, apt, curl and docker pulls
+    re.compile(r"[━█▏▎▍▌▋▊▉]{3,}|\|[#=>\- ]{10,}\||\[[#=>\- ]{10,}\]"),
+    re.compile(r"\d+(?:\.\d+)? ?[kKMG]i?B/s\b|\d+(?:\.\d+)?/\d+(?:\.\d+)? ?[kMG]B\b"),
+    re.compile(r"^\s*\d{1,3}%"),
+    re.compile(
+        r"^\s*(?:Downloading|Collecting|Using cached|Requirement already satisfied"
+        r"|Obtaining|Preparing metadata|Building wheels? for|Created wheel for"
+        r"|Stored in directory|Installing collected packages|Attempting uninstall"
+        r"|Found existing installation|Uninstalling|Successfully uninstalled"
+        r"|Getting requirements to build|Installing build dependencies|Saved )"
+    ),
+    re.compile(
+        r"^\s*(?:Get:\d+|Hit:\d+|Ign:\d+|Fetched |Reading package lists"
+        r"|Building dependency tree|Reading state information|Unpacking "
+        r"|Setting up |Selecting previously unselected|Preparing to unpack"
+        r"|Processing triggers|\(Reading database|debconf: )"
+    ),
+    # buildkit bookkeeping
+    re.compile(
+        r"^#\d+ (?:DONE|CACHED|sha256:|extracting|resolve |transferring"
+        r"|naming to|writing image|exporting)"
+    ),
+    re.compile(r"^#\d+ \[internal\]|^#\d+ load (?:build|metadata|\.dockerignore)"),
+    re.compile(r"^-{3,}$|^\s*> \[[^\]]*\].*:$|^\s*\d+ \| |^\s*-{8,}$"),
+]
+# a python traceback goes on with indented lines up to the exception
+TRACEBACK_START_PATTERN = re.compile(r"Traceback \(most recent call last\):")
+PIP_ERROR_PATTERNS = [
+    re.compile(r"ERROR: (?:Could not find a version|No matching distribution)"),
+    re.compile(r"ERROR: (?:Cannot install|ResolutionImpossible|Could not build)"),
+    re.compile(r"ERROR: (?:Failed building wheel|Could not install packages)"),
+    re.compile(
+        r"ERROR: (?:Package .* requires a different Python|Invalid requirement)"
+    ),
+    re.compile(
+        r"ERROR: (?:file://\S+ does not appear|Directory '.*' is not installable)"
+    ),
+    re.compile(r"error: (?:subprocess-exited-with-error|metadata-generation-failed)"),
+    re.compile(r"error: externally-managed-environment"),
+]
+# indented block that pip prints under these lines
+PIP_BLOCK_PATTERN = re.compile(r"The conflict is caused by:|Requires-Python")
+APT_ERROR_PATTERN = re.compile(r"^E: |has no installation candidate|dpkg: error")
+COMPILER_ERROR_PATTERN = re.compile(
+    r"^\S+\.(?:c|h|cc|cpp|cxx|hpp|pyx|pxd|f90|rs):\d+(?::\d+)?: (?:fatal )?error: "
+    r"|error: command '[^']*' failed|^error\[E\d+\]:|(?:gcc|g\+\+|cc|ld): error: "
+    r"|error: Microsoft Visual C\+\+|error: can't find Rust compiler"
+)
+PYTEST_SUMMARY_START_PATTERN = re.compile(r"^=+ short test summary info =+$")
+PYTEST_RESULT_PATTERN = re.compile(
+    r"^=+ .*\b(?:\d+ (?:passed|failed|errors?)|no tests ran)\b.* in [\d.]+s.*=+$"
+)
+PYTEST_COLLECTION_PATTERN = re.compile(r"^(?:ERROR|FAILED) \S+")
+DOCKER_ERROR_PATTERNS = [
+    re.compile(r"did not complete successfully: exit code: \d+"),
+    re.compile(r"returned a non-zero code: \d+"),
+    re.compile(r"pull access denied|manifest unknown|not found: manifest"),
+    re.compile(r"failed to compute cache key|COPY failed|no such file or directory"),
+]
+# parts of error messages that differ between repos and runs for the same error
+SIGNATURE_PATTERNS = [
+    (re.compile(r"^(?:ERROR: )?(?:failed to solve: )?"), ""),
+    (re.compile(r"/tmp/[\w.\-/]+|/(?:usr|opt|root|home|app|repo)\S*"), "<path>"),
+    (re.compile(r"\b[0-9a-f]{8,}\b"), "<hex>"),
+    (re.compile(r" in [\d.]+s\b"), " in <t>s"),
+    (re.compile(r"\b\d+(?:\.\d+)+[\w.+\-]*"), "<version>"),
+    (re.compile(r"line \d+"), "line <n>"),
+    (re.compile(r":\d+(?::\d+)?:"), ":<n>:"),
+    (re.compile(r"exit code: \d+"), "exit code: <n>"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def clean_line(line: str) -> str:
+    "the text of a line of output as it last appeared, without colors or prefixes"
+    # progress bars redraw the line with carriage returns
+    line = line.rstrip("\r\n").split("\r")[-1]
+    return BUILDKIT_PREFIX_PATTERN.sub("", ANSI_PATTERN.sub("", line), count=1)
+
+
+def is_noise(line: str) -> bool:
+    return line.strip() == "" or any(p.search(line) for p in NOISE_PATTERNS)
+
+
+def error_signature(kind: str, message: str) -> str:
+    "normalized form of an error, the same for the same error in different repos"
+    message = message.strip()
+    for pattern, replacement in SIGNATURE_PATTERNS:
+        message = pattern.sub(replacement, message)
+    return f"{kind}: {message}"
+
+
+class LogReducer:
+    """
+    Reduces the output of a docker build one line at a time to the errors in it,
+    dropping progress bars and download lines and collapsing repeated lines.
+    Python tracebacks, pip, apt, compiler and docker errors and pytest summaries
+    are extracted, and identical errors are only kept once.
+    """
+
+    def __init__(self, tail_size: int = REDUCED_TAIL_SIZE) -> None:
+        self.tail = deque(maxlen=tail_size)
+        self.errors: List[Dict[str, Any]] = []
+        self.signatures: Dict[str, Dict[str, Any]] = {}
+        # error whose following lines are still being collected
+        self.block: Optional[Dict[str, Any]] = None
+        self.previous: Optional[str] = None
+        self.n_repeats = 0
+        self.n_chars = 0
+        self.n_lines = 0
+        self.n_noise = 0
+
+    def feed(self, line: str):
+        "process a line of build output"
+        self.n_lines += 1
+        self.n_chars += len(line)
+        line = clean_line(line)
+        if is_noise(line):
+            self.n_noise += 1
+            return
+        if line == self.previous:
+            self.n_repeats += 1
+            return
+        self.flush_repeats()
+        self.previous = line
+        self.tail.append(line)
+        if self.block is not None and self.continue_block(line):
+            return
+        self.extract(line)
+
+    def flush_repeats(self):
+        if self.n_repeats > 0 and len(self.tail) > 0:
+            self.tail[-1] += f" (repeated {self.n_repeats} more times)"
+        self.n_repeats = 0
+
+    def continue_block(self, line: str) -> bool:
+        "add a line to the open error, returns False once the error has ended"
+        block = self.block
+        if block["kind"] == "traceback":
+            if line[:1].isspace():
+                block["lines"].append(line)
+                return True
+            # the first line that is not indented is the exception
+            block["lines"].append(line)
+            block["message"] = line.strip()
+            self.close_block()
+            return True
+        if block["kind"] == "pytest":
+            block["lines"].append(line)
+            if PYTEST_RESULT_PATTERN.match(line.strip()):
+                block["message"] = line.strip().strip("= ")
+                self.close_block()
+            return True
+        # pip blocks go on while they are indented
+        if line[:1].isspace() or line.strip().startswith(("-", "*")):
+            block["lines"].append(line)
+            return True
+        self.close_block()
+        return False
+
+    def open_block(self, kind: str, line: str, message: Optional[str] = None):
+        self.close_block()
+        self.block = {"kind": kind, "message": message or line.strip(), "lines": [line]}
+
+    def close_block(self):
+        if self.block is not None:
+            block, self.block = self.block, None
+            self.add(block["kind"], block["message"], block["lines"])
+
+    def extract(self, line: str):
+        stripped = line.strip()
+        if TRACEBACK_START_PATTERN.search(stripped):
+            self.open_block("traceback", line)
+        elif PYTEST_SUMMARY_START_PATTERN.match(stripped):
+            self.open_block("pytest", line)
+        elif PYTEST_RESULT_PATTERN.match(stripped):
+            self.add("pytest", stripped.strip("= "), [line])
+        elif PIP_BLOCK_PATTERN.search(stripped):
+            self.open_block("pip", line)
+        elif any(p.search(stripped) for p in PIP_ERROR_PATTERNS):
+            self.open_block("pip", line)
+        elif APT_ERROR_PATTERN.search(stripped):
+            self.add("apt", stripped, [line])
+        elif COMPILER_ERROR_PATTERN.search(stripped):
+            self.add("compiler", stripped, [line])
+        elif any(p.search(stripped) for p in DOCKER_ERROR_PATTERNS):
+            self.add("docker", stripped, [line])
+        elif PYTEST_COLLECTION_PATTERN.match(stripped) and self.errors_of("pytest"):
+            self.errors_of("pytest")[-1]["lines"].append(line)
+
+    def errors_of(self, kind: str) -> List[Dict[str, Any]]:
+        return [error for error in self.errors if error["kind"] == kind]
+
+    def add(self, kind: str, message: str, lines: List[str]):
+        signature = error_signature(kind, message)
+        if signature in self.signatures:
+            self.signatures[signature]["count"] += 1
+            return
+        error = {
+            "kind": kind,
+            "message": message,
+            "signature": signature,
+            "count": 1,
+            # the end of long errors, where the cause is
+            "lines": lines[:2] + lines[2:][-(MAX_ERROR_LINES - 2) :],
+        }
+        self.signatures[signature] = error
+        self.errors.append(error)
+
+    def text(self, errors: List[Dict[str, Any]]) -> str:
+        parts = []
+        for error in errors:
+            count = f" (x{error['count']})" if error["count"] > 1 else ""
+            parts.append(f"[{error['kind']}]{count}\n" + "\n".join(error["lines"]))
+        shown = {line for error in self.errors for line in error["lines"]}
+        tail = [line for line in self.tail if line not in shown]
+        if len(tail) > 0:
+            parts.append("last lines of output:\n" + "\n".join(tail))
+        return "\n\n".join(parts)
+
+    def result(self) -> Dict[str, Any]:
+        "the errors found so far and the reduced text of the output"
+        self.close_block()
+        self.flush_repeats()
+        errors = self.errors[-MAX_ERRORS:]
+        text = self.text(errors)
+        return {
+            "errors": errors,
+            "signature": [error["signature"] for error in errors],
+            "text": text,
+            "n_lines": self.n_lines,
+            "n_noise": self.n_noise,
+            "original_chars": self.n_chars,
+            "reduced_chars": len(text),
+            "ratio": len(text) / self.n_chars if self.n_chars > 0 else 1.0,
+        }
+
+
+def reduce_log(log: str) -> Dict[str, Any]:
+    "reduce a whole build log, see LogReducer"
+    reducer = LogReducer()
+    for line in log.splitlines():
+        reducer.feed(line)
+    return reducer.result()
@@ -1,14 +1,19 @@
+import heapq
 import json
 import os
 import random
+import threading
+from collections import Counter, defaultdict
 from difflib import get_close_matches
 from functools import reduce
 from types import SimpleNamespace
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 import git
 import requests
 
+from install_test.consts import PATH_INDEX_CANDIDATES, PATH_INDEX_MIN_SIZE
+
 
 def print_output(msg: str, char: str, verbose: bool):
     if verbose:
@@ -34,6 +39,12 @@ def classify_output(
     if not options:
         return response
 
+    elif isinstance(options, PathList):
+        match = options.close_match(response, cutoff)
+        if match is None:
+            raise ClassificationError(response, options)
+        return match
+
     elif isinstance(options, list):
         matches = get_close_matches(response, options, n=1, cutoff=cutoff)
         if len(matches) == 0:
@@ -53,6 +64,117 @@ def classify_output(
         return inverse_options[matches[0]]
 
 
+def trigrams(path: str) -> Set[str]:
+    path = f"  {path.lower()} "
+    return {path[i : i + 3] for i in range(len(path) - 2)}
+
+
+class PathList(list):
+    """
+    A list of repository paths indexed for `classify_output`.
+    The index is extended as paths are appended, and rebuilt after any other
+    change. Lists shorter than PATH_INDEX_MIN_SIZE are matched with difflib
+    against every path, longer ones only against the paths ending with the
+    response and those sharing the most trigrams with it.
+    The index is guarded by a lock, as tool calls running in parallel extend
+    the lists while others match against them.
+    """
+
+    def __init__(self, paths=()):
+        super().__init__(paths)
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._indexed = 0
+        self._paths = set()
+        self._suffixes = defaultdict(list)
+        self._trigrams = defaultdict(list)
+        self._n_trigrams = []
+
+    def _update(self):
+        with self._lock:
+            # paths appended meanwhile are indexed by the next update
+            stop = len(self)
+            for i in range(self._indexed, stop):
+                path = self[i]
+                self._paths.add(path)
+                parts = path.strip("/").split("/")
+                for j in range(len(parts)):
+                    self._suffixes["/".join(parts[j:])].append(i)
+                path_trigrams = trigrams(path)
+                for trigram in path_trigrams:
+                    self._trigrams[trigram].append(i)
+                self._n_trigrams.append(len(path_trigrams))
+            self._indexed = stop
+
+    def candidates(self, response: str) -> List[str]:
+        "paths ending with the response, then those sharing the most trigrams"
+        with self._lock:
+            return self._candidates(response)
+
+    def _candidates(self, response: str) -> List[str]:
+        self._update()
+        key = response.strip()
+        while key.startswith("./"):
+            key = key[2:]
+        indices = dict.fromkeys(self._suffixes.get(key.strip("/"), []))
+        response_trigrams = trigrams(response)
+        shared = Counter()
+        for trigram in response_trigrams:
+            shared.update(self._trigrams.get(trigram, []))
+        # ranked by dice coefficient, so that long paths are not favoured
+        n = len(response_trigrams)
+        best = heapq.nlargest(
+            PATH_INDEX_CANDIDATES,
+            shared,
+            key=lambda i: shared[i] / (n + self._n_trigrams[i]),
+        )
+        indices.update((i, None) for i in best)
+        return [self[i] for i in indices]
+
+    def close_match(self, response: str, cutoff: float = 0.5) -> Optional[str]:
+        "the path most similar to the response, if it is similar enough"
+        if len(self) < PATH_INDEX_MIN_SIZE:
+            matches = get_close_matches(response, self, n=1, cutoff=cutoff)
+        else:
+            with self._lock:
+                self._update()
+                if response in self._paths:
+                    return response
+                candidates = self._candidates(response)
+            matches = get_close_matches(response, candidates, n=1, cutoff=cutoff)
+        return matches[0] if len(matches) > 0 else None
+
+
+def _invalidating(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            result = method(self, *args, **kwargs)
+            self._reset()
+        return result
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+# changes other than appending paths shift or replace the indexed ones
+for _name in [
+    "__setitem__",
+    "__delitem__",
+    "__imul__",
+    "insert",
+    "remove",
+    "pop",
+    "clear",
+    "sort",
+    "reverse",
+]:
+    setattr(PathList, _name, _invalidating(_name))
+
+
 def update_files_dirs(
     files: List[str],
     dirs: List[str],
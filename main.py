@@ -4,14 +4,23 @@ from pprint import pprint
 from typing import Any, Dict, List, Optional
 
 from install_test.agent import Agent, GatherAgent, RepairAgent
+from install_test.agent.fix_cache import FixCache
+from install_test.agent.functions import set_backend, set_cache
+from install_test.agent.github_cache import GithubCache
+from install_test.agent.llm_cache import LLMCache
 from install_test.consts import (
     DEFAULT_MODEL,
     FASTAPI,
+    FIX_CACHE_PATH,
+    LLM_CACHE_MODES,
+    LLM_CACHE_PATH,
     NO_SEARCH_SYSTEM_PROMPT_PATH,
+    REPO_BACKENDS,
 )
 from install_test.utils import generate_name
 from eval.eval_gather import eval_gather_build
-from vm_control import VMController
+from eval.eval_pipeline import eval_pipeline
+from vm_control import VMController, WorkerPool, parse_worker
 
 
 def gather_repo(
@@ -34,8 +43,39 @@ def gather_repo(
 def main(args, run_name):
     url = args.repo
     repo_name = url.split("/")[-1][:-4]
+    set_backend(args.backend, args.clone_dir)
+    if args.context_budget is not None:
+        Agent.context_budget = int(args.context_budget)
+    if not args.no_github_cache:
+        set_cache(GithubCache())
+    GatherAgent.prefetch = args.prefetch
+    if args.base_url is not None:
+        Agent.base_url = args.base_url
+    Agent.n_candidates = int(args.candidates)
+    if args.llm_cache is not None:
+        Agent.response_cache = LLMCache(args.llm_cache_path, mode=args.llm_cache)
+    if args.fix_cache:
+        RepairAgent.fix_cache = FixCache(args.fix_cache_path)
+    if args.workers:
+        VMController.pool = WorkerPool([parse_worker(w) for w in args.workers])
+    VMController.layer_cache = args.layer_cache
+    VMController.cache_mounts = args.cache_mounts
+    VMController.clean_verification = args.clean_verification
+    VMController.reuse_checkout = args.reuse_checkout
+    VMController.staged_build = args.staged_build
 
-    if args.eval:
+    if args.eval and args.pipeline:
+        eval_pipeline(
+            repo_sets=args.repo_sets,
+            n_eval=int(args.n_eval),
+            repair_attempts=int(args.n_tries),
+            model=args.model,
+            run_name=run_name,
+            perfect_recall=args.PR,
+            n_llm=int(args.n_workers),
+            build_queue=int(args.build_queue),
+        )
+    elif args.eval:
         eval_gather_build(
             repo_sets=args.repo_sets,
             n_eval=int(args.n_eval),
@@ -43,12 +83,14 @@ def main(args, run_name):
             model=args.model,
             run_name=run_name,
             perfect_recall=args.PR,
+            n_workers=int(args.n_workers),
         )
     else:
         if args.dockerfile is not None:
             with open(args.dockerfile, "r") as f:
                 dockerfile = f.read()
             prev_messages = []
+            alternatives = []
         else:
             url = args.repo
             name = url.split("/")[-1][:-4]
@@ -60,6 +102,7 @@ def main(args, run_name):
             agent = gather_repo(url, model=args.model, prev_messages=prev_messages)
             dockerfile = agent.gen_dockerfile(url, name)
             prev_messages = agent.prev_messages
+            alternatives = agent.alternatives
         agent = RepairAgent(
             args.model,
             RepairAgent.init_system_message(url, dockerfile),
@@ -72,6 +115,7 @@ def main(args, run_name):
             dockerfile=dockerfile,
             repo_name=repo_name,
             n_tries=int(args.n_tries),
+            alternatives=alternatives,
         )
 
 
@@ -109,6 +153,36 @@ if __name__ == "__main__":
         default=10,
         help="Number of times to repeat evaluation.",
     )
+    parser.add_argument(
+        "--n_workers",
+        default=1,
+        help="Number of repositories to evaluate at the same time.",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help=(
+            "If set, dockerfiles of some repos are built while the model works "
+            "on others, with --n_workers repos being generated at a time."
+        ),
+    )
+    parser.add_argument(
+        "--build_queue",
+        default=2,
+        help=(
+            "With --pipeline, number of generated dockerfiles that may wait "
+            "for a build before generation pauses."
+        ),
+    )
+    parser.add_argument(
+        "--candidates",
+        default=1,
+        help=(
+            "Number of alternative dockerfiles to request for every generation "
+            "and repair. They are built at the same time, and the first one to "
+            "pass is kept while the other builds are cancelled."
+        ),
+    )
     parser.add_argument(
         "--model",
         help="name of the openai model to use as the agent.",
@@ -135,6 +209,125 @@ if __name__ == "__main__":
             "the agent will first replay these messages before actually querying the LLM."
         ),
     )
+    parser.add_argument(
+        "--backend",
+        choices=REPO_BACKENDS,
+        default="api",
+        help=(
+            "where the agent reads repository contents from, either the github api "
+            "or a local clone of each repository."
+        ),
+    )
+    parser.add_argument(
+        "--clone_dir",
+        default=None,
+        help=(
+            "directory holding local clones for the local backend. "
+            "Existing checkouts named <owner>__<repo>@<ref> are reused."
+        ),
+    )
+    parser.add_argument(
+        "--no_github_cache",
+        action="store_true",
+        help="If set, github api responses are not cached on disk.",
+    )
+    parser.add_argument(
+        "--workers",
+        nargs="*",
+        help=(
+            "build workers to verify dockerfiles on, either <machine_name>:<host_port> "
+            "for a virtual machine or a docker host url (e.g. unix:///var/run/docker.sock) "
+            "for a local docker daemon. Defaults to the single machine in the readme."
+        ),
+    )
+    parser.add_argument(
+        "--layer_cache",
+        action="store_true",
+        help=(
+            "If set, docker layer caches are kept between builds, "
+            "so repair attempts and later rounds only rebuild the changed layers."
+        ),
+    )
+    parser.add_argument(
+        "--cache_mounts",
+        action="store_true",
+        help="With --layer_cache, also cache pip and apt downloads between builds.",
+    )
+    parser.add_argument(
+        "--clean_verification",
+        action="store_true",
+        help=(
+            "With --layer_cache, confirm every successful build "
+            "with a build that does not use any cache."
+        ),
+    )
+    parser.add_argument(
+        "--reuse_checkout",
+        action="store_true",
+        help=(
+            "If set, each build worker keeps a checkout of every repository "
+            "that is reset between builds instead of cloning it for every attempt."
+        ),
+    )
+    parser.add_argument(
+        "--staged_build",
+        action="store_true",
+        help=(
+            "If set, builds follow the instructions of the dockerfile in the buildkit "
+            "progress output, stop at the first failing step and report it "
+            "to the repair agent."
+        ),
+    )
+    parser.add_argument(
+        "--context_budget",
+        default=None,
+        help=(
+            "If set, the oldest tool outputs are replaced by short stubs "
+            "in requests that would be larger than this many tokens."
+        ),
+    )
+    parser.add_argument(
+        "--llm_cache",
+        default=None,
+        choices=LLM_CACHE_MODES,
+        help=(
+            "Cache model responses on disk. 'record' always calls the api and "
+            "stores the responses, 'replay' only uses stored responses, "
+            "'auto' only calls the api for requests that were never recorded."
+        ),
+    )
+    parser.add_argument(
+        "--llm_cache_path",
+        default=LLM_CACHE_PATH,
+        help="File the model responses are cached in.",
+    )
+    parser.add_argument(
+        "--fix_cache",
+        action="store_true",
+        help=(
+            "If set, dockerfile changes that fixed a build are cached by the errors "
+            "they fixed, and tried on builds failing with the same errors "
+            "before asking the model for a repair."
+        ),
+    )
+    parser.add_argument(
+        "--fix_cache_path",
+        default=FIX_CACHE_PATH,
+        help="File the fixes that worked are cached in.",
+    )
+    parser.add_argument(
+        "--base_url",
+        default=None,
+        help="OpenAI compatible endpoint to send model requests to.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help=(
+            "If set, files that usually document the installation are fetched "
+            "in the background while the model searches the repository."
+        ),
+    )
     args = parser.parse_args()
     run_name = generate_name()
     print(f"RUN:    {run_name}")
@@ -144,6 +337,13 @@ if __name__ == "__main__":
     except KeyboardInterrupt as e:
         pass
     finally:
-        print("clearing cache...")
-        VMController().clear_cache()
+        if not VMController.layer_cache:
+            print("clearing cache...")
+            VMController().clear_cache()
+        for worker in VMController.pool.workers:
+            worker.close()
+        if Agent.response_cache is not None:
+            print(f"llm cache: {Agent.response_cache.stats()}")
+        if RepairAgent.fix_cache is not None:
+            print(f"fix cache: {RepairAgent.fix_cache.stats()}")
         print(f"FINISHED:   {run_name}")
@@ -1,15 +1,20 @@
 import argparse
 import os
+import queue
 import re
 import signal
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import uuid
+from contextlib import contextmanager
 from difflib import get_close_matches
 from io import TextIOWrapper
-from typing import List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
+from install_test.build_log import BuildLogAnalyzer, StagedBuildAnalyzer
 from install_test.consts import FASTAPI
 from install_test.utils import notify
 from git_scraping import get_repository_language
@@ -23,6 +28,20 @@ HOST_PORT = "3022"
 DOCKER_NAME = "lmmilliken"
 IMAGE_NAME = "temp_image"
 TIMEOUT = 60 * 20
+# seconds between checks of the cancel event of a running build
+CANCEL_POLL = 1.0
+# where checkouts are kept on a worker between builds
+CHECKOUT_DIR = "$HOME/vmc_checkouts"
+# free space on a worker below which images are evicted before a build
+MIN_FREE_SPACE = 20 * 2**30
+# free space that eviction tries to get back to
+TARGET_FREE_SPACE = 40 * 2**30
+# base images used by most builds, never evicted
+HOT_IMAGES = ["python", "ubuntu", "debian"]
+PIP_CACHE_MOUNT = "--mount=type=cache,target=/root/.cache/pip"
+APT_CACHE_MOUNT = "--mount=type=cache,target=/var/cache/apt,sharing=locked"
+# build argument given a new value for every cached build, to rerun the tests
+CACHE_BUST_ARG = "CACHE_BUST"
 
 
 class OutOfStorage(Exception):
@@ -30,12 +49,275 @@ class OutOfStorage(Exception):
         super().__init__(*args)
 
 
+def base_images(dockerfile: str) -> List[str]:
+    "the images that a dockerfile builds on, with their tags"
+    images = re.findall(
+        r"^\s*FROM\s+(?:--platform=\S+\s+)?(\S+)", dockerfile, re.I | re.M
+    )
+    return [image if ":" in image else f"{image}:latest" for image in images]
+
+
+def add_cache_mounts(dockerfile: str) -> str:
+    """
+    add buildkit cache mounts to RUN instructions that use pip or apt,
+    so that downloaded packages are reused even when a layer has to be rebuilt.
+    """
+    lines = dockerfile.split("\n")
+    for i, line in enumerate(lines):
+        stripped = line.lstrip()
+        if not stripped.upper().startswith("RUN "):
+            continue
+        end = i
+        while end < len(lines) - 1 and lines[end].rstrip().endswith("\\"):
+            end += 1
+        instruction = "\n".join(lines[i : end + 1])
+        mounts, prefix = [], ""
+        if re.search(r"\bpip3?\b", instruction):
+            mounts.append(PIP_CACHE_MOUNT)
+            for j in range(i, end + 1):
+                lines[j] = lines[j].replace(" --no-cache-dir", "")
+        if re.search(r"\bapt(-get)?\b", instruction):
+            mounts.append(APT_CACHE_MOUNT)
+            # the official images delete downloaded packages after every install
+            if not stripped[4:].lstrip().startswith("["):
+                prefix = "rm -f /etc/apt/apt.conf.d/docker-clean ; "
+        if len(mounts) > 0:
+            indent = lines[i][: len(lines[i]) - len(lines[i].lstrip())]
+            command = lines[i].lstrip()[4:].lstrip()
+            lines[i] = f"{indent}RUN {' '.join(mounts)} {prefix}{command}"
+    return "\n".join(lines)
+
+
+def add_cache_bust(dockerfile: str) -> str:
+    """
+    declare CACHE_BUST_ARG before the last RUN instruction, where the tests run.
+    Building with a new value for it reruns that instruction even when
+    its layer is cached, as cached steps print no test output to count.
+    """
+    lines = dockerfile.split("\n")
+    last = None
+    for i, line in enumerate(lines):
+        continued = i > 0 and lines[i - 1].rstrip().endswith("\\")
+        if not continued and line.lstrip().upper().startswith("RUN "):
+            last = i
+    if last is None:
+        return dockerfile
+    indent = lines[last][: len(lines[last]) - len(lines[last].lstrip())]
+    lines.insert(last, f"{indent}ARG {CACHE_BUST_ARG}")
+    return "\n".join(lines)
+
+
+class BuildWorker:
+    """
+    A target that docker builds can be run on, either a virtual machine reached
+    over ssh through a forwarded port, or a docker daemon on the host.
+    """
+
+    def __init__(
+        self,
+        machine_name: str = MACHINE_NAME,
+        host_port: str = HOST_PORT,
+        user_name: str = USER_NAME,
+        pwd: str = PWD,
+        docker_host: Optional[str] = None,
+    ) -> None:
+        self.machine_name = machine_name
+        self.host_port = host_port
+        self.user_name = user_name
+        self.pwd = pwd
+        self.docker_host = docker_host
+        self.lock = threading.Lock()
+        # when each image on the worker was last used by a build
+        self.image_use: Dict[str, float] = {}
+
+    @property
+    def is_local(self) -> bool:
+        return self.docker_host is not None
+
+    @property
+    def name(self) -> str:
+        return (
+            self.docker_host
+            if self.is_local
+            else f"{self.machine_name}:{self.host_port}"
+        )
+
+    @property
+    def slug(self) -> str:
+        return re.sub(r"[^A-Za-z0-9]+", "_", self.name).strip("_")
+
+    @property
+    def env(self) -> Optional[Dict[str, str]]:
+        return (
+            {**os.environ, "DOCKER_HOST": self.docker_host} if self.is_local else None
+        )
+
+    @property
+    def ssh_options(self) -> str:
+        # commands reuse the session of the master connection opened in `connect`,
+        # and fall back to a connection of their own if it is not available.
+        return (
+            "-oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null "
+            f"-oControlMaster=no -oControlPath={self.control_path}"
+        )
+
+    @property
+    def control_path(self) -> str:
+        return os.path.join(
+            tempfile.gettempdir(), f"vmc-{self.user_name}-{self.host_port}.sock"
+        )
+
+    def is_connected(self) -> bool:
+        if self.is_local:
+            return True
+        check = subprocess.run(
+            (
+                f"ssh -oControlPath={self.control_path} -O check "
+                f"-p {self.host_port} {self.user_name}@localhost"
+            ).split(" "),
+            capture_output=True,
+        )
+        return check.returncode == 0
+
+    def connect(self):
+        "opens the persistent ssh session that later commands are multiplexed over"
+        with self.lock:
+            if self.is_connected():
+                return
+            try:
+                self.open_master()
+            except subprocess.TimeoutExpired:
+                # commands will open connections of their own instead
+                pass
+
+    def open_master(self):
+        subprocess.run(
+            (
+                f"/usr/bin/sshpass -p {self.pwd} ssh -M -N -f -p {self.host_port} "
+                "-oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null "
+                f"-oControlPath={self.control_path} -oControlPersist=yes "
+                "-oServerAliveInterval=30 "
+                f"{self.user_name}@localhost"
+            ).split(" "),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=60,
+        )
+
+    def close(self):
+        "closes the persistent ssh session, if there is one"
+        if self.is_local or not self.is_connected():
+            return
+        subprocess.run(
+            (
+                f"ssh -oControlPath={self.control_path} -O exit "
+                f"-p {self.host_port} {self.user_name}@localhost"
+            ).split(" "),
+            capture_output=True,
+        )
+
+    def command(self, cmd: str) -> List[str]:
+        "returns the arguments needed to run the shell command `cmd` on the worker"
+        if self.is_local:
+            return ["bash", "-c", cmd]
+        return (
+            f"/usr/bin/sshpass -p {self.pwd} ssh -T -p {self.host_port} "
+            f"{self.ssh_options} {self.user_name}@localhost"
+        ).split(" ") + [cmd]
+
+    def copy(self, src: str, dst: str) -> List[str]:
+        "returns the arguments needed to copy a local file to `dst` on the worker"
+        if self.is_local:
+            return ["cp", src, dst]
+        return (
+            f"/usr/bin/sshpass -p {self.pwd} scp -P {self.host_port} "
+            f"{self.ssh_options} {src} {self.user_name}@localhost:{dst}"
+        ).split(" ")
+
+    def run(self, cmd: str, **kwargs) -> subprocess.CompletedProcess:
+        return subprocess.run(self.command(cmd), env=self.env, **kwargs)
+
+    def popen(self, cmd: str, **kwargs) -> subprocess.Popen:
+        return subprocess.Popen(self.command(cmd), env=self.env, **kwargs)
+
+    def stream(self, cmd: str) -> Iterator[str]:
+        "runs `cmd` on the worker, yielding lines of its stdout and stderr as they arrive"
+        process = self.popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            for line in process.stdout:
+                yield line.decode("utf-8", errors="replace")
+        finally:
+            process.stdout.close()
+            process.wait()
+
+
+def parse_worker(spec: str) -> BuildWorker:
+    """
+    build a worker from either `<machine_name>:<host_port>` for a virtual machine
+    or a docker host url such as `unix:///var/run/docker.sock` for a local daemon.
+    """
+    if "://" in spec:
+        return BuildWorker(docker_host=spec)
+    machine_name, host_port = spec.split(":")
+    return BuildWorker(machine_name=machine_name, host_port=host_port)
+
+
+class WorkerPool:
+    "hands out idle build workers, so that each worker runs one build at a time"
+
+    def __init__(self, workers: List[BuildWorker]) -> None:
+        self.workers = workers
+        self.idle = queue.Queue()
+        for worker in workers:
+            self.idle.put(worker)
+
+    @contextmanager
+    def lease(self) -> Iterator[BuildWorker]:
+        worker = self.idle.get()
+        try:
+            yield worker
+        finally:
+            self.idle.put(worker)
+
+
 class VMController:
-    def __init__(self, logs: Optional[str] = "STDOUT") -> None:
+    # shared by all controllers, replace to build on several machines at once
+    pool = WorkerPool([BuildWorker()])
+    # reuse docker layer caches between builds instead of building with --no-cache
+    layer_cache = False
+    # with layer_cache, also cache pip and apt downloads with buildkit cache mounts
+    cache_mounts = False
+    # with layer_cache, confirm successful builds with a build that uses no cache
+    clean_verification = False
+    # keep a checkout of each repo on the worker and reset it between builds
+    reuse_checkout = False
+    # follow the instructions of the dockerfile in the buildkit progress output,
+    # stopping at the first failing step and recording it in last_build["failure"]
+    staged_build = False
+
+    def __init__(
+        self,
+        logs: Optional[str] = "STDOUT",
+        worker: Optional[BuildWorker] = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> None:
         self.logs = logs
+        # once set, the build is stopped, e.g. when another candidate has passed
+        self.cancel = cancel
         if self.logs is not None:
             with open(self.logs, "w") as f:
                 f.write("")
+        # set while a build is running, unless fixed by the caller
+        self.worker = worker
+        # every build gets its own tag so that builds can not remove each other
+        self.image_name = f"{IMAGE_NAME}_{uuid.uuid4().hex[:12]}"
+        # structured result of the most recent call to build_project
+        self.last_build: Optional[Dict[str, Any]] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel is not None and self.cancel.is_set()
 
     def log(self, msg, flag="a"):
         if self.logs == "STDOUT":
@@ -57,22 +339,25 @@ class VMController:
 
     def open_machine(self):
         """Opens the to use for testing, if the machine is already running, does nothing."""
+        if self.worker.is_local:
+            return
+        machine_name = self.worker.machine_name
 
         machines = subprocess.run(
             ["VBoxManage", "list", "vms"], capture_output=True
         ).stdout.decode("utf-8")
 
-        if '"' + MACHINE_NAME + '"' not in machines:
-            raise ValueError(f"no machine named {MACHINE_NAME}")
+        if '"' + machine_name + '"' not in machines:
+            raise ValueError(f"no machine named {machine_name}")
         running_machines = str(
             subprocess.run(
                 ["VBoxManage", "list", "runningvms"], capture_output=True
             ).stdout
         )
-        if '"' + MACHINE_NAME + '"' not in running_machines:
+        if '"' + machine_name + '"' not in running_machines:
             response = str(
                 subprocess.run(
-                    f"VBoxManage startvm {MACHINE_NAME} --type headless".split(" "),
+                    f"VBoxManage startvm {machine_name} --type headless".split(" "),
                     capture_output=True,
                 ).stdout
             )
@@ -88,13 +373,11 @@ class VMController:
         Clones target repo in a temporary directory within the vm,
         then sends the dockerfile via scp.
         """
+        if self.reuse_checkout:
+            return None, self.setup_checkout(target_repo, dockerfile, ref=ref)
         # make temp directory
-        cmd = (
-            f"sshpass -p {PWD} ssh -p {HOST_PORT} {USER_NAME}@localhost "
-            f"echo $(mktemp -d)"
-        )
         tmp_dir = (
-            subprocess.run(cmd.split(" "), capture_output=True)
+            self.worker.run("echo $(mktemp -d)", capture_output=True)
             .stdout.decode("utf-8")
             .strip()
         )
@@ -102,17 +385,16 @@ class VMController:
         # clone target repo in temp directory
         repo_name = target_repo.split("/")[-1][:-4]
         cmd = (
-            f"/usr/bin/sshpass -p {PWD} ssh -T -p {HOST_PORT} {USER_NAME}@localhost "
-            f"cd {tmp_dir} ; git clone --recursive {target_repo} ; cd {repo_name} ; rm .dockerignore"
+            f"cd {tmp_dir} ; git clone --recursive {target_repo} ; "
+            f"cd {repo_name} ; rm .dockerignore"
         )
         if ref is not None:
             cmd = cmd + f"; git checkout {ref}"
-        cmd = cmd.split(" ")
 
         try:
-            resp = subprocess.run(cmd, capture_output=True, timeout=TIMEOUT)
+            resp = self.worker.run(cmd, capture_output=True, timeout=TIMEOUT)
         except subprocess.TimeoutExpired:
-            resp = subprocess.run(cmd, capture_output=True, timeout=TIMEOUT)
+            resp = self.worker.run(cmd, capture_output=True, timeout=TIMEOUT)
 
         self.log(resp.stderr.decode("utf-8").strip())
         self.log(resp.stdout.decode("utf-8").strip())
@@ -122,147 +404,320 @@ class VMController:
         repo_dir = f"{tmp_dir}/{repo_name}"
         print(repo_dir)
         # send dockerfile to vm
-        subprocess.run(
-            (
-                f"/usr/bin/sshpass -p {PWD} "
-                f"scp -P {HOST_PORT} "
-                "-oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null "
-                f"{dockerfile} {USER_NAME}@localhost:{repo_dir}/Dockerfile"
-            ).split(" ")
-        )
+        subprocess.run(self.worker.copy(dockerfile, f"{repo_dir}/Dockerfile"))
         dockerfile = dockerfile.split("/")[-1]
         return tmp_dir, repo_dir
 
-    def build_project(self, repo_dir: str, logs: str) -> bool:
-        """Run docker build in the virtual machine and stream progress."""
-        # build dockerfile
+    def setup_checkout(
+        self, target_repo: str, dockerfile: str, ref: Optional[str] = None
+    ) -> str:
+        """
+        Resets the checkout of target repo that is kept on the worker between builds,
+        cloning it from a mirror the first time, then sends the dockerfile.
+        """
+        owner, repo = target_repo.replace(".git", "").split("/")[-2:]
+        root = f"{CHECKOUT_DIR}/{self.worker.slug}"
+        mirror = f"{root}/mirrors/{owner}__{repo}.git"
+        checkout = f"{root}/checkouts/{owner}__{repo}"
+        if ref is None:
+            fetch = "git fetch -q origin ; "
+        else:
+            # only go to the network if the pinned commit has not been seen before
+            fetch = (
+                f"git cat-file -e {ref}^{{commit}} || "
+                f"( git -C {mirror} fetch -q --prune ; git fetch -q origin ) ; "
+            )
         cmd = (
-            f"sshpass -p {PWD} ssh -p {HOST_PORT} "
-            "-oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null "
-            f"{USER_NAME}@localhost "
-            f"cd {repo_dir} ; docker build --no-cache -t {IMAGE_NAME} ."
-        ).split(" ")
+            f"mkdir -p {root}/mirrors {root}/checkouts ; "
+            f"[ -d {mirror} ] || git clone -q --mirror {target_repo} {mirror} ; "
+            f"[ -d {checkout} ] || "
+            f"git clone -q --reference {mirror} {target_repo} {checkout} ; "
+            f"cd {checkout} ; {fetch}"
+            "git reset -q --hard ; git clean -q -ffdx ; "
+            f"git checkout -q --force {ref or 'origin/HEAD'} ; "
+            "git submodule update -q --init --recursive --force ; "
+            "git submodule foreach -q --recursive 'git reset -q --hard ; git clean -q -ffdx' ; "
+            "rm -f .dockerignore ; echo REPO_DIR=$(pwd)"
+        )
+        start_time = time.time()
+        try:
+            resp = self.worker.run(cmd, capture_output=True, timeout=TIMEOUT)
+        except subprocess.TimeoutExpired:
+            resp = self.worker.run(cmd, capture_output=True, timeout=TIMEOUT)
+        self.log(resp.stderr.decode("utf-8").strip())
+        self.log(f"checkout ready in {time.time() - start_time:.1f} seconds")
+
+        repo_dirs = re.findall(r"REPO_DIR=(.*)", resp.stdout.decode("utf-8"))
+        if len(repo_dirs) == 0 or not repo_dirs[-1].strip().endswith(
+            f"checkouts/{owner}__{repo}"
+        ):
+            raise ValueError(f"failed to set up checkout of {target_repo}")
+        repo_dir = repo_dirs[-1].strip()
+        print(repo_dir)
+        # send dockerfile to vm
+        subprocess.run(self.worker.copy(dockerfile, f"{repo_dir}/Dockerfile"))
+        return repo_dir
+
+    def build_project(
+        self,
+        repo_dir: str,
+        logs: str,
+        no_cache: Optional[bool] = None,
+        dockerfile: Optional[str] = None,
+    ) -> bool:
+        """
+        Run docker build in the virtual machine and stream progress.
+        With staged_build and the contents of the dockerfile, the build runs
+        with buildkit's plain progress output and stops at the first failing step.
+        """
+        if no_cache is None:
+            no_cache = not self.layer_cache
+        staged = self.staged_build and dockerfile is not None
+        # build dockerfile, buildkit keeps its cache when the image is removed
+        if staged:
+            build = "DOCKER_BUILDKIT=1 docker build --progress=plain" + (
+                " --no-cache" if no_cache else ""
+            )
+        else:
+            build = (
+                "docker build --no-cache"
+                if no_cache
+                else "DOCKER_BUILDKIT=1 docker build"
+            )
+        if not no_cache:
+            build += f" --build-arg {CACHE_BUST_ARG}={uuid.uuid4().hex}"
+        cmd = self.worker.command(f"cd {repo_dir} ; {build} -t {self.image_name} .")
+        start_time = time.time()
+        free_before = self.free_space()
+        analyzer = StagedBuildAnalyzer(dockerfile) if staged else BuildLogAnalyzer()
         with open(logs, "a") as f:
-            progress, timeout = self.monitor_process(cmd, f, TIMEOUT)
-        if timeout:
+            progress, timeout, aborted = self.monitor_process(
+                cmd, f, TIMEOUT, on_line=analyzer.feed
+            )
+        # a build stopped at its failing step has its result and is not retried
+        if timeout and not aborted and not self.cancelled:
             with open(logs, "a") as f:
-                progress, timeout = self.monitor_process(cmd, f, TIMEOUT)
-
-        #     progress = subprocess.Popen(cmd, stdout=f, stderr=f)
-        # progress.wait()
-
-        with open(logs, "r") as f:
-            output = f.readlines()
-        passed = False
-        ran = False
-        for i, line in enumerate(output):
-            if "fatal" in line and "No space left on device" in line:
-                raise OutOfStorage()
-            if (
-                (
-                    ("==" in line and " in " in line)
-                    or "snapshots" in line
-                    or ("tests" in line)
-                    or len(output) - i < 30
+                progress, timeout, aborted = self.monitor_process(
+                    cmd, f, TIMEOUT, on_line=analyzer.feed
                 )
-                and "passed" in line
-            ) or (
-                ran
-                and (
-                    len(line.split()) > 0
-                    and line.split()[-1].strip() == "OK"
-                    or ("(" in line and line.split("(")[0].split()[-1] == "OK")
-                )
-            ):
-                passed = True
-            elif "Ran" in line and "tests in" in line:
-                ran = True
+
+        self.last_build = analyzer.result()
+        self.last_build["timeout"] = timeout
+        self.last_build["cached"] = not no_cache
+        self.last_build["duration"] = time.time() - start_time
+        self.last_build["cancelled"] = self.cancelled
+        free_after = self.free_space()
+        if free_before is not None and free_after is not None:
+            self.last_build["disk_used"] = free_before - free_after
+        if analyzer.out_of_storage:
+            raise OutOfStorage()
+        if self.cancelled and not self.last_build["passed"]:
+            self.log("build cancelled.")
+            return False
         if timeout:
             msg = (
                 "process timed out twice! "
                 f"(took more than {TIMEOUT} seconds) Aborting...\n"
             )
-            f.write(msg)
+            with open(logs, "a") as f:
+                f.write(msg)
+            self.last_build["failure_stage"] = "timeout"
             notify(msg)
             return False
-        if not passed:
-            try:
-                err = "Error running docker build on virtual machine:\n" + "\n".join(
-                    [p.decode("utf-8") for p in progress.stderr]
+        if not self.last_build["passed"]:
+            err = (
+                "Error running docker build on virtual machine:\n"
+                f"failed at step: {self.last_build['failing_step']}\n"
+                f"{self.last_build['fatal'] or self.last_build['tail']}"
+            )
+            failure = self.last_build.get("failure")
+            if failure is not None:
+                err += (
+                    f"\nfailing instruction on line {failure['line']}: "
+                    f"{failure['instruction']} (exit code {failure['exit_code']})"
                 )
-                self.log(err)
-                print(err)
-            except:
-                pass
+            self.log(err)
+            print(err)
             return False
         else:
             succ = (
-                "At least 1 test passed.\n"
+                f"At least 1 test passed ({self.last_build['n_passed']} counted).\n"
                 "Docker build completed successfully on virtual machine."
             )
             self.log(succ)
             print(succ)
             return True
 
-    def monitor_process(self, cmd: List[str], f: TextIOWrapper, timeout_val: int):
-        progress = subprocess.Popen(cmd, stdout=f, stderr=f)
-        start_time = time.time()
+    def free_space(self) -> Optional[int]:
+        "bytes available on the disk holding docker's data on the current worker"
+        resp = self.worker.run(
+            "df -B1 --output=avail "
+            "\"$(docker info -f '{{.DockerRootDir}}' 2>/dev/null || echo /)\" "
+            "| tail -n 1",
+            capture_output=True,
+        )
+        try:
+            return int(resp.stdout.decode("utf-8").strip())
+        except ValueError:
+            return None
+
+    def make_space(self) -> Optional[int]:
+        """
+        If the worker is low on storage, remove the least recently used images
+        and then unused build cache until TARGET_FREE_SPACE is available.
+        """
+        free = self.free_space()
+        if free is None or free >= MIN_FREE_SPACE:
+            return free
+        notify(f"LOW ON STORAGE ({free / 2**30:.1f}GB FREE), EVICTING IMAGES")
+        images = (
+            self.worker.run(
+                "docker image ls --format '{{.ID}} {{.Repository}}:{{.Tag}}'",
+                capture_output=True,
+            )
+            .stdout.decode("utf-8")
+            .split("\n")
+        )
+        images = [image.split(" ") for image in images if len(image.split(" ")) == 2]
+        # docker lists the newest images first, so untracked images go oldest first
+        candidates = [
+            (image_id, ref)
+            for image_id, ref in reversed(images)
+            if ref.split(":")[0] not in HOT_IMAGES
+        ]
+        candidates.sort(key=lambda image: self.worker.image_use.get(image[1], 0))
+        for image_id, ref in candidates:
+            self.worker.run(
+                f"docker image rm {image_id if '<none>' in ref else ref}",
+                capture_output=True,
+            )
+            self.worker.image_use.pop(ref, None)
+            free = self.free_space()
+            if free is not None and free >= TARGET_FREE_SPACE:
+                return free
+        for prune in ["docker builder prune -f", "docker builder prune -a -f"]:
+            self.worker.run(prune, capture_output=True)
+            free = self.free_space()
+            if free is not None and free >= TARGET_FREE_SPACE:
+                break
+        return free
+
+    def monitor_process(
+        self,
+        cmd: List[str],
+        f: TextIOWrapper,
+        timeout_val: int,
+        on_line: Optional[Callable[[str], bool]] = None,
+    ):
+        """
+        Run cmd, writing its output to f as it arrives.
+        `on_line` is called with every line of output, and the process is stopped
+        early if it returns True. If the process runs for longer than timeout_val
+        it is interrupted, and killed if the interrupt does not stop it.
+        The same happens once the cancel event of the controller is set.
+        Returns the process, whether it timed out and whether on_line stopped it.
+        """
+        # in a session of its own, so that the shell and docker can be signalled
+        # together, as the shell does not pass signals on to its children
+        progress = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=self.worker.env,
+            start_new_session=True,
+        )
+        # set once the output has ended, or once on_line asked to stop the process
+        stop = threading.Event()
+        aborted = threading.Event()
+        # set once monitor_process returns, after which f may be closed and
+        # the output of children that outlive the process is dropped
+        detached = threading.Event()
+        write_lock = threading.Lock()
+
+        def read_output():
+            for line in progress.stdout:
+                line = line.decode("utf-8", errors="replace")
+                with write_lock:
+                    if detached.is_set():
+                        break
+                    f.write(line)
+                    f.flush()
+                    if not aborted.is_set() and on_line is not None and on_line(line):
+                        aborted.set()
+                        stop.set()
+            stop.set()
+
+        reader = threading.Thread(target=read_output, daemon=True)
+        reader.start()
         timeout = False
-        interrupted = False
+        deadline = time.time() + timeout_val
         try:
-            while True:
-                # get latest output
-                if progress.poll() is not None:
+            timed_out = False
+            while not stop.wait(min(CANCEL_POLL, max(deadline - time.time(), 0))):
+                if self.cancelled:
                     break
-                elif time.time() - start_time > timeout_val:
-                    if not interrupted:
-                        # First try to cancel the process with an interrupt
-                        # os.killpg(os.getpgid(progress.pid), signal.SIGINT)
-                        os.kill(progress.pid, signal.SIGINT)
-                        notify(f"INTERRUPTING")
-                        start_time = time.time()
-                        timeout_val = 20
-                        interrupted = True
-                    else:
-                        # If the interrupt did not work, raise a timeout
-                        raise subprocess.TimeoutExpired(cmd, timeout_val)
-
-        except subprocess.TimeoutExpired:
-            notify("KILLING PROCESS")
-            progress.kill()
-            timeout = True
+                if time.time() >= deadline:
+                    timed_out = True
+                    break
+            if not stop.is_set() or aborted.is_set():
+                # First try to cancel the process with an interrupt
+                self.signal_process(progress, signal.SIGINT)
+                notify(
+                    "INTERRUPTING"
+                    if timed_out
+                    else "STOPPING BUILD EARLY" if aborted.is_set() else "CANCELLING"
+                )
+                try:
+                    progress.wait(20)
+                except subprocess.TimeoutExpired:
+                    # If the interrupt did not work, kill the process
+                    notify("KILLING PROCESS")
+                    # stopping a build that was cancelled is not a timeout
+                    timeout = timed_out
+                # also kills what is left of the group, e.g. background children,
+                # which ignore interrupts
+                self.signal_process(progress, signal.SIGKILL)
         finally:
             progress.wait()
-        return progress, timeout
+            # children that outlive a killed process can hold the output open
+            reader.join(timeout=20)
+            with write_lock:
+                detached.set()
+        return progress, timeout, aborted.is_set()
+
+    def signal_process(self, progress: subprocess.Popen, sig: signal.Signals):
+        """
+        send sig to the process group of a command started by monitor_process.
+        On a remote worker that only stops ssh, so the build of this controller
+        is also signalled on the worker, found by its unique image name.
+        """
+        try:
+            os.killpg(progress.pid, sig)
+        except ProcessLookupError:
+            pass
+        if not self.worker.is_local:
+            self.worker.run(
+                f"pkill -{sig.name[3:]} -f 'docker build .*-t {self.image_name} '",
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
 
     def clear_cache(self):
-        subprocess.run(
-            (
-                f"/usr/bin/sshpass -p {PWD} ssh -T -p {HOST_PORT} {USER_NAME}@localhost "
-                "docker system prune -a -f"
-            ).split(" "),
-        )
+        "remove all docker data on the current worker, or on every worker if idle"
+        workers = [self.worker] if self.worker is not None else self.pool.workers
+        for worker in workers:
+            worker.run("docker system prune -a -f")
 
     def cleanup(self, tmp_dir: str, keep_image: bool = False, keep_repo: bool = False):
         """Delete docker image and temporary file after execution."""
         if not keep_image:
             # remove newly created docker image
             self.log("removing docker image...")
-            subprocess.run(
-                (
-                    f"sshpass -p {PWD} ssh -T -p {HOST_PORT} {USER_NAME}@localhost "
-                    f"docker image rm {IMAGE_NAME}"
-                ).split(" "),
-            )
-        if not keep_repo:
+            self.worker.run(f"docker image rm {self.image_name}")
+        if not keep_repo and tmp_dir is not None:
             # clear temp directory
             self.log("clearing temp directory")
-            subprocess.run(
-                (
-                    f"/usr/bin/sshpass -p {PWD} ssh -T -p {HOST_PORT} {USER_NAME}@localhost "
-                    f"rm -rf {tmp_dir}"
-                ).split(" "),
-            )
+            self.worker.run(f"rm -rf {tmp_dir}")
 
     def test_dockerfile(
         self,
@@ -286,19 +741,81 @@ class VMController:
             df_contents = f.read()
         self.log(df_contents, "w")
 
+        if self.worker is not None:
+            return self._test_dockerfile(
+                target_repo, dockerfile, keep_image, keep_repo, logs, ref
+            )
+        with self.pool.lease() as worker:
+            self.worker = worker
+            self.log(f"building on worker {worker.name}")
+            try:
+                return self._test_dockerfile(
+                    target_repo, dockerfile, keep_image, keep_repo, logs, ref
+                )
+            finally:
+                self.worker = None
+
+    def _test_dockerfile(
+        self,
+        target_repo: str,
+        dockerfile: str,
+        keep_image: bool,
+        keep_repo: bool,
+        logs: Optional[str],
+        ref: Optional[str],
+    ) -> bool:
+        if self.cancelled:
+            # cancelled while waiting for a worker
+            self.log("build cancelled.")
+            return False
         self.open_machine()
+        self.worker.connect()
 
+        tmp_dir = None
+        original_dockerfile = dockerfile
+        self.make_space()
+        now = time.time()
+        with open(dockerfile, "r") as f:
+            original_contents = contents = f.read()
+        for image in base_images(contents):
+            self.worker.image_use[image] = now
+        if self.layer_cache and self.cache_mounts:
+            contents = add_cache_mounts(contents)
+        if self.layer_cache:
+            # the analyzer gets the dockerfile without the argument, whose lines
+            # are the ones the failing instruction is reported on
+            built = add_cache_bust(contents)
+            dockerfile = f"{dockerfile}.build"
+            with open(dockerfile, "w") as f:
+                f.write(built)
         try:
             tmp_dir, repo_dir = self.setup_repo(target_repo, dockerfile, ref=ref)
             self.log("setup repo.")
-            success = self.build_project(repo_dir=repo_dir, logs=logs or self.logs)
+            success = self.build_project(
+                repo_dir=repo_dir, logs=logs or self.logs, dockerfile=contents
+            )
+            if success and self.layer_cache and self.clean_verification:
+                self.log("verifying with a clean build...")
+                cached_duration = self.last_build["duration"]
+                subprocess.run(
+                    self.worker.copy(original_dockerfile, f"{repo_dir}/Dockerfile")
+                )
+                success = self.build_project(
+                    repo_dir=repo_dir,
+                    logs=logs or self.logs,
+                    no_cache=True,
+                    dockerfile=original_contents,
+                )
+                self.last_build["cached_duration"] = cached_duration
         except OutOfStorage:
             self.cleanup(tmp_dir)
             self.clear_cache()
             notify("RAN OUT OF STORAGE!! RESTARTING")
             tmp_dir, repo_dir = self.setup_repo(target_repo, dockerfile, ref=ref)
             self.log("setup repo.")
-            success = self.build_project(repo_dir=repo_dir, logs=logs or self.logs)
+            success = self.build_project(
+                repo_dir=repo_dir, logs=logs or self.logs, dockerfile=contents
+            )
 
         except Exception as e:
             success = False
@@ -320,8 +837,9 @@ def test_dockerfile(
     vmc: Optional[VMController] = None,
     ref: Optional[str] = None,
 ) -> bool:
-    dockerfile_path = "logs/dockerfiles/Dockerfile"
     name = url.split("/")[-1][:-4]
+    # one file per repo so that repos can be built at the same time
+    dockerfile_path = f"logs/dockerfiles/{repo_name or name}-build.dockerfile"
 
     with open(dockerfile_path, "w") as f:
         f.write(dockerfile)